@@ -1 +1,5 @@
 # -*- coding: utf-8 -*-
+"""
+    Provides user authentication for telegram bots.
+"""
+from ownbot.startup import warmup
@@ -2,11 +2,38 @@
 """
     Provides the ownbot AdminCommands class.
 """
+import os
+import threading
+import time
+
 from telegram.parsemode import ParseMode
 from telegram.ext import CommandHandler
 
 from ownbot.auth import requires_usergroup
-from ownbot.usermanager import UserManager
+from ownbot.broadcast import Broadcaster
+from ownbot.expiry import format_duration, parse_duration
+from ownbot.messagequeue import MessageQueue, QueuedBot
+from ownbot.usermanager import UserManager, using_tenant
+
+# The characters which start an entity in Telegram's legacy Markdown
+_MARKDOWN_CHARS = ("_", "*", "`", "[")
+
+
+def _escape_markdown(text):
+    """Escapes a value for a message sent with `ParseMode.MARKDOWN`.
+
+        Usernames like `@john_doe` would otherwise open an entity
+        which is never closed and Telegram would reject the message.
+
+        Args:
+            text (str): The value, e.g. a username or group name.
+
+        Returns:
+            str: The escaped value.
+    """
+    for char in _MARKDOWN_CHARS:
+        text = text.replace(char, "\\" + char)
+    return text
 
 
 class AdminCommands(object):  # pylint: disable=too-few-public-methods
@@ -14,28 +41,101 @@ class AdminCommands(object):  # pylint: disable=too-few-public-methods
         Provides admin command handlers for user/group
         management.
 
+        The replies are sent through a rate-limited message queue
+        so the handlers return without waiting for Telegram.
+
         Args:
             dispatcher (telegram.dispatcher): Command dispatcher to register the
                 admin commands.
+            message_queue (Optional[ownbot.messagequeue.MessageQueue]): The
+                queue to send the replies through.
+            broadcaster (Optional[ownbot.broadcast.Broadcaster]): Sends
+                the messages of the `broadcast` command.
+            tenant (Optional[str]): The tenant whose users are managed.
     """
 
-    def __init__(self, dispatcher):
-        self.__usermanager = UserManager()
+    def __init__(self, dispatcher, message_queue=None, broadcaster=None,
+                 tenant=None):
+        self.__tenant = tenant
         self.__dispatcher = dispatcher
+        self.__message_queue = message_queue
+        if message_queue is None:
+            self.__message_queue = MessageQueue()
+        self.__broadcaster = broadcaster
+        if broadcaster is None:
+            self.__broadcaster = Broadcaster(
+                bucket=self.__message_queue.bucket)
         self.__register_handlers()
 
+    @property
+    def message_queue(self):
+        """
+            Returns the queue the replies are sent through.
+        """
+        return self.__message_queue
+
+    def __queued(self, handler):
+        """Sends the replies of a handler through the message queue.
+
+            Args:
+                handler (func): The command handler function.
+
+            Returns:
+                func: The wrapped command handler function.
+        """
+
+        def call(bot, update, **kwargs):
+            return handler(QueuedBot(bot, self.__message_queue), update,
+                           **kwargs)
+
+        return self.__scoped(call)
+
+    def __scoped(self, handler):
+        """Runs a handler with the users of the tenant.
+
+            Args:
+                handler (func): The command handler function.
+
+            Returns:
+                func: The wrapped command handler function.
+        """
+        if self.__tenant is None:
+            return handler
+
+        def call(*args, **kwargs):
+            with using_tenant(self.__tenant):
+                return handler(*args, **kwargs)
+
+        return call
+
     def __register_handlers(self):
         """
             Registers the admin commands.
         """
-        self.__dispatcher.add_handler(CommandHandler("adminhelp",
-                                                     self.__admin_help))
-        self.__dispatcher.add_handler(CommandHandler("users", self.__get_users))
-        self.__dispatcher.add_handler(CommandHandler("adduser",
-                                                     self.__add_user,
-                                                     pass_args=True))
         self.__dispatcher.add_handler(CommandHandler(
-            "rmuser", self.__rm_user, pass_args=True))
+            "adminhelp", self.__queued(self.__admin_help)))
+        self.__dispatcher.add_handler(CommandHandler(
+            "users", self.__queued(self.__get_users)))
+        self.__dispatcher.add_handler(CommandHandler(
+            "groups", self.__queued(self.__get_groups)))
+        self.__dispatcher.add_handler(CommandHandler(
+            "finduser", self.__queued(self.__find_user), pass_args=True))
+        self.__dispatcher.add_handler(CommandHandler(
+            "pending", self.__queued(self.__get_pending)))
+        self.__dispatcher.add_handler(CommandHandler(
+            "adduser", self.__queued(self.__add_user), pass_args=True))
+        self.__dispatcher.add_handler(CommandHandler(
+            "rmuser", self.__queued(self.__rm_user), pass_args=True))
+        self.__dispatcher.add_handler(CommandHandler(
+            "broadcast", self.__scoped(self.__broadcast), pass_args=True))
+        self.__dispatcher.add_handler(CommandHandler(
+            "invite", self.__queued(self.__invite), pass_args=True))
+        self.__dispatcher.add_handler(CommandHandler(
+            "backup", self.__queued(self.__backup)))
+        # Redeem invite tokens before the bot's own start handler runs
+        self.__dispatcher.add_handler(CommandHandler(
+            "start", self.__queued(self.__redeem_invite), pass_args=True),
+                                      group=-1)
 
     @staticmethod
     @requires_usergroup("admin")
@@ -52,8 +152,14 @@ class AdminCommands(object):  # pylint: disable=too-few-public-methods
         message = """
 *Available Admin Commands*
 /users - Lists all registered users.
-/adduser - Adds a user to a group.
+/groups - Lists all groups and their number of users.
+/finduser - Finds users by the beginning of their name or id.
+/pending - Lists the unverified users and how long ago they were added.
+/adduser - Adds a user to a group, optionally for a time like 2d.
 /rmuser - Removes a user from a group.
+/broadcast - Sends a message to all users of a group.
+/invite - Creates a one-time invite link for a group.
+/backup - Saves a compressed backup of all users.
         """
 
         bot.sendMessage(chat_id=update.message.chat_id,
@@ -80,48 +186,271 @@ class AdminCommands(object):  # pylint: disable=too-few-public-methods
 
         for group, data in config.items():
             message += "*{0}*\n".format(group)
+            expires = data.get("expires") or {}
             if data.get("users"):
                 message += "  verified users:\n"
                 for user in data.get("users"):
-                    message += "    - {0} with id {1}\n" \
+                    message += "    - {0} with id {1}{2}\n" \
                             .format(user.get("username"),
-                                    user.get("id"))
+                                    user.get("id"),
+                                    AdminCommands.__until(
+                                        expires.get(user.get("username"))))
 
             if data.get("unverified"):
                 message += "  unverified users:\n"
                 for user in data.get("unverified"):
-                    message += "    - {0}\n".format(user)
+                    message += "    - {0}{1}\n".format(
+                        user, AdminCommands.__until(expires.get(user)))
+
+        bot.sendMessage(chat_id=update.message.chat_id,
+                        text=message,
+                        parse_mode=ParseMode.MARKDOWN)
+
+    @staticmethod
+    @requires_usergroup("admin")
+    def __get_groups(bot, update):
+        """Command handler function for `groups` command.
+
+            Sends the number of verified and unverified users
+            of every group and when it was last modified.
+
+            Args:
+                bot (telegram.Bot): The bot object.
+                update (telegram.Update): The sent update.
+        """
+        stats = UserManager().get_group_stats()
+        if not stats:
+            bot.sendMessage(chat_id=update.message.chat_id,
+                            text="No groups registered")
+            return
+
+        message = "*Groups*\n"
+        for group in stats:
+            if group["modified"] is None:
+                modified = ""
+            else:
+                modified = ", modified {0}".format(time.strftime(
+                    "%Y-%m-%d %H:%M", time.localtime(group["modified"])))
+            message += "  - {0}: {1} verified, {2} unverified{3}\n".format(
+                _escape_markdown(group["name"]), group["verified"],
+                group["unverified"],
+                modified)
+
+        bot.sendMessage(chat_id=update.message.chat_id,
+                        text=message,
+                        parse_mode=ParseMode.MARKDOWN)
+
+    @staticmethod
+    @requires_usergroup("admin")
+    def __find_user(bot, update, args):
+        """Command handler function for `finduser` command.
+
+            Sends the users whose name or id starts with
+            the given prefix and their groups.
+
+            Args:
+                bot (telegram.Bot): The bot object.
+                update (telegram.Update): The sent update.
+                args (list): The command's arguments.
+        """
+        if len(args) != 1:
+            message = "Usage: finduser <prefix>"
+            bot.sendMessage(chat_id=update.message.chat_id, text=message)
+            return
+
+        limit = 50
+        users = UserManager().find_users(args[0], limit=limit + 1)
+        if not users:
+            message = "No users found for '{0}'".format(args[0])
+            bot.sendMessage(chat_id=update.message.chat_id, text=message)
+            return
+
+        message = ""
+        for user in users[:limit]:
+            if user["id"] is None:
+                message += "{0} (unverified) in {1}\n".format(
+                    user["username"], user["group"])
+            else:
+                message += "{0} with id {1} in {2}\n".format(
+                    user["username"], user["id"], user["group"])
+        if len(users) > limit:
+            message += "Only the first {0} matches are shown.".format(limit)
+
+        bot.sendMessage(chat_id=update.message.chat_id, text=message)
+
+    @staticmethod
+    @requires_usergroup("admin")
+    def __get_pending(bot, update):
+        """Command handler function for `pending` command.
+
+            Sends a list of all unverified users and how long
+            ago they were added, the oldest first.
+
+            Args:
+                bot (telegram.Bot): The bot object.
+                update (telegram.Update): The sent update.
+        """
+        pending = UserManager().get_pending_users()
+        if not pending:
+            bot.sendMessage(chat_id=update.message.chat_id,
+                            text="No pending users")
+            return
+
+        now = time.time()
+        message = "*Pending users*\n"
+        for user in pending:
+            if user["invited"] is None:
+                age = "at an unknown time"
+            else:
+                age = "{0} ago".format(format_duration(now - user["invited"]))
+            message += "  - {0} in {1}, added {2}\n".format(
+                _escape_markdown(user["username"]),
+                _escape_markdown(user["group"]), age)
 
         bot.sendMessage(chat_id=update.message.chat_id,
                         text=message,
                         parse_mode=ParseMode.MARKDOWN)
 
+    @staticmethod
+    @requires_usergroup("admin")
+    def __invite(bot, update, args):
+        """Command handler function for `invite` command.
+
+            Creates a one-time invite token for a usergroup and sends
+            the deep link to redeem it. An optional duration like
+            `12h` overrides how long the token is valid.
+
+            Args:
+                bot (telegram.Bot): The bot object.
+                update (telegram.Update): The sent update.
+                args (list): The command's arguments.
+        """
+        usage = "Usage: invite <group> [duration]"
+        if len(args) not in (1, 2):
+            bot.sendMessage(chat_id=update.message.chat_id, text=usage)
+            return
+
+        group = args[0]
+        expires = None
+        if len(args) == 2:
+            try:
+                expires = time.time() + parse_duration(args[1])
+            except ValueError:
+                bot.sendMessage(chat_id=update.message.chat_id, text=usage)
+                return
+
+        usermanager = UserManager()
+        token = usermanager.create_invite(group, expires=expires)
+        if expires is None:
+            expires = time.time() + usermanager.INVITE_TTL
+
+        message = "Send this link to the user to add them to the group "\
+                "'{0}':\nhttps://t.me/{1}?start={2}\nIt can be used once"\
+                "{3}.".format(group, bot.username, token,
+                              AdminCommands.__until(expires))
+        bot.sendMessage(chat_id=update.message.chat_id, text=message)
+
+    @staticmethod
+    @requires_usergroup("admin")
+    def __backup(bot, update):
+        """Command handler function for `backup` command.
+
+            Saves a compressed backup of all users and sends
+            its name.
+
+            Args:
+                bot (telegram.Bot): The bot object.
+                update (telegram.Update): The sent update.
+        """
+        usermanager = UserManager()
+        try:
+            path = usermanager.backup()
+        except (IOError, OSError) as error:
+            message = "The backup failed: {0}".format(error)
+        else:
+            message = "Saved the backup '{0}'. {1} backups are kept in "\
+                    "'{2}'.".format(os.path.basename(path),
+                                    len(usermanager.get_backups()),
+                                    usermanager.backup_dir)
+        bot.sendMessage(chat_id=update.message.chat_id, text=message)
+
+    @staticmethod
+    def __redeem_invite(bot, update, args):
+        """Command handler function for the `start` command.
+
+            Adds the user to a usergroup if the command carries an
+            invite token. Other `start` commands are left to the
+            bot's own handlers.
+
+            Args:
+                bot (telegram.Bot): The bot object.
+                update (telegram.Update): The sent update.
+                args (list): The command's arguments.
+        """
+        if len(args) != 1 or \
+           not args[0].startswith(UserManager.INVITE_PREFIX):
+            return
+
+        user = update.message.from_user
+        group = UserManager().redeem_invite(args[0], user.id, user.name)
+        if group is None:
+            message = "This invite link is invalid or expired."
+        else:
+            message = "Hello {0}! You have been added to the '{1}' group."\
+                    .format(user.first_name, group)
+
+        bot.sendMessage(chat_id=update.message.chat_id, text=message)
+
+    @staticmethod
+    def __until(expires):
+        """Formats the expiry time of a membership.
+
+            Args:
+                expires (float): The unix timestamp or None.
+
+            Returns:
+                str: The formatted time or an empty string.
+        """
+        if expires is None:
+            return ""
+        return " until {0}".format(
+            time.strftime("%Y-%m-%d %H:%M", time.localtime(expires)))
+
     @staticmethod
     @requires_usergroup("admin")
     def __add_user(bot, update, args):
         """Command handler function for `adduser` command.
 
-            Adds a telegram user to a usergroup.
+            Adds a telegram user to a usergroup. An optional
+            duration like `30m`, `12h` or `2d` limits the membership.
 
             Args:
                 bot (telegram.Bot): The bot object.
                 update (telegram.Update): The sent update.
                 args (list): The command's arguments.
         """
-        if len(args) != 2:
-            message = "Usage: adduser <user> <group>"
-            bot.sendMessage(chat_id=update.message.chat_id, text=message)
+        usage = "Usage: adduser <user> <group> [duration]"
+        if len(args) not in (2, 3):
+            bot.sendMessage(chat_id=update.message.chat_id, text=usage)
             return
 
         username = args[0]
         group = args[1]
-        if not UserManager().add_user(username, group):
+        expires = None
+        if len(args) == 3:
+            try:
+                expires = time.time() + parse_duration(args[2])
+            except ValueError:
+                bot.sendMessage(chat_id=update.message.chat_id, text=usage)
+                return
+
+        if not UserManager().add_user(username, group, expires=expires):
             message = "The user '{0}' is already in the group '{1}'!" \
                     .format(username, group)
 
         else:
-            message = "Added user '{0}' to the group '{1}'." \
-                    .format(username, group)
+            message = "Added user '{0}' to the group '{1}'{2}." \
+                    .format(username, group, AdminCommands.__until(expires))
 
         bot.sendMessage(chat_id=update.message.chat_id, text=message)
 
@@ -152,3 +481,52 @@ class AdminCommands(object):  # pylint: disable=too-few-public-methods
                     .format(username, group)
 
         bot.sendMessage(chat_id=update.message.chat_id, text=message)
+
+    @requires_usergroup("admin")
+    def __broadcast(self, bot, update, args):
+        """Command handler function for `broadcast` command.
+
+            Sends a message to all verified users of a usergroup.
+            The messages are sent in the background and a delivery
+            summary is sent to the client when done.
+
+            Args:
+                bot (telegram.Bot): The bot object.
+                update (telegram.Update): The sent update.
+                args (list): The command's arguments.
+        """
+        reply_bot = QueuedBot(bot, self.__message_queue)
+        chat_id = update.message.chat_id
+        if len(args) < 2:
+            message = "Usage: broadcast <group> <text>"
+            reply_bot.sendMessage(chat_id=chat_id, text=message)
+            return
+
+        group = args[0]
+        # keep the text's original whitespace
+        text = update.message.text.split(None, 2)[2]
+        user_ids = [usr.get("id") for usr in UserManager().get_users(group)]
+        if not user_ids:
+            message = "There are no verified users in the group '{0}'!"\
+                    .format(group)
+            reply_bot.sendMessage(chat_id=chat_id, text=message)
+            return
+
+        message = "Sending the message to {0} users of the group '{1}'..."\
+                .format(len(user_ids), group)
+        reply_bot.sendMessage(chat_id=chat_id, text=message)
+
+        def send():
+            """Sends the broadcast and the delivery summary"""
+            result = self.__broadcaster.broadcast(bot, user_ids, text)
+            message = "Broadcast to the group '{0}' done: {1} of {2}"\
+                    " messages sent in {3:.0f}s.".format(
+                        group, result.sent, result.total, result.elapsed)
+            if result.failed:
+                message += " Failed to reach {0} users.".format(
+                    len(result.failed))
+            reply_bot.sendMessage(chat_id=chat_id, text=message)
+
+        thread = threading.Thread(target=send, name="ownbot-broadcast")
+        thread.daemon = True
+        thread.start()
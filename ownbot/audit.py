@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+    Provides an asynchronous audit log of authorization decisions.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+_AUDIT_LOG = None
+_AUDIT_LOCK = threading.Lock()
+
+DEFAULT_PATH = os.path.join(os.path.expanduser("~"), ".ownbot",
+                            "audit.jsonl")
+
+
+class AuditLog(object):
+    """Writes audit records as JSON lines from a background thread.
+
+        Records are put into a bounded in-memory buffer and never
+        wait for the file. If the buffer is full, new records are
+        dropped and counted. A background thread writes the buffered
+        records in batches and rotates the file once it exceeds
+        `max_bytes`.
+
+        Args:
+            path (str): The log file's path.
+            capacity (Optional[int]): The maximum number of buffered records.
+            batch_size (Optional[int]): The maximum number of records
+                written at once.
+            flush_interval (Optional[float]): Seconds between two writes.
+            max_bytes (Optional[int]): The size at which the file is
+                rotated. 0 disables rotation.
+            backup_count (Optional[int]): The number of rotated files kept.
+    """
+
+    def __init__(self, path, capacity=10000, batch_size=500,
+                 flush_interval=1.0, max_bytes=10 * 1024 * 1024,
+                 backup_count=5):
+        self.path = path
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.dropped = 0
+        self.written = 0
+        self.__buffer = deque()
+        self.__lock = threading.Lock()
+        self.__wakeup = threading.Event()
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__run,
+                                         name="ownbot-audit")
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def record(self, **fields):
+        """Buffers an audit record.
+
+            Args:
+                **fields: The record's fields. Must be serializable to JSON.
+
+            Returns:
+                bool: True if the record was buffered, False if it was
+                    dropped because the buffer is full.
+        """
+        fields.setdefault("time", time.time())
+        with self.__lock:
+            if len(self.__buffer) >= self.capacity:
+                self.dropped += 1
+                return False
+            self.__buffer.append(fields)
+            full_batch = len(self.__buffer) >= self.batch_size
+
+        if full_batch:
+            self.__wakeup.set()
+        return True
+
+    def __take_batch(self):
+        """
+            Removes up to `batch_size` records from the buffer.
+        """
+        with self.__lock:
+            count = min(self.batch_size, len(self.__buffer))
+            return [self.__buffer.popleft() for _ in range(count)]
+
+    def __rotate(self):
+        """
+            Rotates the log file like logging.handlers.RotatingFileHandler.
+        """
+        for index in range(self.backup_count - 1, 0, -1):
+            source = "{0}.{1}".format(self.path, index)
+            if os.path.exists(source):
+                target = "{0}.{1}".format(self.path, index + 1)
+                if os.path.exists(target):
+                    os.remove(target)
+                os.rename(source, target)
+
+        if self.backup_count:
+            target = self.path + ".1"
+            if os.path.exists(target):
+                os.remove(target)
+            os.rename(self.path, target)
+        else:
+            os.remove(self.path)
+
+    def flush(self):
+        """
+            Writes all buffered records to the file.
+        """
+        batch = self.__take_batch()
+        while batch:
+            lines = "".join(json.dumps(record, sort_keys=True) + "\n"
+                            for record in batch)
+            with open(self.path, "a") as log_file:
+                log_file.write(lines)
+                size = log_file.tell()
+            self.written += len(batch)
+
+            if self.max_bytes and size >= self.max_bytes:
+                self.__rotate()
+            batch = self.__take_batch()
+
+    def __run(self):
+        """
+            Writes the buffered records until the log is closed.
+        """
+        log = logging.getLogger(__name__)
+        while self.__running:
+            self.__wakeup.wait(self.flush_interval)
+            self.__wakeup.clear()
+            try:
+                self.flush()
+            except (IOError, OSError):
+                log.exception("Could not write the audit log '%s'", self.path)
+
+    def close(self, timeout=None):
+        """Stops the background thread and writes the remaining records.
+
+            Args:
+                timeout (Optional[float]): Seconds to wait for the thread.
+        """
+        self.__running = False
+        self.__wakeup.set()
+        self.__thread.join(timeout)
+        self.flush()
+
+
+def enable(path=DEFAULT_PATH, **kwargs):
+    """Enables the audit log of authorization decisions.
+
+        Args:
+            path (Optional[str]): The log file's path.
+            **kwargs: Further arguments for `AuditLog`.
+
+        Returns:
+            AuditLog: The enabled audit log.
+    """
+    global _AUDIT_LOG  # pylint: disable=global-statement
+    with _AUDIT_LOCK:
+        if _AUDIT_LOG is not None:
+            _AUDIT_LOG.close()
+        _AUDIT_LOG = AuditLog(path, **kwargs)
+        return _AUDIT_LOG
+
+
+def disable():
+    """
+        Disables the audit log and writes the remaining records.
+    """
+    global _AUDIT_LOG  # pylint: disable=global-statement
+    with _AUDIT_LOCK:
+        if _AUDIT_LOG is not None:
+            _AUDIT_LOG.close()
+        _AUDIT_LOG = None
+
+
+def get_audit_log():
+    """Returns the enabled audit log.
+
+        Returns:
+            AuditLog: The audit log or None if it is disabled.
+    """
+    return _AUDIT_LOG
@@ -2,60 +2,297 @@
 """
     Provides decorator functions for user authentication.
 """
+import inspect
 import logging
+import operator
 from telegram import Bot
+from ownbot import audit, profiling, recording, tracing
+from ownbot.cache import ResponseCache
+from ownbot.ratelimit import CLOCK, RateLimiter
 from ownbot.user import User
-from ownbot.usermanager import UserManager
+from ownbot.usermanager import UserManager, get_tenant, using_tenant
 
+# Rate limiters shared between functions with the same scope
+_LIMITERS = {}
 
-def requires_usergroup(*decorator_args):
+# The update attributes which may hold the sender, most frequent first
+_SOURCES = ("message", "callback_query", "edited_message", "inline_query",
+            "chosen_inline_result", "channel_post", "edited_channel_post")
+
+# inspect.getargspec was removed in python 3.11
+_GETARGSPEC = getattr(inspect, "getfullargspec", None) or \
+    getattr(inspect, "getargspec")
+
+
+def _bot_position(func):
+    """Returns the position of the bot in a handler's arguments.
+
+        The signature is inspected through the wrappers of other
+        decorators.
+
+        Args:
+            func (func): The command handler function.
+
+        Returns:
+            int: The position of the bot or None if the signature
+                doesn't tell.
+    """
+    while hasattr(func, "__wrapped__"):
+        func = func.__wrapped__
+
+    try:
+        names = list(_GETARGSPEC(func).args)
+    except TypeError:
+        return None
+    if inspect.ismethod(func) and func.__self__ is not None:
+        names = names[1:]
+
+    if "bot" in names:
+        return names.index("bot")
+    if names and names[0] in ("self", "cls"):
+        return 1
+    return 0 if len(names) >= 2 else None
+
+
+def _get_extractor(func):
+    """Returns a function which picks the bot and the update from
+        the positional arguments of a handler.
+
+        The handler's signature is inspected once when it is decorated.
+        If it doesn't tell, the arguments are checked on every call.
+
+        Args:
+            func (func): The command handler function.
+
+        Returns:
+            func: Returns the (bot, update) tuple of the arguments.
+    """
+    position = _bot_position(func)
+    if position is not None:
+        return operator.itemgetter(position, position + 1)
+
+    def extract(args):
+        # Set offset to 1 if first argument is not type of
+        # telegram.Bot (self passed).
+        offset = 0
+        if not isinstance(args[0], Bot):
+            offset = 1
+        return args[offset], args[1 + offset]
+
+    return extract
+
+
+def _wraps(func):
+    """
+        Works like functools.wraps but sets `__wrapped__` on python 2
+        as well.
+    """
+
+    def decorate(call):
+        for name in ("__module__", "__name__", "__doc__"):
+            if hasattr(func, name):
+                setattr(call, name, getattr(func, name))
+        call.__wrapped__ = func
+        return call
+
+    return decorate
+
+
+def _get_kind(update):
+    """
+        Returns the name of the update attribute which is set, e.g.
+        `message` or `callback_query`.
+    """
+    for name in _SOURCES:
+        if getattr(update, name, None) is not None:
+            return name
+    return None
+
+
+def _get_source(update):
+    """
+        Returns the message, query or result an update carries.
+    """
+    for name in _SOURCES:
+        source = getattr(update, name, None)
+        if source is not None:
+            return source
+    return None
+
+
+def _get_user(update):
+    """Returns the user who sent an update of any type.
+
+        Args:
+            update (telegram.Update): The sent update.
+
+        Returns:
+            telegram.User: The sender or None, e.g. for channel posts.
+    """
+    return getattr(_get_source(update), "from_user", None)
+
+
+def _get_text(update):
+    """
+        Returns the text, callback data or query of an update.
+    """
+    source = _get_source(update)
+    for name in ("text", "data", "query"):
+        text = getattr(source, name, None)
+        if text is not None:
+            return text
+    return None
+
+
+def _get_chat(update):
+    """
+        Returns the id of the chat an update was sent in or None for
+        inline queries and results.
+    """
+    source = _get_source(update)
+    message = getattr(source, "message", None) or source
+    return getattr(message, "chat_id", None)
+
+
+def _get_chat_id(update, user):
+    """
+        Returns the chat to reply to an update in. Inline queries
+        are answered in the private chat with the user.
+    """
+    chat_id = _get_chat(update)
+    return chat_id if chat_id is not None else user.id
+
+
+def _get_tenant(tenant, bot, update):
+    """Returns the tenant a handler call is checked against.
+
+        Args:
+            tenant (str or func): The tenant or a function which is
+                called with the bot and the update and returns it.
+            bot (telegram.Bot): The bot object.
+            update (telegram.Update): The sent update.
+
+        Returns:
+            str: The tenant or None for the default users.
+    """
+    if not callable(tenant):
+        return tenant
+    return tenant(bot, update)
+
+
+def requires_usergroup(*decorator_args, **options):
     """Checks if the user has access to the decorated function.
 
         Checks if the user who sent the message is in the given
         user group thus has access to the decorated function.
+        Works with messages, edited messages, callback and inline
+        queries. Updates without a sender are ignored. Users granted
+        the group within a chat only have access in that chat, see
+        `ownbot.usermanager.UserManager.grant_in_chat`.
 
         Args:
             group (str): The group's name.
+            tenant (Optional[str or func]): The tenant whose users are
+                checked or a function which is called with the bot and
+                the update and returns it. The decorated function runs
+                with this tenant, see `ownbot.usermanager.using_tenant`.
 
         Returns:
             func: The decorater function.
     """
+    tenant = options.pop("tenant", None)
+    if options:
+        raise TypeError("Unexpected keyword arguments: {0}"
+                        .format(", ".join(sorted(options))))
 
     def decorate(func):
+        extract = _get_extractor(func)
+
+        @_wraps(func)
         def call(*args, **kwargs):
+            bot, update = extract(args)
+            profiler = profiling.get_profiler()
+            if profiler is not None and profiler.should_sample():
+                return profiler.sample(getattr(func, "__name__", "handler"),
+                                       scoped, bot, update, args, kwargs)
+            return scoped(bot, update, args, kwargs)
+
+        def scoped(bot, update, args, kwargs):
+            if tenant is None:
+                return check(update, args, kwargs)
+            with using_tenant(_get_tenant(tenant, bot, update)):
+                return check(update, args, kwargs)
+
+        @tracing.traced("requires_usergroup")
+        def check(update, args, kwargs):
             log = logging.getLogger(__name__)
 
-            # Set offset to 1 if first argument is not type of
-            # telegram.Bot (self passed).
-            offset = 0
-            if not isinstance(args[0], Bot):
-                offset = 1
-            update = args[1 + offset]
+            sender = _get_user(update)
+            if sender is None:
+                log.debug("Ignored an update without a sender.")
+                return
+
+            profiler = profiling.get_profiler()
+            if profiler is not None:
+                profiler.start()
 
-            username = update.message.from_user.name
-            userid = update.message.from_user.id
-            message = update.message.text
+            start = CLOCK()
+            username = sender.name
+            userid = sender.id
+            message = _get_text(update)
+            command = message.split()[0] if message else None
             user = User(username, userid)
 
+            chat_id = _get_chat(update)
+
             has_access = False
             for group in decorator_args:
-                has_access = user.has_access(group) if not has_access else True
+                has_access = user.has_access(group, chat_id=chat_id) \
+                    if not has_access else True
+            authorized = CLOCK()
+            tracing.set_attribute("user_id", userid)
+            tracing.set_attribute("command", command)
+            tracing.set_attribute("decision",
+                                  "grant" if has_access else "deny")
 
-            if not has_access:
+            audit_log = audit.get_audit_log()
+            if audit_log is not None:
+                audit_log.record(
+                    user_id=userid,
+                    username=username,
+                    command=command,
+                    groups=list(decorator_args),
+                    decision="grant" if has_access else "deny",
+                    latency_ms=(authorized - start) * 1000)
+            elif not has_access:
                 log.warn("The user '{0}' with id '{1}' tried to"\
                          " execute the protected command '{2}'!"
                          .format(username, userid, message))
+
+            recorder = recording.get_recorder()
+            if recorder is not None:
+                recorder.record(_get_kind(update), userid, username, message,
+                                decorator_args, has_access, chat_id=chat_id)
+
+            if not has_access:
+                if profiler is not None:
+                    profiler.record(command, userid, authorized - start, 0.0)
                 return
 
             result = func(*args, **kwargs)
+            if profiler is not None:
+                profiler.record(command, userid, authorized - start,
+                                CLOCK() - authorized)
             return result
 
+        # Lets `memoized` detect that it was put above the check
+        call.usergroups = decorator_args
         return call
 
     return decorate
 
 
-def assign_first_to(group):
+def assign_first_to(group, tenant=None):
     """Checks if the user should be added to the given group.
 
         Adds the user who sent the command to the given group
@@ -63,34 +300,39 @@ def assign_first_to(group):
 
         Args:
             group (str): The group's name.
+            tenant (Optional[str or func]): The tenant to add the user
+                to, like in `requires_usergroup`.
 
         Returns:
             func: The decorater function.
     """
 
     def decorate(func):
+        extract = _get_extractor(func)
+
+        @_wraps(func)
         def call(*args, **kwargs):
-            offset = 0
-            # Set offset to 1 if first argument is not type of
-            # telegram.Bot.
-            if not isinstance(args[0], Bot):
-                offset = 1
-
-            bot = args[0 + offset]
-            update = args[1 + offset]
-
-            user = User(update.message.from_user.name,
-                        user_id=update.message.from_user.id,
-                        group=group, )
-            if UserManager().group_is_empty(group):
+            bot, update = extract(args)
+            if tenant is None:
+                return assign(bot, update, args, kwargs)
+            with using_tenant(_get_tenant(tenant, bot, update)):
+                return assign(bot, update, args, kwargs)
+
+        def assign(bot, update, args, kwargs):
+            sender = _get_user(update)
+            if sender is not None and UserManager().group_is_empty(group):
+                user = User(sender.name,
+                            user_id=sender.id,
+                            group=group, )
                 user.save()
                 message = "Hello {0}! "\
                         "You have been added to the '{1}' group."\
                         .format(
-                            update.message.from_user.first_name,
+                            sender.first_name,
                             group
                         )
-                bot.sendMessage(chat_id=update.message.chat_id, text=message)
+                bot.sendMessage(chat_id=_get_chat_id(update, sender),
+                                text=message)
 
             result = func(*args, **kwargs)
             return result
@@ -98,3 +340,185 @@ def assign_first_to(group):
         return call
 
     return decorate
+
+
+def rate_limited(rate, burst=None, scope=None, max_users=10000):
+    """Limits how often a user may execute the decorated function.
+
+        Every user gets a token bucket per scope. Requests which
+        find the bucket empty are dropped before any user or
+        storage lookup, so put this decorator above
+        `requires_usergroup`.
+
+        Args:
+            rate (float): Allowed calls per second and user.
+            burst (Optional[float]): Allowed calls in a burst.
+                Defaults to `rate` but at least 1.
+            scope (Optional[str]): Functions with the same scope share
+                a user's budget. The first decorator of a scope defines
+                its limits. By default every function has its own budget.
+            max_users (Optional[int]): Maximum number of tracked users.
+                The least recently seen users are forgotten first.
+
+        Returns:
+            func: The decorater function.
+    """
+    limiter = RateLimiter(rate, burst=burst, max_keys=max_users)
+    if scope is not None:
+        limiter = _LIMITERS.setdefault(scope, limiter)
+
+    def decorate(func):
+        extract = _get_extractor(func)
+
+        @_wraps(func)
+        def call(*args, **kwargs):
+            sender = _get_user(extract(args)[1])
+            userid = sender.id if sender is not None else None
+
+            if not limiter.allow(userid):
+                log = logging.getLogger(__name__)
+                log.debug("Dropped a request of the user with id '%s':"
+                          " rate limit exceeded.", userid)
+                return
+
+            result = func(*args, **kwargs)
+            return result
+
+        return call
+
+    return decorate
+
+
+class _RecordingBot(object):
+    """Passes calls on to a bot and records the messages sent to a chat.
+
+        Args:
+            bot (telegram.Bot): The bot.
+            chat_id (int): The chat whose messages are recorded.
+
+        Attributes:
+            sent (list): The (args, kwargs) of every recorded message
+                without the chat id.
+            cacheable (bool): False once anything but a message to the
+                chat was sent through the bot.
+    """
+
+    def __init__(self, bot, chat_id):
+        self.__bot = bot
+        self.__chat_id = chat_id
+        self.sent = []
+        self.cacheable = True
+
+    def sendMessage(self, *args, **kwargs):  # pylint: disable=invalid-name
+        """
+            Sends and records a message.
+        """
+        args = list(args)
+        chat_id = kwargs.pop("chat_id") if "chat_id" in kwargs \
+            else args.pop(0)
+        if chat_id == self.__chat_id:
+            self.sent.append((tuple(args), dict(kwargs)))
+        else:
+            self.cacheable = False
+        return self.__bot.sendMessage(chat_id, *args, **kwargs)
+
+    send_message = sendMessage
+
+    def __getattr__(self, name):
+        attr = getattr(self.__bot, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            self.cacheable = False
+            return attr(*args, **kwargs)
+
+        return call
+
+
+def _is_protected(func):
+    """
+        Checks if `requires_usergroup` is among the decorators of
+        a function.
+    """
+    while func is not None:
+        if getattr(func, "usergroups", None) is not None:
+            return True
+        func = getattr(func, "__wrapped__", None)
+    return False
+
+
+def memoized(ttl, max_size=1000, scope=None):
+    """Caches the messages the decorated function replies with.
+
+        The replies are cached by the command with its arguments and
+        the tenant. A cached reply is sent again to the chat of the
+        next update with the same command, without calling the
+        function. Concurrent updates with the same command call it once.
+
+        Only messages sent with `sendMessage` of the passed bot to the
+        update's chat are cached. If the function uses other methods of
+        the bot or sends to other chats, nothing is cached. Put this
+        decorator below `requires_usergroup`, so every update is
+        authorized before it gets a cached reply.
+
+        Args:
+            ttl (float): Seconds a reply is cached.
+            max_size (Optional[int]): The maximum number of cached
+                replies. The least recently used are dropped first.
+            scope (Optional[list]): Group names. Users who are members
+                of different groups among these get separate replies,
+                so content for one group never reaches another.
+                By default all authorized users share the replies.
+
+        Returns:
+            func: The decorater function.
+    """
+    scope = frozenset(scope or ())
+
+    def decorate(func):
+        if _is_protected(func):
+            raise TypeError("memoized must be put below requires_usergroup")
+
+        extract = _get_extractor(func)
+        cache = ResponseCache(ttl, max_size=max_size)
+
+        @_wraps(func)
+        def call(*args, **kwargs):
+            bot, update = extract(args)
+            sender = _get_user(update)
+            if sender is None:
+                return func(*args, **kwargs)
+
+            chat_id = _get_chat_id(update, sender)
+            groups = frozenset()
+            if scope:
+                groups = scope & UserManager().get_user_groups(
+                    sender.id, chat_id=_get_chat(update))
+            key = (get_tenant(), _get_text(update), groups)
+
+            def compute():
+                proxy = _RecordingBot(bot, chat_id)
+                result = func(*[proxy if arg is bot else arg for arg in args],
+                              **kwargs)
+                # A reply sent another way would be lost on a hit
+                cacheable = proxy.cacheable and \
+                    (proxy.sent or result is not None)
+                return (proxy.sent, result), cacheable
+
+            (sent, result), fresh = cache.get(key, compute)
+            tracing.set_attribute("cache_hit", not fresh)
+            if not fresh:
+                message_id = getattr(_get_source(update), "message_id", None)
+                for sent_args, sent_kwargs in sent:
+                    if "reply_to_message_id" in sent_kwargs:
+                        sent_kwargs = dict(sent_kwargs,
+                                           reply_to_message_id=message_id)
+                    bot.sendMessage(chat_id, *sent_args, **sent_kwargs)
+            return result
+
+        call.cache = cache
+        return call
+
+    return decorate
+
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+    Provides compressed backups of the user configuration.
+"""
+import gzip
+import os
+import re
+import tempfile
+import time
+
+import yaml
+
+from ownbot import compat, snapshot
+
+PREFIX = "users-"
+SUFFIX = ".yml.gz"
+_NAME_PATTERN = re.compile(r"^users-\d{8}-\d{6}-\d{6}\.yml\.gz$")
+
+_NUMBER_TYPES = (int, float)
+
+
+def _is_text(value):
+    """
+        Checks if a value is a string on python 2 and 3.
+    """
+    return isinstance(value, (type(u""), str))
+
+
+def validate(config):
+    """Checks that a configuration has the structure ownbot writes.
+
+        Args:
+            config (dict): The user configuration.
+
+        Raises:
+            ValueError: If the configuration is invalid.
+    """
+    if not isinstance(config, dict):
+        raise ValueError("The configuration is not a mapping")
+
+    for group, data in config.items():
+        if not _is_text(group):
+            raise ValueError("Invalid group name '{0}'".format(group))
+        if data is None:
+            continue
+        if not isinstance(data, dict):
+            raise ValueError("The group '{0}' is not a mapping".format(group))
+
+        unknown = set(data) - set([snapshot.VERIFIED, snapshot.UNVERIFIED,
+                                   snapshot.EXPIRES, snapshot.INVITED,
+                                   snapshot.INVITES, snapshot.MODIFIED,
+                                   snapshot.CHATS])
+        if unknown:
+            raise ValueError("Unknown keys in the group '{0}': {1}".format(
+                group, ", ".join(sorted(str(key) for key in unknown))))
+
+        for usr in data.get(snapshot.VERIFIED) or []:
+            if not isinstance(usr, dict) or \
+               not isinstance(usr.get("id"), (int, type(None))) or \
+               not _is_text(usr.get("username") or ""):
+                raise ValueError("Invalid user {0!r} in the group '{1}'"
+                                 .format(usr, group))
+        for username in data.get(snapshot.UNVERIFIED) or []:
+            if not _is_text(username):
+                raise ValueError("Invalid user {0!r} in the group '{1}'"
+                                 .format(username, group))
+        for key in (snapshot.EXPIRES, snapshot.INVITED, snapshot.INVITES):
+            times = data.get(key) or {}
+            if not isinstance(times, dict) or not all(
+                    isinstance(value, _NUMBER_TYPES)
+                    for value in times.values()):
+                raise ValueError("Invalid {0} in the group '{1}'".format(
+                    key, group))
+        chats = data.get(snapshot.CHATS) or {}
+        if not isinstance(chats, dict) or not all(
+                isinstance(chat_id, int) and isinstance(user_ids, list) and
+                all(isinstance(user_id, int) for user_id in user_ids)
+                for chat_id, user_ids in chats.items()):
+            raise ValueError("Invalid chat grants in the group '{0}'".format(
+                group))
+        if not isinstance(data.get(snapshot.MODIFIED) or 0, _NUMBER_TYPES):
+            raise ValueError("Invalid modification time in the group '{0}'"
+                             .format(group))
+
+
+def write(config, directory):
+    """Writes a compressed backup.
+
+        The backup is written to a temporary file first and renamed,
+        so a backup is either complete or missing.
+
+        Args:
+            config (dict): The user configuration.
+            directory (str): The directory of the backups.
+
+        Returns:
+            str: The backup's path.
+    """
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # another thread created it in the meantime
+            if not os.path.isdir(directory):
+                raise
+
+    now = time.time()
+    name = "{0}{1}-{2:06d}{3}".format(
+        PREFIX, time.strftime("%Y%m%d-%H%M%S", time.gmtime(now)),
+        int(now % 1 * 1000000), SUFFIX)
+    path = os.path.join(directory, name)
+
+    handle, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(handle, "wb") as raw_file:
+            with gzip.GzipFile(name, "wb", fileobj=raw_file) as backup_file:
+                backup_file.write(yaml.dump(config).encode("utf-8"))
+        compat.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    return path
+
+
+def read(path):
+    """Reads and validates a backup.
+
+        Args:
+            path (str): The backup's path. Uncompressed YAML files
+                are read as well.
+
+        Returns:
+            dict: The user configuration.
+
+        Raises:
+            ValueError: If the backup is not a valid configuration.
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    try:
+        with opener(path, "rb") as backup_file:
+            config = yaml.safe_load(backup_file.read().decode("utf-8")) or {}
+    except (IOError, OSError, yaml.YAMLError) as error:
+        # missing files and the like, as opposed to corrupt data
+        if getattr(error, "errno", None) is not None:
+            raise
+        raise ValueError("'{0}' is not a valid backup: {1}".format(
+            path, error))
+    validate(config)
+    return config
+
+
+def list_backups(directory):
+    """Lists the backups in a directory.
+
+        Args:
+            directory (str): The directory of the backups.
+
+        Returns:
+            list: The backups' paths, newest first.
+    """
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return []
+    return [os.path.join(directory, name)
+            for name in sorted(names, reverse=True)
+            if _NAME_PATTERN.match(name)]
+
+
+def rotate(directory, keep):
+    """Removes all but the newest backups.
+
+        Args:
+            directory (str): The directory of the backups.
+            keep (int): The number of backups to keep.
+
+        Returns:
+            list: The removed backups' paths.
+    """
+    removed = []
+    for path in list_backups(directory)[keep:]:
+        try:
+            os.remove(path)
+            removed.append(path)
+        except OSError:
+            # removed by another process
+            pass
+    return removed
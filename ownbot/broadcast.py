@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+    Provides concurrent, throttled message fan-out.
+"""
+import logging
+import threading
+import time
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, \
+    TelegramError
+
+from ownbot.ratelimit import CLOCK, TokenBucket
+
+
+class BroadcastResult(object):  # pylint: disable=too-few-public-methods
+    """The delivery summary of a broadcast.
+
+        Attributes:
+            sent (int): The number of delivered messages.
+            failed (list): The chat ids the message could not be sent to.
+            retries (int): The number of retried sends.
+            elapsed (float): The duration of the broadcast in seconds.
+    """
+
+    def __init__(self):
+        self.sent = 0
+        self.failed = []
+        self.retries = 0
+        self.elapsed = 0.0
+
+    @property
+    def total(self):
+        """
+            Returns the number of chats the message was sent to.
+        """
+        return self.sent + len(self.failed)
+
+
+class Broadcaster(object):
+    """Sends a message to many chats.
+
+        The messages are sent by a bounded pool of worker threads
+        which share a token bucket, so the overall rate stays below
+        `rate` messages per second however many workers are waiting
+        on Telegram. Network errors are retried with exponential
+        backoff and flood control errors after the requested delay.
+
+        Every message also takes a token from `bucket` if it is
+        given, so the broadcasts and the bot's other messages together
+        stay below Telegram's limit.
+
+        Args:
+            workers (Optional[int]): The number of sending threads.
+            rate (Optional[float]): Messages per second overall. Keep
+                some headroom below Telegram's limit of 30 for the
+                bot's other replies.
+            retries (Optional[int]): How often a failed send is retried.
+            backoff (Optional[float]): Seconds to wait before the first
+                retry. Doubled with every further retry.
+            sleep (Optional[func]): Sleeps the given number of seconds.
+            bucket (Optional[ownbot.ratelimit.TokenBucket]): A bucket
+                shared with the bot's other senders, e.g. the `bucket`
+                of a `MessageQueue`.
+    """
+
+    def __init__(self, workers=8, rate=25.0, retries=3, backoff=1.0,
+                 sleep=time.sleep, bucket=None):
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.__sleep = sleep
+        self.__bucket = TokenBucket(rate, sleep=sleep)
+        self.__shared_bucket = bucket
+
+    def __send(self, bot, chat_id, text, kwargs, result, lock):
+        """Sends a message to a chat, retrying transient failures.
+
+            Returns:
+                bool: True if the message was sent, otherwise False.
+        """
+        log = logging.getLogger(__name__)
+        error = None
+        for attempt in range(self.retries + 1):
+            self.__bucket.acquire()
+            if self.__shared_bucket is not None:
+                self.__shared_bucket.acquire()
+            try:
+                bot.sendMessage(chat_id=chat_id, text=text, **kwargs)
+                return True
+            except RetryAfter as err:
+                error, delay = err, err.retry_after
+            except BadRequest as err:
+                log.warning("Could not send broadcast to '%s': %s",
+                            chat_id, err)
+                return False
+            except NetworkError as err:
+                error, delay = err, self.backoff * 2 ** attempt
+            except TelegramError as err:
+                # e.g. the user blocked the bot
+                log.warning("Could not send broadcast to '%s': %s",
+                            chat_id, err)
+                return False
+
+            if attempt < self.retries:
+                with lock:
+                    result.retries += 1
+                self.__sleep(delay)
+
+        log.warning("Giving up sending broadcast to '%s': %s", chat_id,
+                    error)
+        return False
+
+    def broadcast(self, bot, chat_ids, text, **kwargs):
+        """Sends a message to all given chats.
+
+            Blocks until all messages are sent or failed.
+
+            Args:
+                bot (telegram.Bot): The bot to send the messages with.
+                chat_ids (list): The chats to send the message to.
+                text (str): The message.
+                **kwargs: Further arguments for `telegram.Bot.sendMessage`.
+
+            Returns:
+                BroadcastResult: The delivery summary.
+        """
+        result = BroadcastResult()
+        lock = threading.Lock()
+        pending = queue.Queue()
+        for chat_id in chat_ids:
+            pending.put(chat_id)
+
+        def work():
+            """Sends messages until no chats are left"""
+            while True:
+                try:
+                    chat_id = pending.get_nowait()
+                except queue.Empty:
+                    return
+
+                sent = self.__send(bot, chat_id, text, kwargs, result, lock)
+                with lock:
+                    if sent:
+                        result.sent += 1
+                    else:
+                        result.failed.append(chat_id)
+
+        start = CLOCK()
+        threads = [threading.Thread(target=work)
+                   for _ in range(min(self.workers, pending.qsize()))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        result.elapsed = CLOCK() - start
+        return result
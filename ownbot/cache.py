@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+    Provides a bounded cache with expiry and single-flight loading.
+"""
+import threading
+import weakref
+from collections import OrderedDict
+
+from ownbot.ratelimit import CLOCK
+
+# Every cache of the process, so `clear_all` can reach them
+_CACHES = weakref.WeakSet()
+_CACHES_LOCK = threading.Lock()
+
+
+def clear_all():
+    """
+        Removes the entries of all caches, e.g. after the users were restored.
+    """
+    with _CACHES_LOCK:
+        caches = list(_CACHES)
+    for cache in caches:
+        cache.clear()
+
+
+class _Flight(object):  # pylint: disable=too-few-public-methods
+    """
+        A computation other callers of the same key wait for.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.cached = False
+
+
+class ResponseCache(object):
+    """Keyed cache with a time to live and LRU eviction.
+
+        Entries are kept in least recently used order: when
+        `max_size` is exceeded the entry which was used the longest
+        time ago is dropped. Concurrent lookups of a missing key
+        compute the value once, the other callers wait for it.
+
+        Args:
+            ttl (float): Seconds an entry is valid.
+            max_size (Optional[int]): The maximum number of entries.
+            clock (Optional[func]): Returns the current time in seconds.
+
+        Attributes:
+            hits (int): The number of lookups served from the cache or
+                by waiting for another caller.
+            misses (int): The number of lookups which computed the value.
+    """
+
+    def __init__(self, ttl, max_size=1000, clock=CLOCK):
+        if ttl <= 0:
+            raise ValueError("ttl must be positive")
+
+        self.ttl = float(ttl)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.__clock = clock
+        self.__entries = OrderedDict()
+        self.__flights = {}
+        self.__generation = 0
+        self.__lock = threading.Lock()
+        with _CACHES_LOCK:
+            _CACHES.add(self)
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def get(self, key, compute):
+        """Returns the value of a key, computing it if necessary.
+
+            Args:
+                key (object): The entry's key.
+                compute (func): Called without arguments if the key is
+                    missing or expired. Returns the value and whether
+                    it may be cached.
+
+            Returns:
+                tuple: The value and True if it was computed by this
+                    call, False if it was cached or computed by a
+                    concurrent call.
+        """
+        with self.__lock:
+            entry = self.__entries.pop(key, None)
+            if entry is not None and entry[0] > self.__clock():
+                # re-insert to mark the entry as most recently used
+                self.__entries[key] = entry
+                self.hits += 1
+                return entry[1], False
+
+            flight = self.__flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.__flights[key] = _Flight()
+            generation = self.__generation
+
+        if not leader:
+            flight.done.wait()
+            if flight.cached:
+                with self.__lock:
+                    self.hits += 1
+                return flight.value, False
+            # The value must not be shared, so compute it again
+            return compute()[0], True
+
+        try:
+            value, cacheable = compute()
+        except Exception:
+            with self.__lock:
+                self.__flights.pop(key, None)
+            flight.done.set()
+            raise
+
+        with self.__lock:
+            self.misses += 1
+            # A value computed before `clear` may be outdated
+            cacheable = cacheable and generation == self.__generation
+            if cacheable:
+                self.__entries[key] = (self.__clock() + self.ttl, value)
+                while len(self.__entries) > self.max_size:
+                    self.__entries.popitem(last=False)
+            self.__flights.pop(key, None)
+        flight.value = value
+        flight.cached = cacheable
+        flight.done.set()
+        return value, True
+
+    def clear(self):
+        """
+            Removes all entries, e.g. after the content changed.
+        """
+        with self.__lock:
+            self.__entries.clear()
+            self.__generation += 1
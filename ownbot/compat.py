@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+"""
+    Provides the python 2 compatibility shims shared by ownbot's modules.
+"""
+import os
+
+# os.replace is not available on python 2
+replace = getattr(os, "replace", os.rename)  # pylint: disable=invalid-name
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+    Provides the scheduling of expiring group memberships.
+"""
+import heapq
+import logging
+import re
+import threading
+import time
+
+DURATION_UNITS = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60,
+                  "w": 7 * 24 * 60 * 60}
+_DURATION_PATTERN = re.compile(r"^(\d+)([smhdw])$")
+
+
+def parse_duration(text):
+    """Parses a duration like `30m`, `12h` or `2d`.
+
+        Args:
+            text (str): A positive number followed by one of the units
+                s, m, h, d or w.
+
+        Returns:
+            int: The duration in seconds.
+
+        Raises:
+            ValueError: If the text is not a valid duration.
+    """
+    match = _DURATION_PATTERN.match(text.strip().lower())
+    if not match or not int(match.group(1)):
+        raise ValueError("Invalid duration '{0}'".format(text))
+    return int(match.group(1)) * DURATION_UNITS[match.group(2)]
+
+
+def format_duration(seconds):
+    """Formats a duration in its largest whole unit, e.g. `3d`.
+
+        Args:
+            seconds (float): The duration in seconds.
+
+        Returns:
+            str: The formatted duration.
+    """
+    seconds = max(0, int(seconds))
+    for unit in ("w", "d", "h", "m"):
+        if seconds >= DURATION_UNITS[unit]:
+            return "{0}{1}".format(seconds // DURATION_UNITS[unit], unit)
+    return "{0}s".format(seconds)
+
+
+class ExpiryHeap(object):
+    """Thread-safe min-heap of membership expiry times.
+
+        Entries are never removed when a membership is removed or
+        changed. Whoever pops an entry has to check that it still
+        matches the configuration.
+
+        Invite tokens are scheduled like memberships, with the
+        token's hash in place of the username.
+    """
+
+    def __init__(self):
+        self.__heap = []
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__heap)
+
+    def push(self, expires, group, username):
+        """Schedules the expiry of a membership.
+
+            Args:
+                expires (float): The expiry time as unix timestamp.
+                group (str): The group's name.
+                username (str): The user's name.
+        """
+        with self.__lock:
+            heapq.heappush(self.__heap, (expires, group, username))
+
+    def rebuild(self, entries):
+        """Replaces all entries.
+
+            Args:
+                entries (iterable): The (expires, group, username) tuples.
+        """
+        heap = list(entries)
+        heapq.heapify(heap)
+        with self.__lock:
+            self.__heap = heap
+
+    def peek(self):
+        """Returns the earliest expiry time.
+
+            Returns:
+                float: The earliest expiry time or None if the heap
+                    is empty.
+        """
+        with self.__lock:
+            return self.__heap[0][0] if self.__heap else None
+
+    def pop_due(self, now):
+        """Removes all entries which expired.
+
+            Args:
+                now (float): The current time as unix timestamp.
+
+            Returns:
+                list: The expired (expires, group, username) tuples.
+        """
+        due = []
+        with self.__lock:
+            while self.__heap and self.__heap[0][0] <= now:
+                due.append(heapq.heappop(self.__heap))
+        return due
+
+
+class Sweeper(object):
+    """Runs a function in a background thread whenever it is due.
+
+        The thread is started by `notify` and stops as soon as
+        `next_run` returns None, so it only runs while there is
+        something to do. After `stop` it is never started again.
+
+        Args:
+            sweep (func): Is called with the current time when due.
+            next_run (func): Returns the time `sweep` is due next or
+                None if there is nothing to do.
+            clock (Optional[func]): Returns the current unix timestamp.
+            max_wait (Optional[float]): The maximum number of seconds
+                to sleep. Bounds the delay if the system clock is set.
+    """
+
+    def __init__(self, sweep, next_run, clock=time.time, max_wait=60.0):
+        self.max_wait = max_wait
+        self.__sweep = sweep
+        self.__next_run = next_run
+        self.__clock = clock
+        self.__thread = None
+        self.__stopped = False
+        self.__lock = threading.Lock()
+        self.__wakeup = threading.Event()
+
+    @property
+    def running(self):
+        """
+            Returns True if the background thread is running.
+        """
+        return self.__thread is not None
+
+    def notify(self):
+        """
+            Starts the background thread or makes it check `next_run`
+            again.
+        """
+        with self.__lock:
+            if self.__thread is None and not self.__stopped:
+                self.__thread = threading.Thread(target=self.__run,
+                                                 name="ownbot-sweeper")
+                self.__thread.daemon = True
+                self.__thread.start()
+        self.__wakeup.set()
+
+    def stop(self, timeout=None):
+        """Stops the background thread for good.
+
+            Args:
+                timeout (Optional[float]): Seconds to wait for a
+                    running sweep to finish.
+        """
+        with self.__lock:
+            self.__stopped = True
+            thread = self.__thread
+        self.__wakeup.set()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+
+    def __run(self):
+        """
+            Sweeps whenever due until there is nothing left to do.
+        """
+        log = logging.getLogger(__name__)
+        while True:
+            with self.__lock:
+                self.__wakeup.clear()
+                due = None if self.__stopped else self.__next_run()
+                if due is None:
+                    self.__thread = None
+                    return
+
+            now = self.__clock()
+            if due <= now:
+                try:
+                    self.__sweep(now)
+                except Exception:  # pylint: disable=broad-except
+                    log.exception("Sweeping the user configuration failed")
+                    self.__wakeup.wait(self.max_wait)
+                continue
+
+            self.__wakeup.wait(min(self.max_wait, due - now))
@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+"""
+    Provides a load generator for ownbot protected handlers.
+
+    Drives handlers decorated with `requires_usergroup` and the
+    `AdminCommands` with synthetic updates through a real dispatcher
+    and a fake bot, so nothing is sent over the network.
+
+    Run `python -m ownbot.loadtest --help` for the options.
+"""
+import argparse
+import logging
+import random
+import threading
+import time
+from datetime import datetime
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+from telegram import Bot, Chat, Message, Update
+from telegram import User as TelegramUser
+from telegram.ext import CommandHandler, Dispatcher
+
+from ownbot.admincommands import AdminCommands
+from ownbot.auth import requires_usergroup
+from ownbot.messagequeue import MessageQueue
+from ownbot.ratelimit import CLOCK
+from ownbot.usermanager import UserManager, temporary_store
+
+ADMIN_ID = 1
+
+
+class FakeBot(Bot):  # pylint: disable=too-many-public-methods
+    """Bot which counts messages instead of sending them.
+
+        Args:
+            latency (Optional[float]): Seconds a sent message takes.
+    """
+
+    def __init__(self, latency=0.0):  # pylint: disable=super-init-not-called
+        self.token = "0:fake"
+        self.latency = latency
+        self.sent = 0
+        self.__lock = threading.Lock()
+
+    def sendMessage(self, chat_id, text, **kwargs):  # pylint: disable=invalid-name, arguments-differ, unused-argument
+        """
+            Counts a message.
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        with self.__lock:
+            self.sent += 1
+
+    send_message = sendMessage
+
+
+def make_update(update_id, user_id, text):
+    """Returns a private chat text message update.
+
+        Args:
+            update_id (int): The update's and message's id.
+            user_id (int): The sender's id.
+            text (str): The message text.
+
+        Returns:
+            telegram.Update: The update.
+    """
+    name = "user{0}".format(user_id)
+    user = TelegramUser(user_id, name, username=name)
+    chat = Chat(user_id, "private")
+    message = Message(update_id, user, datetime.now(), chat, text=text)
+    return Update(update_id, message=message)
+
+
+class LoadReport(object):  # pylint: disable=too-few-public-methods
+    """The results of a load test.
+
+        Attributes:
+            updates (int): The number of processed updates.
+            elapsed (float): The duration of the test in seconds.
+            latencies (list): The sorted latencies in seconds.
+            granted (int): The number of authorized updates.
+            reads (int): The number of storage reads.
+            writes (int): The number of storage writes.
+            messages (int): The number of messages the bot sent.
+    """
+
+    def __init__(self, updates, elapsed, latencies, granted, storage,
+                 messages):
+        self.updates = updates
+        self.elapsed = elapsed
+        self.latencies = sorted(latencies)
+        self.granted = granted
+        self.reads = storage["reads"]
+        self.writes = storage["writes"]
+        self.messages = messages
+
+    @property
+    def throughput(self):
+        """
+            Returns the processed updates per second.
+        """
+        return self.updates / self.elapsed if self.elapsed else 0.0
+
+    def percentile(self, percent):
+        """Returns a latency percentile.
+
+            Args:
+                percent (float): The percentile, e.g. 99.
+
+            Returns:
+                float: The latency in seconds.
+        """
+        if not self.latencies:
+            return 0.0
+        index = int(round(percent / 100.0 * (len(self.latencies) - 1)))
+        return self.latencies[index]
+
+    def __str__(self):
+        lines = [
+            "updates:    {0} in {1:.2f}s ({2:.0f}/s)".format(
+                self.updates, self.elapsed, self.throughput),
+            "granted:    {0}, denied: {1}".format(
+                self.granted, self.updates - self.granted),
+        ]
+        lines.append("latency:    " + ", ".join(
+            "p{0}={1:.2f}ms".format(percent, self.percentile(percent) * 1000)
+            for percent in (50, 90, 99, 100)))
+        lines.append("storage:    {0} reads, {1} writes".format(
+            self.reads, self.writes))
+        lines.append("messages:   {0}".format(self.messages))
+        return "\n".join(lines)
+
+
+def populate(users, groups):
+    """Builds a user configuration.
+
+        The users get the ids 2 to `users` + 1 and are distributed
+        round robin over the groups `group0` to `group<groups - 1>`.
+        The user with the id 1 is in the `admin` group.
+
+        Args:
+            users (int): The number of users.
+            groups (int): The number of groups.
+
+        Returns:
+            dict: The user configuration.
+    """
+    config = {"admin": {UserManager.VERIFIED: [{"id": ADMIN_ID,
+                                                "username": "@admin"}]}}
+    for index in range(users):
+        user_id = index + 2
+        group = config.setdefault("group{0}".format(index % groups), {})
+        group.setdefault(UserManager.VERIFIED, []).append({
+            "id": user_id,
+            "username": "@user{0}".format(user_id)
+        })
+    return config
+
+
+def run(users=1000, groups=10, updates=5000, rate=0.0, workers=4,
+        unauthorized=0.1, write_ratio=0.0, latency=0.0, seed=None):
+    """Runs a load test.
+
+        Every update is sent by a random user. Known users invoke
+        the command of their own group, unauthorized updates come
+        from unknown users. The test works on a temporary user store,
+        see `ownbot.usermanager.temporary_store`.
+
+        Args:
+            users (Optional[int]): The number of known users.
+            groups (Optional[int]): The number of groups.
+            updates (Optional[int]): The number of updates to send.
+            rate (Optional[float]): Updates per second. 0 sends the
+                updates as fast as the workers take them. With a rate
+                the latency is measured from the time an update is due
+                and includes the time it waits for a worker.
+            workers (Optional[int]): The number of dispatching threads.
+            unauthorized (Optional[float]): The fraction of updates
+                sent by unknown users.
+            write_ratio (Optional[float]): The fraction of updates which
+                are `/adduser` commands of the admin.
+            latency (Optional[float]): Seconds a sent message takes.
+            seed (Optional[int]): Seeds the random traffic.
+
+        Returns:
+            LoadReport: The results.
+    """
+    rand = random.Random(seed)
+    with temporary_store() as tenant:
+        usermanager = UserManager(tenant)
+        usermanager.config = populate(users, groups)
+
+        bot = FakeBot(latency=latency)
+        dispatcher = Dispatcher(bot, queue.Queue(), workers=workers)
+        message_queue = MessageQueue(per_chat_rate=1e6, global_rate=1e6)
+        AdminCommands(dispatcher, message_queue=message_queue, tenant=tenant)
+
+        granted = []
+
+        def handler(bot, update):
+            """Replies to an authorized update"""
+            granted.append(True)
+            bot.sendMessage(chat_id=update.message.chat_id, text="ok")
+
+        for index in range(groups):
+            group = "group{0}".format(index)
+            dispatcher.add_handler(CommandHandler(
+                "cmd{0}".format(index),
+                requires_usergroup(group, tenant=tenant)(handler)))
+
+        # At maximum speed a short queue keeps the backlog bounded.
+        pending = queue.Queue(maxsize=0 if rate else workers * 2)
+        latencies = []
+
+        def work():
+            """Dispatches updates until None is received"""
+            while True:
+                item = pending.get()
+                if item is None:
+                    return
+                update, scheduled = item
+                if scheduled is None:
+                    scheduled = CLOCK()
+                dispatcher.process_update(update)
+                latencies.append(CLOCK() - scheduled)
+
+        threads = [threading.Thread(target=work) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+
+        storage_before = usermanager.storage_stats
+        start = CLOCK()
+        for update_id in range(updates):
+            scheduled = None
+            if rate:
+                scheduled = start + update_id / rate
+                delay = scheduled - CLOCK()
+                if delay > 0:
+                    time.sleep(delay)
+
+            draw = rand.random()
+            if draw < write_ratio:
+                text = "/adduser @new{0} group{1}".format(
+                    update_id, rand.randrange(groups))
+                user_id = ADMIN_ID
+            elif draw < write_ratio + unauthorized:
+                user_id = users + 2 + rand.randrange(max(users, 1))
+                text = "/cmd{0}".format(rand.randrange(groups))
+            else:
+                user_id = 2 + rand.randrange(users)
+                text = "/cmd{0}".format((user_id - 2) % groups)
+            pending.put((make_update(update_id, user_id, text), scheduled))
+
+        for _ in threads:
+            pending.put(None)
+        for thread in threads:
+            thread.join()
+        elapsed = CLOCK() - start
+        message_queue.stop()
+
+        storage_after = usermanager.storage_stats
+        storage = dict((key, storage_after[key] - storage_before[key])
+                       for key in storage_after)
+        return LoadReport(updates, elapsed, latencies, len(granted),
+                          storage, bot.sent)
+
+
+def main(argv=None):
+    """
+        Runs a load test from the command line.
+    """
+    parser = argparse.ArgumentParser(
+        description="Drives ownbot protected handlers with synthetic "
+        "updates.")
+    parser.add_argument("--users", type=int, default=1000,
+                        help="number of known users")
+    parser.add_argument("--groups", type=int, default=10,
+                        help="number of groups")
+    parser.add_argument("--updates", type=int, default=5000,
+                        help="number of updates to send")
+    parser.add_argument("--rate", type=float, default=0.0,
+                        help="updates per second, 0 for maximum speed")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="number of dispatching threads")
+    parser.add_argument("--unauthorized", type=float, default=0.1,
+                        help="fraction of updates from unknown users")
+    parser.add_argument("--write-ratio", type=float, default=0.0,
+                        help="fraction of /adduser commands")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds a sent message takes")
+    parser.add_argument("--seed", type=int, help="random seed")
+    args = parser.parse_args(argv)
+
+    # every denied update would be logged as a warning
+    logging.basicConfig(level=logging.ERROR)
+
+    report = run(users=args.users, groups=args.groups, updates=args.updates,
+                 rate=args.rate, workers=args.workers,
+                 unauthorized=args.unauthorized,
+                 write_ratio=args.write_ratio, latency=args.latency,
+                 seed=args.seed)
+    print(report)
+
+
+if __name__ == "__main__":
+    main()
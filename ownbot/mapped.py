@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+"""
+    Provides a compact binary snapshot of the user configuration
+    which is read through mmap.
+
+    Processes which map the same file share its pages, so forked
+    workers don't need their own parsed copy of the users and open
+    the snapshot in O(1).
+
+    File layout (little endian):
+        header: magic, number of groups, ids and names, the offsets
+            of the id and name tables
+        groups: (string offset, length) per group, sorted by name
+        ids: (user id, group, expiry time) per verified user,
+            sorted by id and group
+        names: (string offset, length, group, verified, expiry time)
+            per user, sorted by name and group
+        strings: the UTF-8 encoded group and user names
+
+    An expiry time of 0 means the membership never expires.
+"""
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+from ownbot import compat, snapshot
+from ownbot.ratelimit import CLOCK
+
+MAGIC = b"OWNBOT\x00\x01"
+HEADER = struct.Struct("<8sIIIII")
+GROUP = struct.Struct("<II")
+ID = struct.Struct("<qId")
+NAME = struct.Struct("<IIIId")
+
+
+def export(config, path):
+    """Writes the binary snapshot of a user configuration.
+
+        The file is written to a temporary file first and renamed,
+        so readers always see a complete snapshot.
+
+        Args:
+            config (dict): The user configuration.
+            path (str): The snapshot's path.
+    """
+    groups = sorted(config)
+    ids = []
+    names = []
+    for index, group in enumerate(groups):
+        data = config[group] or {}
+        expires = data.get(snapshot.EXPIRES) or {}
+        for usr in data.get(snapshot.VERIFIED) or []:
+            username = usr.get("username")
+            expiry = float(expires.get(username) or 0)
+            if isinstance(usr.get("id"), int):
+                ids.append((usr["id"], index, expiry))
+            if username:
+                names.append((username.encode("utf-8"), index, 1, expiry))
+        for username in data.get(snapshot.UNVERIFIED) or []:
+            if username:
+                names.append((username.encode("utf-8"), index, 0,
+                              float(expires.get(username) or 0)))
+    ids.sort()
+    names.sort()
+
+    ids_offset = HEADER.size + GROUP.size * len(groups)
+    names_offset = ids_offset + ID.size * len(ids)
+    strings_offset = names_offset + NAME.size * len(names)
+
+    strings = []
+    positions = {}
+    size = [strings_offset]
+
+    def add_string(value):
+        """Returns the offset and length of a deduplicated string"""
+        if value not in positions:
+            positions[value] = size[0]
+            strings.append(value)
+            size[0] += len(value)
+        return positions[value], len(value)
+
+    parts = [HEADER.pack(MAGIC, len(groups), len(ids), len(names),
+                         ids_offset, names_offset)]
+    for group in groups:
+        parts.append(GROUP.pack(*add_string(group.encode("utf-8"))))
+    for entry in ids:
+        parts.append(ID.pack(*entry))
+    for name, index, verified, expiry in names:
+        offset, length = add_string(name)
+        parts.append(NAME.pack(offset, length, index, verified, expiry))
+    parts.extend(strings)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(handle, "wb") as snapshot_file:
+            snapshot_file.write(b"".join(parts))
+        compat.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+class _Table(object):  # pylint: disable=too-few-public-methods
+    """
+        A mapped snapshot file.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as snapshot_file:
+            stat = os.fstat(snapshot_file.fileno())
+            self.stamp = stat.st_ino, stat.st_mtime, stat.st_size
+            self.data = mmap.mmap(snapshot_file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+
+        magic, groups, self.ids, self.names, self.ids_offset, \
+            self.names_offset = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise ValueError("'{0}' is not an ownbot snapshot".format(path))
+
+        self.groups = {}
+        for index in range(groups):
+            offset, length = GROUP.unpack_from(
+                self.data, HEADER.size + index * GROUP.size)
+            name = self.data[offset:offset + length].decode("utf-8")
+            self.groups[name] = index
+
+    def find_id(self, user_id, group):
+        """
+            Returns the expiry time of a verified user or None.
+        """
+        low, high = 0, self.ids
+        while low < high:
+            middle = (low + high) // 2
+            entry = ID.unpack_from(self.data,
+                                   self.ids_offset + middle * ID.size)
+            if (entry[0], entry[1]) < (user_id, group):
+                low = middle + 1
+            else:
+                high = middle
+
+        if low < self.ids:
+            entry = ID.unpack_from(self.data, self.ids_offset + low * ID.size)
+            if entry[0] == user_id and entry[1] == group:
+                return entry[2]
+        return None
+
+    def find_name(self, username, group):
+        """
+            Returns the verified flag and expiry time of a user or None.
+        """
+        key = (username.encode("utf-8"), group)
+        low, high = 0, self.names
+        while low < high:
+            middle = (low + high) // 2
+            entry = NAME.unpack_from(self.data,
+                                     self.names_offset + middle * NAME.size)
+            name = self.data[entry[0]:entry[0] + entry[1]]
+            if (name, entry[2]) < key:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low < self.names:
+            entry = NAME.unpack_from(self.data,
+                                     self.names_offset + low * NAME.size)
+            if (self.data[entry[0]:entry[0] + entry[1]], entry[2]) == key:
+                return entry[3], entry[4]
+        return None
+
+
+def _active(expiry):
+    """
+        Checks if a membership with the given expiry time is active.
+    """
+    return not expiry or expiry > time.time()
+
+
+class MappedSnapshot(object):
+    """Read-only view of a binary snapshot written by `export`.
+
+        Lookups do a binary search directly on the mapped file. The
+        file is checked for a new snapshot at most every
+        `check_interval` seconds and mapped again if it was replaced.
+
+        Args:
+            path (str): The snapshot's path.
+            check_interval (Optional[float]): Seconds between two checks
+                for a new snapshot. None never checks.
+    """
+
+    def __init__(self, path, check_interval=1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self.__table = _Table(path)
+        self.__checked = CLOCK()
+
+    def __get_table(self):
+        """
+            Returns the current table, mapping a new snapshot if
+            the file was replaced.
+        """
+        if self.check_interval is not None and \
+           CLOCK() - self.__checked >= self.check_interval:
+            self.__checked = CLOCK()
+            self.refresh()
+        return self.__table
+
+    def refresh(self):
+        """Maps the snapshot again if the file was replaced.
+
+            Returns:
+                bool: True if a new snapshot was mapped, otherwise False.
+        """
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+
+        if (stat.st_ino, stat.st_mtime, stat.st_size) == self.__table.stamp:
+            return False
+
+        # The old mapping is closed once no lookup uses it anymore
+        self.__table = _Table(self.path)
+        return True
+
+    @property
+    def groups(self):
+        """
+            Returns the names of all groups.
+        """
+        return sorted(self.__get_table().groups)
+
+    def userid_is_verified_in_group(self, group, user_id):
+        """Checks if a user id is verified in a group.
+
+            Args:
+                group (str): The group to look for the user.
+                user_id (int): The user's unique id.
+
+            Returns:
+                bool: True if the user was found in the
+                    given group as verified, otherwise False.
+        """
+        table = self.__get_table()
+        index = table.groups.get(group)
+        if index is None:
+            return False
+        expiry = table.find_id(user_id, index)
+        return expiry is not None and _active(expiry)
+
+    def __find_name(self, group, username):
+        """
+            Returns the verified flag of an active user or None.
+        """
+        table = self.__get_table()
+        index = table.groups.get(group)
+        if index is None or username is None:
+            return None
+        found = table.find_name(username, index)
+        if found is None or not _active(found[1]):
+            return None
+        return found[0]
+
+    def username_is_verified_in_group(self, group, username):
+        """Checks if a username is verified in a group.
+
+            Args:
+                group (str): The group to look for the user.
+                username (str): The user's name.
+
+            Returns:
+                bool: True if the user was found in the
+                    given group as verified, otherwise False.
+        """
+        return self.__find_name(group, username) == 1
+
+    def user_is_unverified_in_group(self, group, username):
+        """Checks if a username is unverified in a group.
+
+            Args:
+                group (str): The group to look for the user.
+                username (str): The user's name.
+
+            Returns:
+                bool: True if the user was found in the
+                    given group as unverified, otherwise False.
+        """
+        return self.__find_name(group, username) == 0
+
+    def user_is_in_group(self, group, user_id=None, username=None):
+        """Checks if a user is in a group.
+
+            Works like `UserManager.user_is_in_group`.
+
+            Args:
+                group (str): The group to look for the user.
+                user_id (Optional[int]): The user's unique id.
+                username (Optional[str]): The user's name.
+
+            Returns:
+                bool: True if the user was found in the
+                    given group, otherwise False.
+        """
+        if user_id:
+            return self.userid_is_verified_in_group(group, user_id)
+        return self.__find_name(group, username) is not None
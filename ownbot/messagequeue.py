@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+    Provides a rate-limited outbound message queue.
+"""
+import heapq
+import itertools
+import logging
+import threading
+from collections import deque
+
+from telegram import Bot
+
+from ownbot.ratelimit import CLOCK, TokenBucket
+
+# Telegram rejects longer messages
+MAX_MESSAGE_LENGTH = 4096
+
+
+def split_text(text, limit=MAX_MESSAGE_LENGTH):
+    """Splits a text into chunks Telegram accepts.
+
+        Splits at line breaks where possible so that line based
+        markdown formatting stays intact.
+
+        Args:
+            text (str): The text to split.
+            limit (Optional[int]): The maximum length of a chunk.
+
+        Returns:
+            list: The chunks of the text.
+    """
+    chunks = []
+    current = ""
+    for line in text.splitlines(True):
+        while len(line) > limit:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(line[:limit])
+            line = line[limit:]
+
+        if len(current) + len(line) > limit:
+            chunks.append(current)
+            current = ""
+        current += line
+
+    if current or not chunks:
+        chunks.append(current)
+    return chunks
+
+
+class MessageQueue(object):
+    """Sends messages from a background thread.
+
+        Messages are sent in order per chat. Two messages to the same
+        chat are at least 1 / `per_chat_rate` seconds apart and no two
+        messages at all are closer than 1 / `global_rate` seconds.
+        Chats are served in the order they become ready so one busy
+        chat doesn't hold back the others.
+
+        The global rate is kept with `bucket`. Pass it to other senders
+        of the same bot, e.g. a `Broadcaster`, so all of them together
+        keep to the rate.
+
+        The worker thread is started with the first message.
+
+        Args:
+            per_chat_rate (Optional[float]): Messages per second to a
+                single chat.
+            global_rate (Optional[float]): Messages per second overall.
+            clock (Optional[func]): Returns the current time in seconds.
+    """
+
+    def __init__(self, per_chat_rate=1.0, global_rate=30.0, clock=CLOCK):
+        self.__chat_interval = 1.0 / per_chat_rate
+        self.__global_interval = 1.0 / global_rate
+        self.__clock = clock
+        self.__bucket = TokenBucket(global_rate, clock=clock)
+        self.__cond = threading.Condition(threading.Lock())
+        self.__pending = {}
+        self.__ready = []
+        self.__last_sent = {}
+        self.__counter = itertools.count()
+        self.__thread = None
+        self.__running = False
+        self.sent = 0
+        self.failed = 0
+
+    @property
+    def bucket(self):
+        """
+            Returns the token bucket every message takes a token from.
+        """
+        return self.__bucket
+
+    def __len__(self):
+        with self.__cond:
+            return sum(len(items) for items in self.__pending.values())
+
+    def enqueue(self, chat, func, *args, **kwargs):
+        """Queues a call which sends a message to a chat.
+
+            Args:
+                chat (int): The id of the chat the message is sent to.
+                func (func): Sends the message, e.g. `bot.sendMessage`.
+                *args: Positional arguments for `func`.
+                **kwargs: Keyword arguments for `func`.
+        """
+        with self.__cond:
+            items = self.__pending.get(chat)
+            if items is None:
+                items = self.__pending[chat] = deque()
+                ready = self.__last_sent.get(chat, 0.0) + \
+                    self.__chat_interval
+                heapq.heappush(self.__ready,
+                               (ready, next(self.__counter), chat))
+            items.append((func, args, kwargs))
+
+            if self.__thread is None:
+                self.__start()
+            self.__cond.notify()
+
+    def __start(self):
+        """
+            Starts the worker thread. Must be called holding the lock.
+        """
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__run,
+                                         name="ownbot-messagequeue")
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self, timeout=None):
+        """Stops the worker thread once all queued messages are sent.
+
+            Args:
+                timeout (Optional[float]): Seconds to wait for the
+                    worker thread.
+        """
+        with self.__cond:
+            thread = self.__thread
+            self.__running = False
+            self.__cond.notify()
+
+        if thread is None:
+            return
+
+        thread.join(timeout)
+        with self.__cond:
+            if self.__thread is thread and not thread.is_alive():
+                self.__thread = None
+
+    def __next(self):
+        """Waits for the next message which may be sent.
+
+            Returns:
+                tuple: The message's chat id, function and arguments
+                    or None if the queue was stopped and is empty.
+        """
+        with self.__cond:
+            while True:
+                if not self.__ready:
+                    if not self.__running:
+                        return None
+                    self.__cond.wait()
+                    continue
+
+                ready, _, chat_id = self.__ready[0]
+                now = self.__clock()
+                if ready > now:
+                    self.__cond.wait(ready - now)
+                    continue
+                if not self.__bucket.consume():
+                    # Other senders may have taken the tokens
+                    self.__cond.wait(self.__global_interval)
+                    continue
+
+                heapq.heappop(self.__ready)
+                items = self.__pending[chat_id]
+                item = items.popleft()
+                self.__last_sent[chat_id] = now
+                if items:
+                    heapq.heappush(self.__ready,
+                                   (now + self.__chat_interval,
+                                    next(self.__counter), chat_id))
+                else:
+                    del self.__pending[chat_id]
+                self.__forget_idle_chats(now)
+                return (chat_id, ) + item
+
+    def __forget_idle_chats(self, now):
+        """
+            Drops send times which can't delay a message anymore.
+        """
+        if len(self.__last_sent) < 1024:
+            return
+        for chat_id, sent in list(self.__last_sent.items()):
+            if sent + self.__chat_interval <= now:
+                del self.__last_sent[chat_id]
+
+    def __run(self):
+        """
+            Sends the queued messages.
+        """
+        log = logging.getLogger(__name__)
+        while True:
+            item = self.__next()
+            if item is None:
+                return
+
+            chat_id, func, args, kwargs = item
+            try:
+                func(*args, **kwargs)
+                self.sent += 1
+            except Exception:  # pylint: disable=broad-except
+                self.failed += 1
+                log.exception("Could not send a message to the chat '%s'",
+                              chat_id)
+
+
+class QueuedBot(Bot):  # pylint: disable=too-many-public-methods
+    """Bot which sends its messages through a MessageQueue.
+
+        All other attributes are looked up on the wrapped bot.
+
+        Args:
+            bot (telegram.Bot): The bot to send the messages with.
+            queue (MessageQueue): The queue to send the messages through.
+    """
+
+    OWN_ATTRIBUTES = frozenset(["sendMessage", "send_message",
+                                "_QueuedBot__bot", "_QueuedBot__queue"])
+
+    def __init__(self, bot, queue):  # pylint: disable=super-init-not-called
+        self.__bot = bot
+        self.__queue = queue
+
+    def __getattribute__(self, name):
+        # Methods defined on telegram.Bot must be those of the wrapped bot.
+        if name in QueuedBot.OWN_ATTRIBUTES or name.startswith("__"):
+            return object.__getattribute__(self, name)
+        return getattr(object.__getattribute__(self, "_QueuedBot__bot"), name)
+
+    def sendMessage(self, chat_id, text, **kwargs):  # pylint: disable=invalid-name, arguments-differ
+        """Queues a text message.
+
+            Messages longer than Telegram allows are split.
+
+            Args:
+                chat_id (int): The chat to send the message to.
+                text (str): The message.
+                **kwargs: Further arguments for `telegram.Bot.sendMessage`.
+        """
+        for chunk in split_text(text):
+            self.__queue.enqueue(chat_id, self.__bot.sendMessage,
+                                 chat_id=chat_id, text=chunk, **kwargs)
+
+    send_message = sendMessage
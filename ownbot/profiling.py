@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+    Provides opt-in profiling of protected handlers.
+"""
+import cProfile
+import logging
+import os
+import random
+import threading
+import time
+
+_PROFILER = None
+_PROFILER_LOCK = threading.Lock()
+
+# The storage time of the current thread's request
+_LOCAL = threading.local()
+
+DEFAULT_DIRECTORY = os.path.join(os.path.expanduser("~"), ".ownbot",
+                                 "profiles")
+
+
+class Profiler(object):
+    """Times the phases of protected handler calls.
+
+        Requests slower than `threshold` are logged with the time
+        spent on the authorization, the storage reads and writes
+        and the handler itself. A fraction of the requests is run
+        under cProfile and dumped to a pstats file in `directory`.
+
+        Args:
+            threshold (Optional[float]): Seconds above which a request
+                is logged. None logs no requests.
+            sample_rate (Optional[float]): The fraction of requests
+                which are profiled.
+            directory (Optional[str]): Where the pstats files are written.
+            max_samples (Optional[int]): The maximum number of pstats
+                files written. None writes any number.
+    """
+
+    def __init__(self, threshold=0.5, sample_rate=0.0,
+                 directory=DEFAULT_DIRECTORY, max_samples=100):
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.directory = directory
+        self.max_samples = max_samples
+        self.slow = 0
+        self.samples = 0
+        self.__lock = threading.Lock()
+        self.__random = random.Random()
+
+    def start(self):
+        """
+            Starts timing a request of the current thread.
+        """
+        _LOCAL.storage = 0.0
+
+    def record(self, command, user_id, auth, handler):
+        """Logs a request if it was slow.
+
+            Args:
+                command (str): The executed command.
+                user_id (int): The sender's id.
+                auth (float): Seconds the authorization took.
+                handler (float): Seconds the handler took.
+
+            Returns:
+                bool: True if the request was logged, otherwise False.
+        """
+        total = auth + handler
+        if self.threshold is None or total < self.threshold:
+            return False
+
+        with self.__lock:
+            self.slow += 1
+        storage = getattr(_LOCAL, "storage", 0.0)
+        logging.getLogger(__name__).warning(
+            "Slow request '%s' of the user with id '%s': %.1fms"
+            " (auth %.1fms, storage %.1fms, handler %.1fms)",
+            command, user_id, total * 1000, auth * 1000, storage * 1000,
+            handler * 1000)
+        return True
+
+    def should_sample(self):
+        """Decides if a request is profiled.
+
+            Returns:
+                bool: True if the request should be run by `sample`.
+        """
+        if not self.sample_rate or getattr(_LOCAL, "sampling", False):
+            return False
+        with self.__lock:
+            if self.max_samples is not None and \
+               self.samples >= self.max_samples:
+                return False
+            return self.__random.random() < self.sample_rate
+
+    def sample(self, name, func, *args, **kwargs):
+        """Runs a function under cProfile and dumps the statistics.
+
+            Args:
+                name (str): Is used in the file name, e.g. the
+                    handler's name.
+                func (func): The function to profile.
+                *args: The function's positional arguments.
+                **kwargs: The function's keyword arguments.
+
+            Returns:
+                The function's result.
+        """
+        profile = cProfile.Profile()
+        _LOCAL.sampling = True
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            _LOCAL.sampling = False
+            with self.__lock:
+                self.samples += 1
+                number = self.samples
+            self.__dump(profile, name, number)
+
+    def __dump(self, profile, name, number):
+        """
+            Writes the statistics of a profiled request.
+        """
+        path = os.path.join(self.directory, "{0}-{1}-{2}-{3}.pstats".format(
+            name, int(time.time() * 1000), os.getpid(), number))
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            profile.dump_stats(path)
+        except (IOError, OSError):
+            logging.getLogger(__name__).exception(
+                "Could not write the profile '%s'", path)
+
+
+def add_storage_time(seconds):
+    """Adds the time of a storage read or write to the current request.
+
+        Args:
+            seconds (float): The time the read or write took.
+    """
+    if _PROFILER is not None:
+        _LOCAL.storage = getattr(_LOCAL, "storage", 0.0) + seconds
+
+
+def enable(**kwargs):
+    """Enables the profiling of protected handlers.
+
+        Args:
+            **kwargs: The arguments for `Profiler`.
+
+        Returns:
+            Profiler: The enabled profiler.
+    """
+    global _PROFILER  # pylint: disable=global-statement
+    with _PROFILER_LOCK:
+        _PROFILER = Profiler(**kwargs)
+        return _PROFILER
+
+
+def disable():
+    """
+        Disables the profiling of protected handlers.
+    """
+    global _PROFILER  # pylint: disable=global-statement
+    with _PROFILER_LOCK:
+        _PROFILER = None
+
+
+def get_profiler():
+    """Returns the enabled profiler.
+
+        Returns:
+            Profiler: The profiler or None if profiling is disabled.
+    """
+    return _PROFILER
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+    Provides token-bucket rate limiting.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+# time.monotonic is not available on python 2
+CLOCK = getattr(time, "monotonic", time.time)
+
+
+def refill(tokens, stamp, now, rate, capacity):
+    """Refills a token bucket.
+
+        Args:
+            tokens (float): The tokens left at `stamp`.
+            stamp (float): The time the bucket was last updated.
+            now (float): The current time.
+            rate (float): Tokens added per second.
+            capacity (float): The maximum number of tokens.
+
+        Returns:
+            float: The tokens available at `now`.
+    """
+    return min(capacity, tokens + max(0.0, now - stamp) * rate)
+
+
+class RateLimiter(object):
+    """Keyed token-bucket rate limiter.
+
+        Holds one token bucket per key. Buckets are kept in least
+        recently used order so that the number of buckets is bounded:
+        when `max_keys` is exceeded the bucket which was idle the
+        longest is dropped. A dropped bucket behaves like a full one
+        the next time its key shows up.
+
+        Args:
+            rate (float): Tokens added to a bucket per second.
+            burst (Optional[float]): The capacity of a bucket. Defaults
+                to `rate` but at least 1.
+            max_keys (Optional[int]): The maximum number of buckets.
+            clock (Optional[func]): Returns the current time in seconds.
+    """
+
+    def __init__(self, rate, burst=None, max_keys=10000, clock=CLOCK):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1, rate))
+        self.max_keys = max_keys
+        self.__clock = clock
+        self.__buckets = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__buckets)
+
+    def allow(self, key, tokens=1):
+        """Takes tokens from the bucket of a key.
+
+            Args:
+                key (object): The bucket's key.
+                tokens (Optional[float]): The tokens to take.
+
+            Returns:
+                bool: True if the bucket had enough tokens, otherwise False.
+        """
+        now = self.__clock()
+        with self.__lock:
+            bucket = self.__buckets.pop(key, None)
+            if bucket is None:
+                available = self.burst
+            else:
+                available = refill(bucket[0], bucket[1], now, self.rate,
+                                   self.burst)
+
+            allowed = available >= tokens
+            if allowed:
+                available -= tokens
+
+            # re-insert to mark the bucket as most recently used
+            self.__buckets[key] = (available, now)
+            if len(self.__buckets) > self.max_keys:
+                self.__buckets.popitem(last=False)
+
+        return allowed
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket.
+
+        Args:
+            rate (float): Tokens added per second.
+            burst (Optional[float]): The capacity of the bucket.
+                Defaults to 1.
+            clock (Optional[func]): Returns the current time in seconds.
+            sleep (Optional[func]): Sleeps the given number of seconds.
+    """
+
+    def __init__(self, rate, burst=1, clock=CLOCK, sleep=time.sleep):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.__clock = clock
+        self.__sleep = sleep
+        self.__tokens = self.burst
+        self.__stamp = clock()
+        self.__lock = threading.Lock()
+
+    def __refill(self, now):
+        """
+            Refills the bucket. Must be called holding the lock.
+        """
+        if self.__tokens < self.burst:
+            self.__tokens = refill(self.__tokens, self.__stamp, now,
+                                   self.rate, self.burst)
+        self.__stamp = now
+
+    def consume(self, tokens=1):
+        """Takes tokens from the bucket without waiting.
+
+            Args:
+                tokens (Optional[float]): The tokens to take.
+
+            Returns:
+                bool: True if the bucket had enough tokens, otherwise False.
+        """
+        with self.__lock:
+            self.__refill(self.__clock())
+            if self.__tokens < tokens:
+                return False
+            self.__tokens -= tokens
+            return True
+
+    def acquire(self, tokens=1):
+        """Takes tokens from the bucket, waiting until they are available.
+
+            Every caller reserves its tokens right away, so concurrent
+            callers are served in order and never wake up in vain.
+
+            Args:
+                tokens (Optional[float]): The tokens to take.
+
+            Returns:
+                float: The seconds waited.
+        """
+        with self.__lock:
+            self.__refill(self.__clock())
+            self.__tokens -= tokens
+            wait = max(0.0, -self.__tokens / self.rate)
+
+        if wait:
+            self.__sleep(wait)
+        return wait
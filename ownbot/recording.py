@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+"""
+    Provides an opt-in recorder of the updates protected handlers get.
+
+    The recording is a JSON lines file. The first line holds the
+    anonymized user configuration at the start, every further line
+    one update with its authorization decision. Replay it with
+    `python -m ownbot.replay`.
+"""
+import hashlib
+import hmac
+import json
+import os
+import threading
+
+from ownbot import snapshot
+from ownbot.audit import AuditLog
+from ownbot.expiry import parse_duration
+from ownbot.ratelimit import CLOCK
+from ownbot.usermanager import UserManager
+
+_RECORDER = None
+_RECORDER_LOCK = threading.Lock()
+
+DEFAULT_PATH = os.path.join(os.path.expanduser("~"), ".ownbot",
+                            "recording.jsonl")
+
+FORMAT_VERSION = 1
+
+
+class Anonymizer(object):
+    """Replaces user ids and names by keyed hashes.
+
+        The same id or name always gets the same replacement within
+        one recording, so the recorded updates still match the
+        recorded users.
+
+        Args:
+            key (Optional[bytes]): The secret key. Defaults to a
+                random key.
+    """
+
+    def __init__(self, key=None):
+        self.__key = key if key is not None else os.urandom(16)
+
+    def __digest(self, value):
+        """
+            Returns the keyed hash of a value as hex string.
+        """
+        return hmac.new(self.__key, str(value).encode("utf-8"),
+                        hashlib.sha256).hexdigest()
+
+    def user_id(self, user_id):
+        """
+            Returns the replacement of a user id, a positive 48 bit int.
+        """
+        if user_id is None:
+            return None
+        return int(self.__digest(user_id)[:12], 16) + 1
+
+    def username(self, username):
+        """
+            Returns the replacement of a username.
+        """
+        if not username:
+            return username
+        return "@u" + self.__digest(username.lower())[:10]
+
+    def text(self, text, groups):
+        """Anonymizes a command.
+
+            The command and its arguments which are group names or
+            durations are kept, names starting with @ are replaced and
+            all other words are dropped.
+
+            Args:
+                text (str): The message text, callback data or query.
+                groups (set): The known group names.
+
+            Returns:
+                str: The anonymized text.
+        """
+        if not text:
+            return text
+        words = text.split()
+        result = [words[0]] if words[0].startswith("/") else ["x"]
+        for word in words[1:]:
+            if word.startswith("@"):
+                result.append(self.username(word))
+            elif word in groups or _is_duration(word):
+                result.append(word)
+            else:
+                result.append("x")
+        return " ".join(result)
+
+    def config(self, config):
+        """Anonymizes a user configuration.
+
+            Args:
+                config (dict): The user configuration.
+
+            Returns:
+                dict: The configuration with replaced ids and names.
+        """
+        result = {}
+        for group, data in config.items():
+            data = dict(data or {})
+            if snapshot.VERIFIED in data:
+                data[snapshot.VERIFIED] = [
+                    {"id": self.user_id(usr.get("id")),
+                     "username": self.username(usr.get("username"))}
+                    for usr in data[snapshot.VERIFIED] or []]
+            if snapshot.UNVERIFIED in data:
+                data[snapshot.UNVERIFIED] = [
+                    self.username(name)
+                    for name in data[snapshot.UNVERIFIED] or []]
+            for key in (snapshot.EXPIRES, snapshot.INVITED):
+                if key in data:
+                    data[key] = dict((self.username(name), value)
+                                     for name, value in
+                                     (data[key] or {}).items())
+            if snapshot.CHATS in data:
+                data[snapshot.CHATS] = dict(
+                    (self.user_id(chat_id),
+                     [self.user_id(user_id) for user_id in user_ids or []])
+                    for chat_id, user_ids in
+                    (data[snapshot.CHATS] or {}).items())
+            result[group] = data
+        return result
+
+
+def _is_duration(word):
+    """
+        Checks if a word is a duration like 2d.
+    """
+    try:
+        parse_duration(word)
+    except ValueError:
+        return False
+    return True
+
+
+class Recorder(object):
+    """Records the updates of protected handlers, anonymized.
+
+        Writes the anonymized user configuration first. The updates
+        are written by an `ownbot.audit.AuditLog`, so recording never
+        waits for the disk.
+
+        Args:
+            path (str): The recording's path.
+            tenant (Optional[str]): The tenant whose users are recorded.
+            anonymizer (Optional[Anonymizer]): Replaces ids and names.
+            **kwargs: Further arguments for `ownbot.audit.AuditLog`.
+    """
+
+    def __init__(self, path, tenant=None, anonymizer=None, **kwargs):
+        self.path = path
+        self.anonymizer = anonymizer or Anonymizer()
+        self.__start = CLOCK()
+        kwargs.setdefault("max_bytes", 0)
+        usermanager = UserManager(tenant)
+        config = usermanager.config
+        self.__groups = set(config)
+
+        with open(path, "w") as recording_file:
+            recording_file.write(json.dumps(
+                {"version": FORMAT_VERSION,
+                 "config": self.anonymizer.config(config)},
+                sort_keys=True) + "\n")
+        self.__log = AuditLog(path, **kwargs)
+
+    def record(self, kind, user_id, username, text, groups, decision,  # pylint: disable=too-many-arguments
+               chat_id=None):
+        """Records an update.
+
+            Args:
+                kind (str): The update's type, e.g. `message` or
+                    `callback_query`.
+                user_id (int): The sender's id.
+                username (str): The sender's name.
+                text (str): The message text, callback data or query.
+                groups (list): The groups the handler requires.
+                decision (bool): True if access was granted.
+                chat_id (Optional[int]): The chat the update was sent in.
+
+            Returns:
+                bool: True if the update was recorded, False if it was
+                    dropped because the buffer is full.
+        """
+        self.__groups.update(groups)
+        return self.__log.record(
+            time=round(CLOCK() - self.__start, 6),
+            kind=kind,
+            user_id=self.anonymizer.user_id(user_id),
+            username=self.anonymizer.username(username),
+            text=self.anonymizer.text(text, self.__groups),
+            groups=list(groups),
+            granted=bool(decision),
+            chat_id=self.anonymizer.user_id(chat_id))
+
+    @property
+    def dropped(self):
+        """
+            Returns the number of updates dropped because the buffer
+            was full.
+        """
+        return self.__log.dropped
+
+    def close(self, timeout=None):
+        """Writes the remaining updates.
+
+            Args:
+                timeout (Optional[float]): Seconds to wait for the
+                    writer thread.
+        """
+        self.__log.close(timeout)
+
+
+def load(path):
+    """Reads a recording.
+
+        Args:
+            path (str): The recording's path.
+
+        Returns:
+            tuple: The recorded user configuration and the list of
+                recorded updates as dicts.
+
+        Raises:
+            ValueError: If the file is not a recording.
+    """
+    with open(path) as recording_file:
+        header = json.loads(recording_file.readline() or "{}")
+        if header.get("version") != FORMAT_VERSION:
+            raise ValueError("'{0}' is not an ownbot recording".format(path))
+        events = [json.loads(line) for line in recording_file if line.strip()]
+
+    config = header["config"]
+    for data in config.values():
+        # JSON turned the chat ids into strings
+        if data and data.get(snapshot.CHATS):
+            data[snapshot.CHATS] = dict(
+                (int(chat_id), user_ids)
+                for chat_id, user_ids in data[snapshot.CHATS].items())
+    return config, events
+
+
+def enable(path=DEFAULT_PATH, **kwargs):
+    """Starts recording the updates of protected handlers.
+
+        Args:
+            path (Optional[str]): The recording's path. An existing
+                file is replaced.
+            **kwargs: Further arguments for `Recorder`.
+
+        Returns:
+            Recorder: The recorder.
+    """
+    recorder = Recorder(path, **kwargs)
+    previous = set_recorder(recorder)
+    if previous is not None:
+        previous.close()
+    return recorder
+
+
+def disable():
+    """
+        Stops recording and writes the remaining updates.
+    """
+    previous = set_recorder(None)
+    if previous is not None:
+        previous.close()
+
+
+def set_recorder(recorder):
+    """Replaces the recorder without closing the previous one.
+
+        Anything with a `record` method like `Recorder.record` works,
+        e.g. to collect the decisions of a replay.
+
+        Args:
+            recorder: The new recorder or None.
+
+        Returns:
+            The previous recorder or None.
+    """
+    global _RECORDER  # pylint: disable=global-statement
+    with _RECORDER_LOCK:
+        previous = _RECORDER
+        _RECORDER = recorder
+        return previous
+
+
+def get_recorder():
+    """Returns the active recorder.
+
+        Returns:
+            Recorder: The recorder or None if nothing is recorded.
+    """
+    return _RECORDER
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+    Provides the replay of recorded updates.
+
+    Feeds the updates of a recording written by `ownbot.recording`
+    through `requires_usergroup` and the `AdminCommands` against a
+    temporary copy of the recorded users and a fake bot. Reports the
+    throughput and every authorization decision which differs from
+    the recorded one.
+
+    Run `python -m ownbot.replay --help` for the options.
+"""
+import argparse
+import logging
+import threading
+import time
+from datetime import datetime
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+from telegram import CallbackQuery, Chat, ChosenInlineResult, InlineQuery
+from telegram import Message, Update
+from telegram import User as TelegramUser
+from telegram.ext import Dispatcher
+
+from ownbot import recording
+from ownbot.admincommands import AdminCommands
+from ownbot.auth import requires_usergroup
+from ownbot.loadtest import FakeBot, LoadReport
+from ownbot.messagequeue import MessageQueue
+from ownbot.ratelimit import CLOCK
+from ownbot.usermanager import UserManager, temporary_store
+
+# The commands handled by the AdminCommands
+ADMIN_COMMANDS = ("adminhelp", "users", "groups", "finduser", "pending",
+                  "adduser", "rmuser", "broadcast", "invite", "backup")
+
+
+def make_update(update_id, event):
+    """Builds the update of a recorded event.
+
+        Args:
+            update_id (int): The update's id.
+            event (dict): The recorded event.
+
+        Returns:
+            telegram.Update: The update.
+    """
+    username = (event.get("username") or "").lstrip("@") or None
+    user = TelegramUser(event["user_id"], "user", username=username)
+    text = event.get("text")
+    kind = event.get("kind")
+
+    chat_id = event.get("chat_id") or event["user_id"]
+    chat = Chat(chat_id, "private" if chat_id == event["user_id"] else "group")
+
+    if kind == "callback_query":
+        return Update(update_id, callback_query=CallbackQuery(
+            str(update_id), user, "replay", data=text,
+            message=Message(update_id, user, datetime.now(), chat)))
+    if kind == "inline_query":
+        return Update(update_id, inline_query=InlineQuery(
+            str(update_id), user, text or "", ""))
+    if kind == "chosen_inline_result":
+        return Update(update_id, chosen_inline_result=ChosenInlineResult(
+            str(update_id), user, text or ""))
+
+    message = Message(update_id, user, datetime.now(), chat, text=text)
+    if kind in ("edited_message", "channel_post", "edited_channel_post"):
+        return Update(update_id, **{kind: message})
+    return Update(update_id, message=message)
+
+
+class ReplayReport(LoadReport):  # pylint: disable=too-few-public-methods
+    """The results of a replay.
+
+        Attributes:
+            changed (list): A dict with the `index` of the recorded
+                update, the `recorded` and the `replayed` decision per
+                update whose decision changed.
+    """
+
+    def __init__(self, changed, *args, **kwargs):
+        super(ReplayReport, self).__init__(*args, **kwargs)
+        self.changed = changed
+
+    def __str__(self):
+        lines = [super(ReplayReport, self).__str__(),
+                 "changed:    {0} decisions".format(len(self.changed))]
+        for change in self.changed[:10]:
+            lines.append("  - update {0}: {1} -> {2}".format(
+                change["index"],
+                "grant" if change["recorded"] else "deny",
+                "grant" if change["replayed"] else "deny"))
+        return "\n".join(lines)
+
+
+class _DecisionCollector(object):  # pylint: disable=too-few-public-methods
+    """
+        Collects the decisions of the replayed updates by the index
+        of the update the current thread replays.
+    """
+
+    def __init__(self):
+        self.decisions = {}
+        self.local = threading.local()
+
+    def record(self, kind, user_id, username, text, groups, decision,  # pylint: disable=too-many-arguments, unused-argument
+               chat_id=None):
+        """
+            Stores the decision of the current update.
+        """
+        self.decisions[self.local.index] = bool(decision)
+
+
+def run(path, speed=0.0, workers=1):
+    """Replays a recording.
+
+        Updates of the admin commands are dispatched to the
+        `AdminCommands`, all other updates are passed to a handler
+        which requires the recorded groups.
+
+        Args:
+            path (str): The recording's path.
+            speed (Optional[float]): 1 replays at the recorded speed,
+                2 twice as fast. 0 replays as fast as possible.
+            workers (Optional[int]): The number of replaying threads.
+                With more than one thread the order of the updates
+                and thus the decisions may change.
+
+        Returns:
+            ReplayReport: The results.
+    """
+    config, events = recording.load(path)
+    events.sort(key=lambda event: event["time"])
+
+    collector = _DecisionCollector()
+    previous = recording.set_recorder(collector)
+    try:
+        with temporary_store() as tenant:
+            return _replay(config, events, collector, tenant, speed, workers)
+    finally:
+        recording.set_recorder(previous)
+
+
+def _replay(config, events, collector, tenant, speed, workers):
+    """Replays the events against the users of a temporary tenant.
+
+        Args:
+            config (dict): The recorded users.
+            events (list): The recorded events sorted by time.
+            collector (_DecisionCollector): Collects the decisions.
+            tenant (str): The tenant created by `temporary_store`.
+            speed (float): See `run`.
+            workers (int): See `run`.
+
+        Returns:
+            ReplayReport: The results.
+    """
+    usermanager = UserManager(tenant)
+    usermanager.config = config
+
+    bot = FakeBot()
+    dispatcher = Dispatcher(bot, queue.Queue(), workers=workers)
+    message_queue = MessageQueue(per_chat_rate=1e6, global_rate=1e6)
+    AdminCommands(dispatcher, message_queue=message_queue, tenant=tenant)
+
+    def handler(bot, update):
+        """Replies to an authorized update"""
+        bot.sendMessage(chat_id=update.update_id, text="ok")
+
+    protected = {}
+    pending = queue.Queue(maxsize=0 if speed else workers * 2)
+    latencies = []
+
+    def work():
+        """Replays updates until None is received"""
+        while True:
+            item = pending.get()
+            if item is None:
+                return
+            index, event, scheduled = item
+            if scheduled is None:
+                scheduled = CLOCK()
+            collector.local.index = index
+            update = make_update(index + 1, event)
+            command = (event.get("text") or "").split(" ")[0]
+            if event.get("groups") == ["admin"] and \
+               event.get("kind") == "message" and \
+               command.lstrip("/") in ADMIN_COMMANDS:
+                dispatcher.process_update(update)
+            else:
+                groups = tuple(event.get("groups") or ())
+                if groups not in protected:
+                    protected[groups] = requires_usergroup(
+                        *groups, tenant=tenant)(handler)
+                protected[groups](bot, update)
+            latencies.append(CLOCK() - scheduled)
+
+    threads = [threading.Thread(target=work) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    storage_before = usermanager.storage_stats
+    start = CLOCK()
+    for index, event in enumerate(events):
+        scheduled = None
+        if speed:
+            scheduled = start + event["time"] / speed
+            delay = scheduled - CLOCK()
+            if delay > 0:
+                time.sleep(delay)
+        pending.put((index, event, scheduled))
+
+    for _ in threads:
+        pending.put(None)
+    for thread in threads:
+        thread.join()
+    elapsed = CLOCK() - start
+    message_queue.stop()
+
+    storage_after = usermanager.storage_stats
+    storage = dict((key, storage_after[key] - storage_before[key])
+                   for key in storage_after)
+    changed = [{"index": index, "recorded": event["granted"],
+                "replayed": collector.decisions.get(index, False)}
+               for index, event in enumerate(events)
+               if collector.decisions.get(index, False) !=
+               event["granted"]]
+    granted = sum(1 for decision in collector.decisions.values()
+                  if decision)
+    return ReplayReport(changed, len(events), elapsed, latencies,
+                        granted, storage, bot.sent)
+
+
+def main(argv=None):
+    """
+        Replays a recording from the command line.
+    """
+    parser = argparse.ArgumentParser(
+        description="Replays updates recorded by ownbot.recording.")
+    parser.add_argument("path", help="the recording")
+    parser.add_argument("--speed", type=float, default=0.0,
+                        help="1 for the recorded speed, 0 for maximum speed")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of replaying threads")
+    args = parser.parse_args(argv)
+
+    # every denied update would be logged as a warning
+    logging.basicConfig(level=logging.ERROR)
+
+    print(run(args.path, speed=args.speed, workers=args.workers))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,671 @@
+# -*- coding: utf-8 -*-
+"""
+    Provides immutable snapshots of the ownbot user configuration.
+"""
+import bisect
+import sys
+import threading
+import time
+
+from ownbot.expiry import ExpiryHeap
+
+UNVERIFIED = "unverified"
+VERIFIED = "users"
+EXPIRES = "expires"
+INVITED = "invited"
+INVITES = "invites"
+MODIFIED = "modified"
+CHATS = "chats"
+
+# The chat id of the grants which apply to every chat
+GLOBAL = None
+
+# The modes of multi-group queries
+UNION = "union"
+INTERSECTION = "intersection"
+
+
+def search_key(text):
+    """Returns the key a username or prefix is searched by.
+
+        Args:
+            text (str): The username or prefix.
+
+        Returns:
+            str: The text in lower case without a leading @.
+    """
+    return (text or "").lower().lstrip("@")
+
+
+class GroupSnapshot(object):  # pylint: disable=too-few-public-methods
+    """Indexed, read-only view of a single group.
+
+        Args:
+            data (dict): The group's configuration.
+    """
+    __slots__ = ("data", "ids", "names", "unverified", "expires",
+                 "expiring_ids", "invited", "oldest_invite", "invites",
+                 "verified_count", "unverified_count", "verified_users",
+                 "unverified_users", "modified", "chats", "size")
+
+    def __init__(self, data):
+        self.data = data or {}
+        verified = self.data.get(VERIFIED) or []
+        self.ids = frozenset(usr.get("id") for usr in verified)
+        self.names = frozenset(usr.get("username") for usr in verified)
+        self.unverified = frozenset(self.data.get(UNVERIFIED) or [])
+        self.expires = self.data.get(EXPIRES) or {}
+        self.expiring_ids = dict(
+            (usr.get("id"), self.expires[usr.get("username")])
+            for usr in verified if usr.get("username") in self.expires)
+        self.invited = self.data.get(INVITED) or {}
+        self.oldest_invite = min(
+            [added for name, added in self.invited.items()
+             if name in self.unverified] or [None])
+        self.invites = self.data.get(INVITES) or {}
+        self.verified_count = len(verified)
+        self.unverified_count = len(self.unverified)
+        # The users in the order of the file, each once, for queries
+        # which stream the users of several groups
+        seen = set()
+        self.verified_users = tuple(
+            (usr.get("username"), usr.get("id")) for usr in verified
+            if usr.get("id") is not None and usr.get("id") not in seen
+            and not seen.add(usr.get("id")))
+        seen = set()
+        self.unverified_users = tuple(
+            username for username in self.data.get(UNVERIFIED) or []
+            if username not in seen and not seen.add(username))
+        self.modified = self.data.get(MODIFIED)
+        self.chats = self.data.get(CHATS) or {}
+        # A rough estimate of the memory used by the group's users
+        # and indexes. The strings are shared and not counted.
+        self.size = sys.getsizeof(self.data) + \
+            sum(sys.getsizeof(usr) for usr in verified) + \
+            sum(sys.getsizeof(ids) for ids in self.chats.values()) + \
+            sys.getsizeof(self.verified_users) + \
+            sys.getsizeof(self.unverified_users) + \
+            sys.getsizeof(self.ids) + sys.getsizeof(self.names) + \
+            sys.getsizeof(self.unverified)
+
+    def is_expired(self, username=None, user_id=None):
+        """Checks if the membership of a user expired.
+
+            Args:
+                username (Optional[str]): The user's name.
+                user_id (Optional[int]): The user's unique id. Only
+                    used if no username is passed.
+
+            Returns:
+                bool: True if the membership has an expiry time
+                    which passed, otherwise False.
+        """
+        if not self.expires:
+            return False
+
+        if username is None:
+            expires = self.expiring_ids.get(user_id)
+        else:
+            expires = self.expires.get(username)
+        return expires is not None and expires <= time.time()
+
+    def search_entries(self, name):
+        """Returns the entries of the group's users in the search index.
+
+            Verified users are found by their name and id, unverified
+            users by their name only. Entries of unverified users lack
+            the id, so entries never have to compare an id with None.
+
+            Args:
+                name (str): The group's name.
+
+            Returns:
+                generator: The (key, group, username[, user_id]) tuples.
+        """
+        for usr in self.data.get(VERIFIED) or []:
+            username = usr.get("username") or ""
+            user_id = usr.get("id")
+            yield search_key(username), name, username, user_id
+            if user_id is not None:
+                yield str(user_id), name, username, user_id
+
+        for username in self.data.get(UNVERIFIED) or []:
+            yield search_key(username), name, username or ""
+
+    def grant_keys(self):
+        """Returns the keys of the group's members in the grant index.
+
+            Returns:
+                generator: The (chat_id, user_id) tuples. The chat id of
+                    the group's verified users is `GLOBAL`.
+        """
+        for user_id in self.ids:
+            if user_id is not None:
+                yield GLOBAL, user_id
+        for chat_id, user_ids in self.chats.items():
+            for user_id in user_ids or []:
+                yield chat_id, user_id
+
+
+EMPTY_GROUP = GroupSnapshot({})
+
+
+class Snapshot(object):  # pylint: disable=too-few-public-methods
+    """Immutable view of the whole user configuration.
+
+        A snapshot must never be modified once it has been published.
+        Writers build a new configuration which shares all untouched
+        group dicts with the previous snapshot, so only the modified
+        groups have to be indexed again.
+
+        Args:
+            config (dict): The user configuration.
+            previous (Optional[Snapshot]): The snapshot to reuse group
+                indexes from.
+    """
+    __slots__ = ("config", "groups", "oldest_invite", "invite_index",
+                 "search_index", "grant_index", "counts", "size")
+
+    def __init__(self, config, previous=None):
+        self.config = config
+        self.groups = {}
+
+        old_groups = previous.groups if previous is not None else {}
+        for name, data in config.items():
+            old = old_groups.get(name)
+            if old is not None and old.data is data:
+                self.groups[name] = old
+            else:
+                self.groups[name] = GroupSnapshot(data)
+
+        self.oldest_invite = min(
+            [group.oldest_invite for group in self.groups.values()
+             if group.oldest_invite is not None] or [None])
+        self.invite_index = None
+        if previous is not None and previous.invite_index is not None:
+            self.invite_index = self.__update_invite_index(previous)
+        self.size = sys.getsizeof(config) + \
+            sum(group.size for group in self.groups.values())
+
+        self.search_index = None
+        if previous is not None and previous.search_index is not None:
+            self.search_index = self.__update_search_index(previous)
+
+        self.counts = {}
+        self.grant_index = None
+        if previous is not None and previous.grant_index is not None:
+            self.grant_index = self.__update_grant_index(previous)
+
+    def __update_search_index(self, previous):
+        """Updates the search index of the previous snapshot.
+
+            Only the entries of the groups which changed are removed
+            and inserted. The index is built from scratch if more
+            than a few groups changed.
+
+            Args:
+                previous (Snapshot): The snapshot whose index is updated.
+
+            Returns:
+                list: The sorted search index or None if it has to be
+                    built from scratch.
+        """
+        removed = [entry for name, group in previous.groups.items()
+                   if self.groups.get(name) is not group
+                   for entry in group.search_entries(name)]
+        added = [entry for name, group in self.groups.items()
+                 if previous.groups.get(name) is not group
+                 for entry in group.search_entries(name)]
+
+        index = previous.search_index
+        if (len(removed) + len(added)) * 8 > len(index):
+            return None
+
+        index = list(index)
+        for entry in removed:
+            position = bisect.bisect_left(index, entry)
+            if position < len(index) and index[position] == entry:
+                del index[position]
+        for entry in added:
+            bisect.insort(index, entry)
+        return index
+
+    def __update_invite_index(self, previous):
+        """Updates the invite index of the previous snapshot.
+
+            Only the tokens of the groups which changed are removed
+            and added.
+
+            Args:
+                previous (Snapshot): The snapshot whose index is updated.
+
+            Returns:
+                dict: The invite index.
+        """
+        index = dict(previous.invite_index)
+        for name, group in previous.groups.items():
+            if self.groups.get(name) is not group:
+                for digest in group.invites:
+                    if index.get(digest, (None, ))[0] == name:
+                        del index[digest]
+        for name, group in self.groups.items():
+            if previous.groups.get(name) is not group:
+                for digest, expires in group.invites.items():
+                    index[digest] = (name, expires)
+        return index
+
+    def __update_grant_index(self, previous):
+        """Updates the grant index of the previous snapshot.
+
+            Only the keys of the groups which changed are updated. The
+            index is built from scratch if more than a few groups changed.
+
+            Args:
+                previous (Snapshot): The snapshot whose index is updated.
+
+            Returns:
+                dict: The grant index or None if it has to be built
+                    from scratch.
+        """
+        removed = [(key, name) for name, group in previous.groups.items()
+                   if self.groups.get(name) is not group
+                   for key in group.grant_keys()]
+        added = [(key, name) for name, group in self.groups.items()
+                 if previous.groups.get(name) is not group
+                 for key in group.grant_keys()]
+
+        index = previous.grant_index
+        if (len(removed) + len(added)) * 8 > len(index):
+            return None
+
+        index = dict(index)
+        for key, name in removed:
+            groups = index.get(key, frozenset()) - frozenset([name])
+            if groups:
+                index[key] = groups
+            else:
+                index.pop(key, None)
+        for key, name in added:
+            index[key] = index.get(key, frozenset()) | frozenset([name])
+        return index
+
+    def group(self, name):
+        """Returns the indexed view of a group.
+
+            Args:
+                name (str): The group's name.
+
+            Returns:
+                GroupSnapshot: The group or an empty group if
+                    it doesn't exist.
+        """
+        return self.groups.get(name, EMPTY_GROUP)
+
+    def find_invite(self, digest):
+        """Looks up an invite token.
+
+            The index of all tokens is built on the first lookup.
+
+            Args:
+                digest (str): The hash of the token.
+
+            Returns:
+                tuple: The group the token invites to and its expiry
+                    time or None if there is no such token.
+        """
+        index = self.invite_index
+        if index is None:
+            index = dict(
+                (key, (name, expires))
+                for name, group in self.groups.items()
+                for key, expires in group.invites.items())
+            self.invite_index = index
+        return index.get(digest)
+
+    def grants(self, user_id, chat_id=GLOBAL):
+        """Returns the groups a user is a member of in a chat.
+
+            Uses an index keyed by (chat_id, user_id) which is built on
+            the first lookup and updated incrementally by the following
+            snapshots, so the global and the chat's grants take one
+            O(1) lookup each. Expired memberships are left out.
+
+            Args:
+                user_id (int): The user's unique id.
+                chat_id (Optional[int]): The chat. Only the global
+                    grants are returned if it is `GLOBAL`.
+
+            Returns:
+                frozenset: The names of the groups.
+        """
+        index = self.grant_index
+        if index is None:
+            index = {}
+            for name, group in self.groups.items():
+                for key in group.grant_keys():
+                    index.setdefault(key, set()).add(name)
+            index = dict((key, frozenset(groups))
+                         for key, groups in index.items())
+            self.grant_index = index
+
+        groups = index.get((GLOBAL, user_id), frozenset())
+        if groups and any(self.groups[name].expiring_ids for name in groups):
+            groups = frozenset(
+                name for name in groups
+                if not self.groups[name].is_expired(user_id=user_id))
+        if chat_id is not GLOBAL:
+            groups = groups | index.get((chat_id, user_id), frozenset())
+        return groups
+
+    def find_users(self, prefix, limit=None):
+        """Finds users by a prefix of their name or id.
+
+            Uses a sorted index of all names and ids which is built on
+            the first search and updated incrementally by the following
+            snapshots, so a search takes O(log n + k).
+
+            Args:
+                prefix (str): The prefix. Case and a leading @ are
+                    ignored.
+                limit (Optional[int]): The maximum number of results.
+
+            Returns:
+                list: The matching (group, username, user_id) tuples
+                    sorted by the matched key. The user id of
+                    unverified users is None.
+        """
+        index = self.search_index
+        if index is None:
+            index = sorted(entry for name, group in self.groups.items()
+                           for entry in group.search_entries(name))
+            self.search_index = index
+
+        key = search_key(prefix)
+        results = []
+        seen = set()
+        position = bisect.bisect_left(index, (key, ))
+        while position < len(index) and index[position][0].startswith(key):
+            entry = index[position]
+            position += 1
+            found = (entry[1], entry[2], entry[3] if len(entry) > 3 else None)
+            if found in seen or \
+               self.group(entry[1]).is_expired(username=entry[2]):
+                continue
+            seen.add(found)
+            results.append(found)
+            if limit is not None and len(results) >= limit:
+                break
+        return results
+
+    def iter_users(self, names, mode=UNION, verified=True, unverified=False):
+        """Streams the users of several groups.
+
+            Verified users are identified by their id, unverified users
+            by their name. Each user is yielded once; verified users
+            without an id are left out. Membership in the other groups
+            is looked up in their indexes, so nothing but the current
+            user is held in memory.
+
+            Args:
+                names (list): The groups' names.
+                mode (Optional[str]): `UNION` yields the users of any
+                    of the groups, `INTERSECTION` the users of all.
+                verified (Optional[bool]): Yields the verified users.
+                unverified (Optional[bool]): Yields the unverified users.
+
+            Returns:
+                generator: The (username, user_id) tuples. The user id
+                    of unverified users is None.
+
+            Raises:
+                ValueError: If the mode is unknown.
+        """
+        groups = self.__query_groups(names, mode)
+        if not groups:
+            return
+
+        if mode == INTERSECTION:
+            # Walk the smallest group and look up the others
+            first = min(groups, key=lambda group: group.verified_count +
+                        group.unverified_count)
+            others = [group for group in groups if group is not first]
+            if verified:
+                for username, user_id in first.verified_users:
+                    if not first.is_expired(user_id=user_id) and \
+                       all(user_id in group.ids and
+                           not group.is_expired(user_id=user_id)
+                           for group in others):
+                        yield username, user_id
+            if unverified:
+                for username in first.unverified_users:
+                    if not first.is_expired(username=username) and \
+                       all(username in group.unverified and
+                           not group.is_expired(username=username)
+                           for group in others):
+                        yield username, None
+            return
+
+        for position, group in enumerate(groups):
+            # A user is yielded by the first group it is active in
+            earlier = groups[:position]
+            if verified:
+                for username, user_id in group.verified_users:
+                    if not group.is_expired(user_id=user_id) and \
+                       not any(user_id in other.ids and
+                               not other.is_expired(user_id=user_id)
+                               for other in earlier):
+                        yield username, user_id
+            if unverified:
+                for username in group.unverified_users:
+                    if not group.is_expired(username=username) and \
+                       not any(username in other.unverified and
+                               not other.is_expired(username=username)
+                               for other in earlier):
+                        yield username, None
+
+    def count_users(self, names, mode=UNION, verified=True,
+                    unverified=False):
+        """Counts the users `iter_users` yields.
+
+            A single group without expiring memberships is counted in
+            O(1). Otherwise the users are counted while they are
+            streamed like by `iter_users`, in constant memory. The
+            count is kept with the snapshot unless one of the groups
+            has expiring memberships.
+
+            Args:
+                names (list): The groups' names.
+                mode (Optional[str]): `UNION` or `INTERSECTION`.
+                verified (Optional[bool]): Counts the verified users.
+                unverified (Optional[bool]): Counts the unverified users.
+
+            Returns:
+                int: The number of users.
+
+            Raises:
+                ValueError: If the mode is unknown.
+        """
+        names = tuple(names)
+        groups = self.__query_groups(names, mode)
+        if not groups:
+            return 0
+
+        key = (names, mode, verified, unverified)
+        count = self.counts.get(key)
+        if count is not None:
+            return count
+
+        expiring = any(group.expires for group in groups)
+        if len(groups) == 1 and not expiring:
+            count = (len(groups[0].verified_users) if verified else 0) + \
+                (len(groups[0].unverified_users) if unverified else 0)
+        else:
+            count = sum(1 for _ in self.iter_users(
+                names, mode, verified=verified, unverified=unverified))
+
+        if not expiring:
+            self.counts[key] = count
+        return count
+
+    def __query_groups(self, names, mode):
+        """Returns the groups of a query.
+
+            Args:
+                names (list): The groups' names.
+                mode (str): `UNION` or `INTERSECTION`.
+
+            Returns:
+                list: The groups' snapshots without duplicates. Empty
+                    if no user can match.
+
+            Raises:
+                ValueError: If the mode is unknown.
+        """
+        if mode not in (UNION, INTERSECTION):
+            raise ValueError("Unknown mode '{0}'".format(mode))
+
+        groups = []
+        for name in names:
+            group = self.groups.get(name)
+            if group is None:
+                if mode == INTERSECTION:
+                    return []
+            elif group not in groups:
+                groups.append(group)
+        return groups
+
+    def stats(self):
+        """Returns the statistics of all groups.
+
+            The numbers are counted once per group and snapshot, so
+            this takes O(number of groups).
+
+            Returns:
+                list: A dict with the group's `name`, the number of
+                    `verified` and `unverified` users and the unix
+                    timestamp the group was last `modified` at per
+                    group, sorted by name. The timestamp is None if
+                    it is unknown.
+        """
+        return [{"name": name,
+                 "verified": self.groups[name].verified_count,
+                 "unverified": self.groups[name].unverified_count,
+                 "modified": self.groups[name].modified}
+                for name in sorted(self.groups)]
+
+    def expiries(self):
+        """Returns the expiry times of all memberships and invite tokens.
+
+            Returns:
+                generator: The (expires, group, username) tuples. Invite
+                    tokens are identified by their hash instead of a
+                    username.
+        """
+        for name, group in self.groups.items():
+            for username, expires in group.expires.items():
+                yield expires, name, username
+            for digest, expires in group.invites.items():
+                yield expires, name, digest
+
+
+class Store(object):  # pylint: disable=too-few-public-methods
+    """Holds the currently published snapshot of a configuration file.
+
+        Readers fetch the `snapshot` attribute without any locking.
+        Writers serialize on `lock` and swap in a new snapshot when
+        they are done.
+
+        Attributes:
+            snapshot (Snapshot): The current snapshot or None if the
+                configuration file has not been loaded yet.
+            stamp (tuple): Identifies the file state the snapshot
+                corresponds to.
+            generation (int): Incremented before and after a write;
+                odd while the configuration file is being written.
+            version (int): Incremented with every published snapshot.
+            last_used (float): When the snapshot was last looked up.
+            lock (threading.RLock): Serializes writers.
+            export_lock (threading.Lock): Serializes the writes of the
+                binary snapshot.
+            exported (Snapshot): The snapshot last written to the
+                binary snapshot file or None.
+            expiries (ExpiryHeap): The expiry times of the memberships
+                in the published snapshots.
+            sweeper (ownbot.expiry.Sweeper): Removes expired memberships
+                or None if it has not been created yet.
+            reads (int): The number of times the file was parsed.
+            writes (int): The number of times the file was written.
+    """
+
+    def __init__(self):
+        self.snapshot = None
+        self.stamp = None
+        self.generation = 0
+        self.version = 0
+        self.last_used = 0.0
+        self.reads = 0
+        self.writes = 0
+        self.lock = threading.RLock()
+        self.export_lock = threading.Lock()
+        self.exported = None
+        self.expiries = ExpiryHeap()
+        self.sweeper = None
+        self.__publish_lock = threading.Lock()
+
+    def publish(self, snapshot, stamp, expected=None, check=False,
+                expiries=None):
+        """Swaps in a new snapshot.
+
+            The expiry heap is updated together with the snapshot, so
+            it never lags behind a snapshot published later.
+
+            Args:
+                snapshot (Snapshot): The new snapshot.
+                stamp (tuple): The file state of the new snapshot.
+                expected (Optional[Snapshot]): The snapshot which must
+                    still be current if `check` is set.
+                check (Optional[bool]): Only publish if the current
+                    snapshot is `expected`.
+                expiries (Optional[list]): The (expires, group, username)
+                    tuples added by the new snapshot. If None, the expiry
+                    heap is rebuilt from the snapshot.
+
+            Returns:
+                bool: True if the snapshot was published, otherwise False.
+        """
+        with self.__publish_lock:
+            if check and self.snapshot is not expected:
+                return False
+            self.snapshot = snapshot
+            self.stamp = stamp
+            self.version += 1
+            if expiries is None:
+                self.expiries.rebuild(snapshot.expiries())
+            else:
+                for entry in expiries:
+                    self.expiries.push(*entry)
+            return True
+
+    def evict(self):
+        """Drops the snapshot to free its memory.
+
+            The snapshot is loaded again on the next lookup. The lock
+            and the expiry heap are kept.
+
+            Returns:
+                bool: True if the snapshot was dropped, False if there
+                    was none or a writer holds the lock.
+        """
+        # A writer may have read the snapshot as the base of its change
+        if not self.lock.acquire(False):
+            return False
+        try:
+            with self.__publish_lock:
+                if self.snapshot is None or self.generation % 2:
+                    return False
+                self.snapshot = None
+                self.stamp = None
+                self.version += 1
+                return True
+        finally:
+            self.lock.release()
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+    Provides the warm-up of a bot process and a readiness probe.
+"""
+import gc
+import importlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:  # python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from ownbot import compat
+from ownbot.ratelimit import CLOCK
+from ownbot.usermanager import UserManager
+
+# The modules ownbot imports on the first update
+MODULES = ("ownbot.admincommands", "ownbot.auth", "ownbot.broadcast",
+           "ownbot.expiry", "ownbot.messagequeue", "ownbot.user")
+
+
+def write_readiness_file(report, path):
+    """Writes a warm-up report as JSON.
+
+        The file is replaced atomically, so a probe never reads a
+        partial report.
+
+        Args:
+            report (dict): The report returned by `warmup`.
+            path (str): The file's path.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(handle, "w") as readiness_file:
+            json.dump(report, readiness_file, sort_keys=True)
+        compat.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+class ReadinessProbe(object):
+    """Answers HTTP requests with the warm-up report.
+
+        `GET /ready` returns 503 until a report is set and 200 with
+        the report as JSON afterwards.
+
+        Args:
+            port (int): The port to listen on. 0 picks a free port.
+            host (Optional[str]): The address to listen on.
+    """
+
+    def __init__(self, port, host="127.0.0.1"):
+        self.report = None
+        probe = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """
+                Serves the readiness endpoint.
+            """
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                """
+                    Returns the report or 503 if not ready.
+                """
+                report = probe.report
+                if self.path.split("?")[0] != "/ready":
+                    self.send_error(404)
+                    return
+                status = 200 if report is not None else 503
+                body = json.dumps(report if report is not None
+                                  else {"ready": False}).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                """
+                    Keeps the probe's requests out of stderr.
+                """
+
+        self.__server = HTTPServer((host, port), Handler)
+        self.__thread = threading.Thread(target=self.__server.serve_forever,
+                                         name="ownbot-readiness")
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    @property
+    def address(self):
+        """
+            Returns the (host, port) tuple the probe listens on.
+        """
+        return self.__server.server_address
+
+    def close(self):
+        """
+            Stops answering requests.
+        """
+        self.__server.shutdown()
+        self.__server.server_close()
+        self.__thread.join()
+
+
+def warmup(tenants=(), modules=(), freeze=True, readiness_file=None,
+           probe=None):
+    """Prepares the process for the first update.
+
+        Creates the config dir, loads the users of the default store
+        and the given tenants, builds their indexes and imports the
+        modules. Call it before forking workers, so the loaded users
+        are shared by the workers' memory pages.
+
+        Args:
+            tenants (Optional[list]): The tenants to preload in addition
+                to the default users.
+            modules (Optional[list]): The names of further modules to
+                import, e.g. the bot's handlers.
+            freeze (Optional[bool]): Moves all objects into the permanent
+                generation of the garbage collector if it supports
+                `gc.freeze`. The collector then doesn't touch their
+                pages, so they stay shared after a fork.
+            readiness_file (Optional[str]): Where the report is written.
+            probe (Optional[ReadinessProbe]): Serves the report.
+
+        Returns:
+            dict: The report with `ready`, the `load_time` in seconds,
+                the number of `groups` and `users`, the estimated
+                `size` of the loaded users in bytes, the `pid` and
+                the `time` as unix timestamp.
+    """
+    start = CLOCK()
+    for name in MODULES + tuple(modules):
+        importlib.import_module(name)
+
+    report = {"groups": 0, "users": 0, "size": 0}
+    for tenant in (None, ) + tuple(tenants):
+        stats = UserManager(tenant).preload()
+        for key in report:
+            report[key] += stats[key]
+
+    if freeze and hasattr(gc, "freeze"):
+        gc.collect()
+        gc.freeze()  # pylint: disable=no-member
+
+    report.update(ready=True, load_time=CLOCK() - start, pid=os.getpid(),
+                  time=time.time())
+    if readiness_file is not None:
+        write_readiness_file(report, readiness_file)
+    if probe is not None:
+        probe.report = report
+    return report
@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""
+    Provides lightweight tracing of authorization checks.
+
+    A trace starts with a protected handler call and has a span for
+    every `User.has_access`, `UserManager` call and every load and save
+    of the configuration file below it. The spans are written as JSON
+    lines with OTLP field names.
+"""
+import binascii
+import os
+import random
+import threading
+import time
+from functools import wraps
+
+from ownbot.audit import AuditLog
+
+_TRACER = None
+_TRACER_LOCK = threading.Lock()
+
+# The stack of open spans of the current thread
+_LOCAL = threading.local()
+
+DEFAULT_PATH = os.path.join(os.path.expanduser("~"), ".ownbot",
+                            "traces.jsonl")
+
+
+def _new_id(size):
+    """
+        Returns a random hex id of `size` bytes.
+    """
+    return binascii.hexlify(os.urandom(size)).decode("ascii")
+
+
+class Span(object):  # pylint: disable=too-few-public-methods
+    """A timed operation within a trace.
+
+        Attributes:
+            trace_id (str): The id of the trace the span belongs to.
+            span_id (str): The span's id.
+            parent_id (str): The id of the parent span or None.
+            name (str): The operation's name.
+            start (float): The start time as unix timestamp.
+            attributes (dict): The span's attributes.
+    """
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "start",
+                 "attributes")
+
+    def __init__(self, name, parent=None, attributes=None):
+        self.trace_id = parent.trace_id if parent is not None \
+            else _new_id(16)
+        self.span_id = _new_id(8)
+        self.parent_id = parent.span_id if parent is not None else None
+        self.name = name
+        self.start = time.time()
+        self.attributes = attributes or {}
+
+
+class _SpanContext(object):  # pylint: disable=too-few-public-methods
+    """
+        Opens a span on enter and exports it on exit.
+    """
+    __slots__ = ("tracer", "name", "attributes")
+
+    def __init__(self, tracer, name, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self):
+        return self.tracer.start_span(self.name, self.attributes)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.tracer.end_span(exc_type)
+
+
+class _NoSpan(object):  # pylint: disable=too-few-public-methods
+    """
+        Is used while tracing is disabled.
+    """
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+class Tracer(object):
+    """Records spans and exports them as JSON lines.
+
+        Whether a trace is recorded is decided when its first span
+        starts, so a trace is either recorded completely or not at all.
+        The spans are written by an `ownbot.audit.AuditLog`, so opening
+        and closing a span never waits for the disk.
+
+        Args:
+            path (str): The trace file's path.
+            sample_rate (Optional[float]): The fraction of traces which
+                are recorded.
+            **kwargs: Further arguments for `ownbot.audit.AuditLog`.
+    """
+
+    def __init__(self, path, sample_rate=1.0, **kwargs):
+        self.sample_rate = sample_rate
+        self.exporter = AuditLog(path, **kwargs)
+        self.__random = random.Random()
+
+    def span(self, name, attributes=None):
+        """Returns a context manager which records a span.
+
+            Args:
+                name (str): The operation's name.
+                attributes (Optional[dict]): The span's attributes.
+
+            Returns:
+                The context manager. It returns the `Span` or None
+                if the trace is not recorded.
+        """
+        return _SpanContext(self, name, attributes)
+
+    def start_span(self, name, attributes=None):
+        """Opens a span as child of the current thread's open span.
+
+            Every call must be followed by a call of `end_span`.
+
+            Args:
+                name (str): The operation's name.
+                attributes (Optional[dict]): The span's attributes.
+
+            Returns:
+                Span: The span or None if the trace is not recorded.
+        """
+        stack = getattr(_LOCAL, "stack", None)
+        if stack is None:
+            stack = _LOCAL.stack = []
+
+        if stack:
+            parent = stack[-1]
+            span = Span(name, parent, attributes) \
+                if parent is not None else None
+        elif self.__random.random() < self.sample_rate:
+            span = Span(name, None, attributes)
+        else:
+            span = None
+        stack.append(span)
+        return span
+
+    def end_span(self, error=None):
+        """Closes the current thread's open span and exports it.
+
+            Args:
+                error (Optional[type]): The exception raised in the span.
+        """
+        span = _LOCAL.stack.pop()
+        if span is None:
+            return
+
+        end = time.time()
+        status = {"code": "ERROR", "message": error.__name__} \
+            if error is not None else {"code": "OK"}
+        self.exporter.record(
+            time=end,
+            traceId=span.trace_id,
+            spanId=span.span_id,
+            parentSpanId=span.parent_id,
+            name=span.name,
+            startTimeUnixNano=int(span.start * 1e9),
+            endTimeUnixNano=int(end * 1e9),
+            attributes=span.attributes,
+            status=status)
+
+    def close(self, timeout=None):
+        """Writes the remaining spans.
+
+            Args:
+                timeout (Optional[float]): Seconds to wait for the
+                    exporter's thread.
+        """
+        self.exporter.close(timeout)
+
+
+def span(name, **attributes):
+    """Returns a context manager which records a span.
+
+        Args:
+            name (str): The operation's name.
+            **attributes: The span's attributes.
+
+        Returns:
+            The context manager. It returns the `Span` or None if
+            tracing is disabled or the trace is not recorded.
+    """
+    tracer = _TRACER
+    if tracer is None:
+        return _NO_SPAN
+    return tracer.span(name, attributes)
+
+
+def traced(name):
+    """Records a span for every call of the decorated function.
+
+        Args:
+            name (str): The span's name.
+
+        Returns:
+            func: The decorater function.
+    """
+
+    def decorate(func):
+        @wraps(func)
+        def call(*args, **kwargs):
+            tracer = _TRACER
+            if tracer is None:
+                return func(*args, **kwargs)
+            with tracer.span(name):
+                return func(*args, **kwargs)
+
+        return call
+
+    return decorate
+
+
+def set_attribute(key, value):
+    """Sets an attribute of the current thread's open span.
+
+        Does nothing if tracing is disabled or the trace is not recorded.
+
+        Args:
+            key (str): The attribute's name.
+            value: The attribute's value. Must be serializable to JSON.
+    """
+    stack = getattr(_LOCAL, "stack", None)
+    if stack and stack[-1] is not None:
+        stack[-1].attributes[key] = value
+
+
+def enable(path=DEFAULT_PATH, sample_rate=1.0, **kwargs):
+    """Enables tracing.
+
+        Args:
+            path (Optional[str]): The trace file's path.
+            sample_rate (Optional[float]): The fraction of traces which
+                are recorded.
+            **kwargs: Further arguments for `ownbot.audit.AuditLog`.
+
+        Returns:
+            Tracer: The enabled tracer.
+    """
+    global _TRACER  # pylint: disable=global-statement
+    with _TRACER_LOCK:
+        if _TRACER is not None:
+            _TRACER.close()
+        _TRACER = Tracer(path, sample_rate=sample_rate, **kwargs)
+        return _TRACER
+
+
+def disable():
+    """
+        Disables tracing and writes the remaining spans.
+    """
+    global _TRACER  # pylint: disable=global-statement
+    with _TRACER_LOCK:
+        if _TRACER is not None:
+            _TRACER.close()
+        _TRACER = None
+
+
+def get_tracer():
+    """Returns the enabled tracer.
+
+        Returns:
+            Tracer: The tracer or None if tracing is disabled.
+    """
+    return _TRACER
@@ -2,6 +2,7 @@
 """
     Provides the ownbot User class.
 """
+from ownbot import tracing
 from ownbot.usermanager import UserManager
 
 
@@ -12,13 +13,14 @@ class User(object):
             name (str): The user's unique telegram username.
             user_id (str): The user's unique telegram id.
             group (Optional[str]): The user's group.
+            tenant (Optional[str]): The tenant the user belongs to.
     """
 
-    def __init__(self, name, user_id, group=None):
+    def __init__(self, name, user_id, group=None, tenant=None):
         self.__name = name
         self.__id = user_id
         self.__group = group
-        self.__usermanager = UserManager()
+        self.__usermanager = UserManager(tenant)
 
     def save(self):
         """Saves the user's data.
@@ -37,7 +39,8 @@ class User(object):
                                     user_id=self.__id)
         return True
 
-    def has_access(self, group):
+    @tracing.traced("User.has_access")
+    def has_access(self, group, chat_id=None):
         """Checks if the user is in given group.
 
             Returns True if given user has access rights
@@ -45,16 +48,17 @@ class User(object):
 
             Args:
                 group (str): The group's name.
+                chat_id (Optional[int]): The chat the user acts in.
+                    Grants of the group within this chat count, too.
 
             Returns:
                 bool: True if user is in the given group, otherwise False.
         """
-        is_in_group = self.__usermanager.user_is_in_group(group,
-                                                          user_id=self.__id)
-        is_admin = self.__usermanager.user_is_in_group("admin",
-                                                       user_id=self.__id)
-
-        if is_in_group or is_admin:
+        # One lookup covers the group and the admins, globally and
+        # within the chat.
+        groups = self.__usermanager.get_user_groups(self.__id,
+                                                    chat_id=chat_id)
+        if group in groups or "admin" in groups:
             self.save()
             return True
 
@@ -2,95 +2,729 @@
 """
     Provides the ownbot UserManager class.
 """
+import base64
+import copy
+import hashlib
+import logging
 import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
 import yaml
 
+from ownbot import (backup, cache, compat, mapped, profiling, snapshot,
+                    tracing)
+from ownbot.expiry import Sweeper
+from ownbot.ratelimit import CLOCK
+
+_STORES = {}
+_STORES_LOCK = threading.Lock()
+
+# The directories of the tenants created by `temporary_store`
+_TEMPORARY_DIRS = {}
+
+# The transactions and the tenant of the current thread
+_LOCAL = threading.local()
+
+
+class TransactionConflict(Exception):
+    """
+        Raised if a transaction could not be applied to a
+        configuration which was modified concurrently.
+    """
+
+
+class _Transaction(object):  # pylint: disable=too-few-public-methods
+    """The state of a running transaction.
+
+        Args:
+            base (ownbot.snapshot.Snapshot): The snapshot the
+                transaction started from.
+            version (int): The store's version of the base snapshot.
+    """
+
+    def __init__(self, base, version):
+        self.base = base
+        self.version = version
+        self.snapshot = base
+        self.expiries = []
+        self.reindex = False
+        self.clear_caches = False
+        self.log = []
+
+
+def _get_store(path):
+    """Returns the store of a configuration file.
+
+        Args:
+            path (str): The configuration file's path.
+
+        Returns:
+            ownbot.snapshot.Store: The store shared by all
+                UserManager instances using this file.
+    """
+    store = _STORES.get(path)
+    if store is None:
+        with _STORES_LOCK:
+            store = _STORES.setdefault(path, snapshot.Store())
+    return store
+
+
+def _drop_store(path):
+    """Forgets the store of a configuration file.
+
+        Stops the store's sweeper, so nothing is written to the
+        file anymore.
+
+        Args:
+            path (str): The configuration file's path, e.g. of a
+                temporary file which is removed.
+    """
+    with _STORES_LOCK:
+        store = _STORES.pop(path, None)
+    if store is not None and store.sweeper is not None:
+        store.sweeper.stop()
+
+
+def _evict_cold_stores(keep, budget):
+    """Drops the least recently used snapshots until all snapshots
+        fit into the memory budget.
+
+        Args:
+            keep (ownbot.snapshot.Store): The store which must not
+                be evicted.
+            budget (int): The memory budget in bytes.
+    """
+    stores = [store for store in list(_STORES.values())
+              if store.snapshot is not None]
+    total = sum(store.snapshot.size for store in stores)
+    if total <= budget:
+        return
+
+    for store in sorted(stores, key=lambda store: store.last_used):
+        if store is keep:
+            continue
+        current = store.snapshot
+        if current is not None and store.evict():
+            total -= current.size
+            if total <= budget:
+                return
+
+
+def _reset_after_fork():
+    """
+        Forgets the sweeper threads, which don't survive a fork, so
+        the child process starts its own.
+    """
+    for store in _STORES.values():
+        store.sweeper = None
+
+
+# os.register_at_fork is not available before python 3.7
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(  # pylint: disable=no-member
+        after_in_child=_reset_after_fork)
+
+
+def get_tenant():
+    """Returns the tenant set for the current thread.
+
+        Returns:
+            str: The tenant or None for the default users.
+    """
+    return getattr(_LOCAL, "tenant", None)
+
+
+@contextmanager
+def using_tenant(tenant):
+    """Sets the tenant of the UserManagers created in the block.
+
+        Args:
+            tenant (str): The tenant or None for the default users.
+    """
+    previous = get_tenant()
+    _LOCAL.tenant = tenant
+    try:
+        yield
+    finally:
+        _LOCAL.tenant = previous
+
+
+@contextmanager
+def temporary_store():
+    """Provides a tenant whose users live in a temporary directory.
+
+        The class attributes of `UserManager` are left alone and no
+        binary snapshot is written for the tenant, so a bot running
+        in the same process keeps using its own users. The directory
+        and the tenant's store are removed after the block.
+
+            with temporary_store() as tenant:
+                UserManager(tenant).config = {"admin": {}}
+                AdminCommands(dispatcher, tenant=tenant)
+
+        Yields:
+            str: The tenant, e.g. for `UserManager`, `AdminCommands`
+                or `requires_usergroup`.
+    """
+    directory = tempfile.mkdtemp(prefix="ownbot-")
+    tenant = os.path.basename(directory)
+    with _STORES_LOCK:
+        _TEMPORARY_DIRS[tenant] = directory
+    try:
+        yield tenant
+    finally:
+        with _STORES_LOCK:
+            _TEMPORARY_DIRS.pop(tenant, None)
+        _drop_store(os.path.join(directory, "users.yml"))
+        shutil.rmtree(directory)
+
+
+def _hash_token(token):
+    """Returns the hash an invite token is stored as.
+
+        Args:
+            token (str): The invite token.
+
+        Returns:
+            str: The token's SHA-256 hex digest.
+    """
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def _current_transaction(path):
+    """Returns the transaction of the current thread.
+
+        Args:
+            path (str): The configuration file's path.
+
+        Returns:
+            _Transaction: The running transaction or None.
+    """
+    return getattr(_LOCAL, "transactions", {}).get(path)
+
+
+def _logged(func):
+    """
+        Records calls of the decorated mutation in the log of the
+        running transaction so that they can be replayed.
+    """
+
+    @wraps(func)
+    def call(self, *args, **kwargs):
+        result = func(self, *args, **kwargs)
+        transaction = _current_transaction(self.USERS_CONF_PATH)
+        if transaction is not None:
+            transaction.log.append((call, args, kwargs, result))
+        return result
+
+    return call
+
+
+def _writes(func):
+    """
+        Runs the decorated method holding the write lock.
+    """
+
+    @wraps(func)
+    def call(self, *args, **kwargs):
+        with _get_store(self.USERS_CONF_PATH).lock:
+            return func(self, *args, **kwargs)
+
+    return call
+
 
 class UserManager(object):  # pylint: disable=too-few-public-methods
     """
         Provides functions to save and load
         ownbot users.
+
+        Args:
+            tenant (Optional[str]): The name of an independent set of
+                users, e.g. per bot. Its users are stored in
+                `CONFIG_DIR_PATH/tenants/<tenant>/users.yml` or in the
+                directory of a tenant created by `temporary_store`.
+                Defaults to the tenant set with `using_tenant` or the
+                default users in `USERS_CONF_PATH`.
+
+        Note:
+            All methods are thread-safe. The users are published as
+            immutable snapshots: lookups read the current snapshot
+            without any locking while mutations are serialized by
+            a write lock and swap in a new snapshot when done.
+
+            Use `transaction` to apply several mutations at once.
     """
     CONFIG_DIR_PATH = os.path.join(os.path.expanduser("~"), ".ownbot")
     USERS_CONF_PATH = os.path.join(
         os.path.expanduser("~"), ".ownbot", "users.yml")
 
-    UNVERIFIED = "unverified"
-    VERIFIED = "users"
-
-    def __init__(self):
-        self.__config = None
+    UNVERIFIED = snapshot.UNVERIFIED
+    VERIFIED = snapshot.VERIFIED
+    EXPIRES = snapshot.EXPIRES
+    INVITED = snapshot.INVITED
+    INVITES = snapshot.INVITES
+    MODIFIED = snapshot.MODIFIED
+    CHATS = snapshot.CHATS
+
+    INVITE_PREFIX = "inv_"
+    # Seconds an invite token is valid by default.
+    INVITE_TTL = 7 * 24 * 60 * 60
+
+    # Path of a binary snapshot for ownbot.mapped.MappedSnapshot
+    # which is written after every change. None disables it. The
+    # snapshot of a tenant is written to a file of the same name in
+    # the tenant's directory.
+    MAPPED_SNAPSHOT_PATH = None
+
+    # Seconds after which unverified users are removed again.
+    # None keeps them forever.
+    UNVERIFIED_TTL = 30 * 24 * 60 * 60
+
+    # The number of backups kept by `backup`
+    BACKUP_COUNT = 10
+
+    # Bytes the loaded users of all tenants may use. The users of
+    # the least recently used tenants are dropped from memory and
+    # loaded again when needed. None keeps all users in memory.
+    MEMORY_BUDGET = None
+
+    def __init__(self, tenant=None):
+        if tenant is None:
+            tenant = get_tenant()
+
+        if tenant is not None:
+            if not tenant or os.sep in tenant or tenant in (".", "..") \
+               or (os.altsep and os.altsep in tenant):
+                raise ValueError("Invalid tenant '{0}'".format(tenant))
+            temporary = _TEMPORARY_DIRS.get(tenant)
+            self.CONFIG_DIR_PATH = temporary or os.path.join(
+                self.CONFIG_DIR_PATH, "tenants", tenant)
+            self.USERS_CONF_PATH = os.path.join(self.CONFIG_DIR_PATH,
+                                                "users.yml")
+            if temporary is not None:
+                self.MAPPED_SNAPSHOT_PATH = None
+            elif self.MAPPED_SNAPSHOT_PATH is not None:
+                self.MAPPED_SNAPSHOT_PATH = os.path.join(
+                    self.CONFIG_DIR_PATH,
+                    os.path.basename(self.MAPPED_SNAPSHOT_PATH))
+        self.tenant = tenant
 
         # create config dir if it doesn't already exist
         if not os.path.exists(self.CONFIG_DIR_PATH):
-            os.mkdir(self.CONFIG_DIR_PATH)
+            try:
+                if tenant is None:
+                    os.mkdir(self.CONFIG_DIR_PATH)
+                else:
+                    os.makedirs(self.CONFIG_DIR_PATH)
+            except OSError:
+                # another thread created it in the meantime
+                if not os.path.isdir(self.CONFIG_DIR_PATH):
+                    raise
 
+    @property
+    def __store(self):
+        """
+            Returns the store of the configuration file.
+        """
+        return _get_store(self.USERS_CONF_PATH)
+
+    def __file_stamp(self):
+        """Returns the state of the configuration file.
+
+            Returns:
+                tuple: The file's inode, modification time and size
+                    or None if the file does not exist.
+        """
+        try:
+            stat = os.stat(self.USERS_CONF_PATH)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_mtime, stat.st_size
+
+    @tracing.traced("storage.load")
     def __load_config(self):
         """Loads the configuration file.
 
-            Loads all usergroups and users as a dict from
-            the configuration file into the config attribute.
+            Publishes a new snapshot of all usergroups and users if
+            the configuration file changed since the current snapshot
+            was loaded.
         """
-        if not os.path.exists(self.USERS_CONF_PATH):
-            self.__config = {}
+        tracing.set_attribute("path", self.USERS_CONF_PATH)
+        store = self.__store
+        generation = store.generation
+        current = store.snapshot
+        if generation % 2 and current is not None:
+            # A write is in progress, the snapshot is newer than the file.
+            tracing.set_attribute("cache_hit", True)
+            return
+
+        stamp = self.__file_stamp()
+        if current is not None and stamp is not None \
+           and stamp == store.stamp:
+            tracing.set_attribute("cache_hit", True)
             return
 
-        with open(self.USERS_CONF_PATH, "r") as config_file:
-            config = yaml.load(config_file)
-            if not config:
-                self.__config = {}
+        tracing.set_attribute("cache_hit", False)
+        if not os.path.exists(self.USERS_CONF_PATH):
+            if current is not None and not current.config \
+               and store.stamp is None:
                 return
+            stamp, config = None, {}
+        else:
+            started = CLOCK()
+            try:
+                store.reads += 1
+                with open(self.USERS_CONF_PATH, "r") as config_file:
+                    text = config_file.read()
+                tracing.set_attribute("bytes_read", len(text))
+                config = yaml.safe_load(text) or {}
+            except yaml.YAMLError:
+                # A half written file can't be parsed.
+                if store.generation == generation:
+                    raise
+                return
+            finally:
+                profiling.add_storage_time(CLOCK() - started)
+
+        # Discard what was read if a writer touched the file meanwhile.
+        # Without a snapshot it is published unless a writer already
+        # published one.
+        if store.generation != generation and current is not None:
+            return
+
+        if not store.publish(snapshot.Snapshot(config, current), stamp,
+                             expected=current, check=True):
+            return
 
-            self.__config = config
+        if self.MEMORY_BUDGET is not None:
+            _evict_cold_stores(store, self.MEMORY_BUDGET)
+        self.__export()
+        if self.__next_sweep() is not None:
+            self.__wake_sweeper()
 
+    @tracing.traced("storage.save")
     def __save_config(self):
         """Saves the configuration.
 
-            Saves the config attribute to the configuration
-            file.
+            Saves the current snapshot to the configuration file.
+            The snapshot is written to a temporary file which replaces
+            the configuration file, so the file is never seen half
+            written.
+        """
+        started = CLOCK()
+        self.__store.writes += 1
+        text = yaml.dump(self.__store.snapshot.config)
+        tracing.set_attribute("bytes_written", len(text))
+        # Writers of this process hold the write lock, so the pid
+        # makes the name unique.
+        tmp_path = "{0}.{1}.tmp".format(self.USERS_CONF_PATH, os.getpid())
+        with open(tmp_path, "w") as config_file:
+            config_file.write(text)
+        compat.replace(tmp_path, self.USERS_CONF_PATH)
+        self.__store.stamp = self.__file_stamp()
+        profiling.add_storage_time(CLOCK() - started)
+
+    def __get_snapshot(self):
+        """Returns the current snapshot.
+
+            Returns:
+                ownbot.snapshot.Snapshot: The snapshot which is up
+                    to date with the configuration file or the
+                    working snapshot of the running transaction.
+        """
+        transaction = _current_transaction(self.USERS_CONF_PATH)
+        if transaction is not None:
+            return transaction.snapshot
+
+        store = self.__store
+        while True:
+            store.last_used = CLOCK()
+            self.__load_config()
+            current = store.snapshot
+            # None if another thread evicted it meanwhile
+            if current is not None:
+                return current
+
+    def __begin(self, group):
+        """Starts the modification of a group.
+
+            Must be called holding the write lock. Sets the
+            group's modification time.
+
+            Args:
+                group (str): The group which will be modified.
+
+            Returns:
+                dict: A copy of the configuration where only the given
+                    group is copied deeply and can be modified.
+        """
+        config = dict(self.__get_snapshot().config)
+        config[group] = copy.deepcopy(config.get(group) or {})
+        config[group][self.MODIFIED] = time.time()
+        return config
+
+    def __commit(self, config, expiries=()):
+        """Publishes and saves a modified configuration.
+
+            Must be called holding the write lock. Readers see the new
+            snapshot immediately and never wait for the file to be written.
+
+            Args:
+                config (dict): The modified configuration.
+                expiries (Optional[list]): The (expires, group, username)
+                    tuples of the added expiring memberships. If None,
+                    all expiry times are taken from the configuration.
+        """
+        transaction = _current_transaction(self.USERS_CONF_PATH)
+        if transaction is not None:
+            # Only the transaction sees the change until it is done
+            transaction.snapshot = snapshot.Snapshot(config,
+                                                     transaction.snapshot)
+            if expiries is None:
+                transaction.reindex = True
+            else:
+                transaction.expiries.extend(expiries)
+            return
+
+        store = self.__store
+        store.generation += 1
+        try:
+            store.publish(snapshot.Snapshot(config, store.snapshot), None,
+                          expiries=expiries)
+            self.__save_config()
+            self.__export()
+        finally:
+            store.generation += 1
+
+        if self.__next_sweep() is not None:
+            self.__wake_sweeper()
+
+    def __export(self):
+        """Writes the binary snapshot if `MAPPED_SNAPSHOT_PATH` is set.
+
+            Readers and writers export after publishing. The snapshot
+            which is current while holding the export lock is written,
+            so an export which lost the race never replaces the file
+            of a newer snapshot.
         """
-        with open(self.USERS_CONF_PATH, "w+") as config_file:
-            config_file.write(yaml.dump(self.__config))
+        if self.MAPPED_SNAPSHOT_PATH is None:
+            return
 
-    def __clean_config(self, group=None):
+        store = self.__store
+        with store.export_lock:
+            current = store.snapshot
+            if current is None or current is store.exported:
+                return
+            try:
+                mapped.export(current.config, self.MAPPED_SNAPSHOT_PATH)
+            except (IOError, OSError):
+                logging.getLogger(__name__).exception(
+                    "Could not write the snapshot '%s'",
+                    self.MAPPED_SNAPSHOT_PATH)
+                return
+            store.exported = current
+
+    def __next_sweep(self):
+        """Returns when the next membership expires or invitation
+            becomes stale.
+
+            Returns:
+                float: The unix timestamp or None if there is
+                    nothing to sweep.
+        """
+        store = self.__store
+        due = store.expiries.peek()
+        current = store.snapshot
+        if self.UNVERIFIED_TTL is not None and current is not None and \
+           current.oldest_invite is not None:
+            stale = current.oldest_invite + self.UNVERIFIED_TTL
+            due = stale if due is None else min(due, stale)
+        return due
+
+    def __wake_sweeper(self):
+        """
+            Starts the sweeper which removes expired memberships.
+        """
+        store = self.__store
+        if store.sweeper is None:
+            # The sweeper must keep working on this file even if the
+            # class attributes are changed later on.
+            manager = copy.copy(self)
+            manager.CONFIG_DIR_PATH = self.CONFIG_DIR_PATH
+            manager.USERS_CONF_PATH = self.USERS_CONF_PATH
+            manager.MAPPED_SNAPSHOT_PATH = self.MAPPED_SNAPSHOT_PATH
+            with _STORES_LOCK:
+                if store.sweeper is None:
+                    store.sweeper = Sweeper(manager.sweep,
+                                            manager.__next_sweep)
+        store.sweeper.notify()
+
+    def __clean_config(self, config, group=None):
         """Removes empty values of keys in config.
 
             Removes all keys from the config which have
             empty lists or dicts as values.
 
             Args:
+                config (dict): The configuration to clean.
                 group (Optional[str]): The group key to clean.
         """
-        verified_present = self.VERIFIED in self.__config[group]
-        unverified_present = self.UNVERIFIED in self.__config[group]
+        verified_present = self.VERIFIED in config[group]
+        unverified_present = self.UNVERIFIED in config[group]
+        expires_present = self.EXPIRES in config[group]
+        invited_present = self.INVITED in config[group]
+        invites_present = self.INVITES in config[group]
+        chats_present = self.CHATS in config[group]
 
         if group:
-            if unverified_present and not self.__config[group][
-                    self.UNVERIFIED]:
-                self.__config[group].pop(self.UNVERIFIED, None)
+            if unverified_present and not config[group][self.UNVERIFIED]:
+                config[group].pop(self.UNVERIFIED, None)
+
+            if verified_present and not config[group][self.VERIFIED]:
+                config[group].pop(self.VERIFIED, None)
 
-            if verified_present and not self.__config[group][self.VERIFIED]:
-                self.__config[group].pop(self.VERIFIED, None)
+            if expires_present and not config[group][self.EXPIRES]:
+                config[group].pop(self.EXPIRES, None)
 
-        if not self.__config[group]:
-            self.__config.pop(group, None)
+            if invited_present and not config[group][self.INVITED]:
+                config[group].pop(self.INVITED, None)
+
+            if invites_present and not config[group][self.INVITES]:
+                config[group].pop(self.INVITES, None)
+
+            if chats_present:
+                chats = config[group][self.CHATS]
+                for chat_id in [chat_id for chat_id in chats
+                                if not chats[chat_id]]:
+                    chats.pop(chat_id)
+                if not chats:
+                    config[group].pop(self.CHATS, None)
+
+        # The modification time of a group without users is useless
+        if not [key for key in config[group] if key != self.MODIFIED]:
+            config.pop(group, None)
+
+    def __remove_user(self, config, group, username):
+        """Removes a user from a group of a configuration.
+
+            Args:
+                config (dict): The configuration. The group must be
+                    a copy which can be modified.
+                group (str): The user's group.
+                username (str): The user's name.
+        """
+        data = config.get(group)
+        if not data:
+            return
+
+        if data.get(self.VERIFIED):
+            data[self.VERIFIED][:] = [
+                usr for usr in data[self.VERIFIED]
+                if usr.get("username") != username
+            ]
+
+        if username in (data.get(self.UNVERIFIED) or []):
+            data[self.UNVERIFIED].remove(username)
+
+        if data.get(self.EXPIRES):
+            data[self.EXPIRES].pop(username, None)
+
+        if data.get(self.INVITED):
+            data[self.INVITED].pop(username, None)
+
+    @property
+    def storage_stats(self):
+        """Returns the storage access counters.
+
+            The counters are shared by all instances using the
+            same configuration file.
+
+            Returns:
+                dict: The number of times the configuration file was
+                    read and written.
+        """
+        store = self.__store
+        return {"reads": store.reads, "writes": store.writes}
 
     @property
     def config(self):
         """
             Returns the user configuration.
+
+            Note:
+                The returned dict is shared with all readers
+                and must not be modified.
         """
-        self.__load_config()
-        return self.__config
+        return self.__get_snapshot().config
 
     @config.setter
+    @_logged
+    @_writes
     def config(self, config):
         """
             Sets the user configuration.
         """
-        self.__config = config
-        self.__save_config()
+        self.__commit(copy.deepcopy(config), expiries=None)
+
+    @property
+    def backup_dir(self):
+        """
+            Returns the directory the backups are written to.
+        """
+        return os.path.join(self.CONFIG_DIR_PATH, "backups")
+
+    def backup(self):
+        """Writes a compressed backup of the users.
+
+            The backup is taken from the current snapshot, so it is
+            consistent and neither readers nor writers have to wait.
+            Only the newest `BACKUP_COUNT` backups are kept.
+
+            Returns:
+                str: The backup's path.
+        """
+        path = backup.write(self.__get_snapshot().config, self.backup_dir)
+        backup.rotate(self.backup_dir, self.BACKUP_COUNT)
+        return path
+
+    def get_backups(self):
+        """Lists the backups.
+
+            Returns:
+                list: The backups' paths, newest first.
+        """
+        return backup.list_backups(self.backup_dir)
 
+    @_logged
+    @_writes
+    def restore(self, path):
+        """Replaces the users with a backup.
+
+            The backup is validated before anything is changed. All
+            instances see the restored users immediately and running
+            transactions are replayed on them.
+
+            Args:
+                path (str): The backup's path, e.g. one returned
+                    by `get_backups`.
+
+            Raises:
+                ValueError: If the backup is not a valid configuration.
+        """
+        self.__commit(backup.read(path), expiries=None)
+        # The cached replies may show the replaced users
+        transaction = _current_transaction(self.USERS_CONF_PATH)
+        if transaction is None:
+            cache.clear_all()
+        else:
+            transaction.clear_caches = True
+
+    @tracing.traced("UserManager.userid_is_verified_in_group")
     def userid_is_verified_in_group(self, group, user_id):
         """
             Checks if a user id is in a group and
@@ -104,15 +738,10 @@ class UserManager(object):  # pylint: disable=too-few-public-methods
                 bool: True if the user was found in the
                     given group as verified, otherwise False.
         """
-        self.__load_config()
-
-        user_in_group = [
-            usr for usr in self.__config.get(group, {}).get(self.VERIFIED, [])
-            if usr.get("id") == user_id
-        ]
-
-        return bool(user_in_group)
+        data = self.__get_snapshot().group(group)
+        return user_id in data.ids and not data.is_expired(user_id=user_id)
 
+    @tracing.traced("UserManager.username_is_verified_in_group")
     def username_is_verified_in_group(self, group, username):
         """
             Checks if a username is in a group and
@@ -126,15 +755,11 @@ class UserManager(object):  # pylint: disable=too-few-public-methods
                 bool: True if the user was found in the
                     given group as verified, otherwise False.
         """
-        self.__load_config()
-
-        user_in_group = [
-            usr for usr in self.__config.get(group, {}).get(self.VERIFIED, [])
-            if usr.get("username") == username
-        ]
-
-        return bool(user_in_group)
+        data = self.__get_snapshot().group(group)
+        return username in data.names and \
+            not data.is_expired(username=username)
 
+    @tracing.traced("UserManager.user_is_unverified_in_group")
     def user_is_unverified_in_group(self, group, username):
         """
             Checks if a user is in a group and
@@ -148,12 +773,13 @@ class UserManager(object):  # pylint: disable=too-few-public-methods
                 bool: True if the user was found in the
                     given group as verified, otherwise False.
         """
-        self.__load_config()
-        unverified_users = self.__config.get(group, {}).get(self.UNVERIFIED,
-                                                            [])
-        return username in unverified_users
+        data = self.__get_snapshot().group(group)
+        return username in data.unverified and \
+            not data.is_expired(username=username)
 
-    def user_is_in_group(self, group, user_id=None, username=None):
+    @tracing.traced("UserManager.user_is_in_group")
+    def user_is_in_group(self, group, user_id=None, username=None,
+                         chat_id=None):
         """
             Checks if a user is in a specific
             group.
@@ -162,6 +788,9 @@ class UserManager(object):  # pylint: disable=too-few-public-methods
                 group (str): The group to look for the user.
                 user_id (Optional[str]): The user's unique id.
                 username (Optional[str]): The user's name.
+                chat_id (Optional[int]): The chat whose grants count
+                    in addition to the group's global members. Only
+                    used together with the user_id.
 
             Note:
                 If the user_id is passed, only the verified users
@@ -173,20 +802,211 @@ class UserManager(object):  # pylint: disable=too-few-public-methods
                 bool: True if the user id was found in
                     the given group, otherwise False.
         """
-        self.__load_config()
+        current = self.__get_snapshot()
 
-        if group not in self.__config or (user_id is None and
-                                          username is None):
+        if group not in current.groups or (user_id is None and
+                                           username is None):
             return False
 
+        data = current.group(group)
         if user_id:
-            return self.userid_is_verified_in_group(group, user_id)
+            return group in current.grants(user_id, chat_id)
+
+        is_in_verified = username in data.names
+        is_in_unverified = username in data.unverified
+
+        return (is_in_verified or is_in_unverified) and \
+            not data.is_expired(username=username)
+
+    @tracing.traced("UserManager.get_user_groups")
+    def get_user_groups(self, user_id, chat_id=None):
+        """Get the groups of a verified user.
+
+            Args:
+                user_id (str): The user's unique id.
+                chat_id (Optional[int]): The chat whose grants are
+                    returned in addition to the global memberships.
+
+            Returns:
+                frozenset: The names of the groups.
+        """
+        return self.__get_snapshot().grants(user_id, chat_id)
+
+    @tracing.traced("UserManager.grant_in_chat")
+    @_logged
+    @_writes
+    def grant_in_chat(self, user_id, group, chat_id):
+        """Adds a user to a group within a single chat.
+
+            The user has the group's permissions in the given chat only,
+            e.g. a moderator of a group chat. The group's global
+            members keep their permissions in every chat.
+
+            Args:
+                user_id (int): The user's unique id.
+                group (str): The group's name.
+                chat_id (int): The chat's id.
+
+            Returns:
+                bool: True if the user was added, False if the user
+                    already has the grant.
+        """
+        current = self.__get_snapshot().group(group)
+        if user_id in (current.chats.get(chat_id) or ()):
+            return False
+
+        config = self.__begin(group)
+        config[group].setdefault(self.CHATS, {}).setdefault(
+            chat_id, []).append(user_id)
+        self.__commit(config)
+        return True
+
+    @tracing.traced("UserManager.revoke_in_chat")
+    @_logged
+    @_writes
+    def revoke_in_chat(self, user_id, group, chat_id):
+        """Removes a user's grant of a group within a chat.
+
+            Args:
+                user_id (int): The user's unique id.
+                group (str): The group's name.
+                chat_id (int): The chat's id.
+
+            Returns:
+                bool: True if the grant was removed, otherwise False.
+        """
+        current = self.__get_snapshot().group(group)
+        if user_id not in (current.chats.get(chat_id) or ()):
+            return False
+
+        config = self.__begin(group)
+        config[group][self.CHATS][chat_id].remove(user_id)
+        self.__clean_config(config, group=group)
+        self.__commit(config)
+        return True
+
+    @tracing.traced("UserManager.get_chat_grants")
+    def get_chat_grants(self, chat_id=None):
+        """Get the grants within chats.
+
+            Args:
+                chat_id (Optional[int]): Only returns the grants of
+                    this chat.
+
+            Returns:
+                list: A dict with the `group`, the `chat_id` and the
+                    user's `id` per grant, sorted by group and chat.
+        """
+        return [{"group": name, "chat_id": chat, "id": user_id}
+                for name, group in
+                sorted(self.__get_snapshot().groups.items())
+                for chat, user_ids in sorted(group.chats.items())
+                if chat_id is None or chat == chat_id
+                for user_id in user_ids]
+
+    @contextmanager
+    def transaction(self, retries=3):
+        """Applies all mutations of a block at once.
+
+            Lookups within the block see the block's mutations, other
+            threads don't see them until the block is done. The
+            configuration is loaded once at the start and saved once
+            at the end.
+
+            No lock is held while the block runs. If the configuration
+            was changed meanwhile, by another thread or by another
+            process, the logged mutations are replayed on the changed
+            configuration. The replay fails if a mutation returns
+            another result than it did in the block, because the block
+            may have relied on it. Tokens of `create_invite` always
+            differ.
+
+            Transactions nest: an inner block is part of the outer one.
+
+            Args:
+                retries (Optional[int]): How often the mutations are
+                    replayed before giving up.
+
+            Yields:
+                UserManager: This user manager.
+
+            Raises:
+                TransactionConflict: If the mutations could not be
+                    applied to the changed configuration.
+        """
+        if _current_transaction(self.USERS_CONF_PATH) is not None:
+            yield self
+            return
+
+        store = self.__store
+        base = self.__get_snapshot()
+        transaction = _Transaction(base, store.version)
+        self.__set_transaction(transaction)
+        try:
+            yield self
+        finally:
+            self.__set_transaction(None)
+
+        self.__finish(transaction, retries)
+
+    def __set_transaction(self, transaction):
+        """Sets the transaction of the current thread.
+
+            Args:
+                transaction (_Transaction): The transaction or None
+                    to clear it.
+        """
+        transactions = getattr(_LOCAL, "transactions", None)
+        if transactions is None:
+            transactions = _LOCAL.transactions = {}
+
+        if transaction is None:
+            transactions.pop(self.USERS_CONF_PATH, None)
+        else:
+            transactions[self.USERS_CONF_PATH] = transaction
 
-        is_in_verified = self.username_is_verified_in_group(group, username)
-        is_in_unverified = self.user_is_unverified_in_group(group, username)
+    @_writes
+    def __finish(self, transaction, retries):
+        """Commits a transaction, replaying it if necessary.
 
-        return is_in_verified or is_in_unverified
+            Args:
+                transaction (_Transaction): The finished transaction.
+                retries (int): How often the mutations are replayed.
+        """
+        store = self.__store
+        for attempt in range(retries + 1):
+            # Picks up changes of other processes
+            self.__load_config()
+            if store.version == transaction.version:
+                if transaction.snapshot is not transaction.base:
+                    self.__commit(transaction.snapshot.config,
+                                  None if transaction.reindex
+                                  else transaction.expiries)
+                if transaction.clear_caches:
+                    cache.clear_all()
+                return
 
+            if attempt == retries:
+                break
+
+            replay = _Transaction(self.__get_snapshot(), store.version)
+            self.__set_transaction(replay)
+            try:
+                for func, args, kwargs, result in transaction.log:
+                    if func(self, *args, **kwargs) != result:
+                        raise TransactionConflict(
+                            "'{0}' returned another result when replayed"
+                            .format(func.__name__))
+            finally:
+                self.__set_transaction(None)
+            transaction = replay
+
+        raise TransactionConflict(
+            "The configuration was modified {0} times while committing"
+            .format(retries + 1))
+
+    @tracing.traced("UserManager.verify_user")
+    @_logged
     def verify_user(self, user_id, username, group):
         """Verifies a user.
 
@@ -199,27 +1019,39 @@ class UserManager(object):  # pylint: disable=too-few-public-methods
                 username (str): The user's name.
                 group (str): The group's name.
         """
-        self.__load_config()
+        # Check the snapshot first so that unknown users
+        # never wait for the write lock.
+        if not self.user_is_unverified_in_group(group, username):
+            return False
+
+        return self.__verify_user(user_id, username, group)
 
-        if group not in self.__config \
-           or self.UNVERIFIED not in self.__config[group] \
-           or username not in self.__config[group][self.UNVERIFIED]:
+    @_writes
+    def __verify_user(self, user_id, username, group):
+        """
+            Moves a user from the unverified to the verified users.
+        """
+        if not self.user_is_unverified_in_group(group, username):
             return False
 
-        self.__config[group][self.UNVERIFIED].remove(username)
+        config = self.__begin(group)
+        config[group][self.UNVERIFIED].remove(username)
+        config[group].get(self.INVITED, {}).pop(username, None)
 
-        if not self.VERIFIED in self.__config[group]:
-            self.__config[group][self.VERIFIED] = []
+        if not self.VERIFIED in config[group]:
+            config[group][self.VERIFIED] = []
 
-        self.__config[group][self.VERIFIED].append({
+        config[group][self.VERIFIED].append({
             "id": user_id,
             "username": username
         })
-        self.__clean_config(group=group)
-        self.__save_config()
+        self.__clean_config(config, group=group)
+        self.__commit(config)
         return True
 
-    def add_user(self, username, group, user_id=None):
+    @tracing.traced("UserManager.add_user")
+    @_logged
+    def add_user(self, username, group, user_id=None, expires=None):
         """
             Adds a user to the unverified users in a
             group.
@@ -228,6 +1060,8 @@ class UserManager(object):  # pylint: disable=too-few-public-methods
                 username (str): The user's name.
                 group (str): The user's group.
                 user_id (Optional[str]): The user's id.
+                expires (Optional[float]): The unix timestamp at which
+                    the user is removed from the group again.
 
             Note:
                 Adding a user and adding a user to a group
@@ -237,39 +1071,66 @@ class UserManager(object):  # pylint: disable=too-few-public-methods
                 automatically gets added to the verfied users
                 of the group.
 
+                An expired membership counts as absent right away and
+                is removed from the configuration in the background.
+                So are unverified users who don't show up within
+                `UNVERIFIED_TTL` seconds.
+
             Returns:
                 bool: True if the user was added to the
                     group, otherwise False.
         """
-        self.__load_config()
+        # Check the snapshot first so that users which are already
+        # in the group never wait for the write lock.
+        if self.user_is_in_group(group, username=username):
+            return False
 
+        return self.__add_user(username, group, user_id, expires)
+
+    @_writes
+    def __add_user(self, username, group, user_id, expires):
+        """
+            Adds a user to a group.
+        """
         # Check if user is already in this group
         if self.user_is_in_group(group, username=username):
             return False
 
-        if not self.__config.get(group, None):
-            self.__config[group] = {}
+        config = self.__begin(group)
+        # Drop what is left of an expired membership
+        self.__remove_user(config, group, username)
+
+        expiries = []
+        if expires is not None:
+            config[group].setdefault(self.EXPIRES, {})[username] = expires
+            expiries.append((expires, group, username))
 
         # Add the user to the verified users of the group
         # if the user_id was passed
         if user_id:
-            if self.VERIFIED not in self.__config[group]:
-                self.__config[group][self.VERIFIED] = []
+            if self.VERIFIED not in config[group]:
+                config[group][self.VERIFIED] = []
 
-            self.__config[group][self.VERIFIED].append({
+            config[group][self.VERIFIED].append({
                 "id": user_id,
                 "username": username
             })
-            self.__save_config()
+            self.__clean_config(config, group=group)
+            self.__commit(config, expiries)
             return True
 
-        if not self.UNVERIFIED in self.__config[group]:
-            self.__config[group][self.UNVERIFIED] = []
+        if not self.UNVERIFIED in config[group]:
+            config[group][self.UNVERIFIED] = []
 
-        self.__config[group][self.UNVERIFIED].append(username)
-        self.__save_config()
+        config[group][self.UNVERIFIED].append(username)
+        config[group].setdefault(self.INVITED, {})[username] = time.time()
+        self.__clean_config(config, group=group)
+        self.__commit(config, expiries)
         return True
 
+    @tracing.traced("UserManager.rm_user")
+    @_logged
+    @_writes
     def rm_user(self, username, group):
         """
             Removes a user from a group.
@@ -281,32 +1142,253 @@ class UserManager(object):  # pylint: disable=too-few-public-methods
             Returns:
                 bool: True if user was removed, otherwise False.
         """
-        self.__load_config()
-
         if not self.username_is_verified_in_group(group, username)\
            and not self.user_is_unverified_in_group(group, username):
             return False
 
-        if self.username_is_verified_in_group(group, username):
-            self.__config[group][self.VERIFIED][:] = [
-                usr for usr in self.__config.get(group).get(self.VERIFIED)
-                if usr.get("username") != username
-            ]
-            self.__save_config()
+        config = self.__begin(group)
+        self.__remove_user(config, group, username)
+        self.__clean_config(config, group=group)
+        self.__commit(config)
 
-        if self.user_is_unverified_in_group(group, username):
-            self.__config[group][self.UNVERIFIED].remove(username)
+        return True
 
-        self.__clean_config(group=group)
-        self.__save_config()
+    @tracing.traced("UserManager.sweep")
+    @_writes
+    def sweep(self, now=None):
+        """Removes expired memberships, stale unverified users and
+            expired invite tokens.
 
-        return True
+            Everything due is removed with a single write. Is called
+            by a background thread, so there is usually no need to
+            call it.
+
+            Args:
+                now (Optional[float]): The current unix timestamp.
+
+            Returns:
+                int: The number of removed memberships and invite tokens.
+        """
+        if now is None:
+            now = time.time()
+
+        current = self.__get_snapshot()
+        removed = set()
+        invites = set()
+        for expires, group, key in self.__store.expiries.pop_due(now):
+            # The membership may have been removed or renewed meanwhile
+            if current.group(group).expires.get(key) == expires:
+                removed.add((group, key))
+            elif current.group(group).invites.get(key) == expires:
+                invites.add((group, key))
+
+        ttl = self.UNVERIFIED_TTL
+        if ttl is not None and current.oldest_invite is not None and \
+           current.oldest_invite + ttl <= now:
+            for group, data in current.groups.items():
+                if data.oldest_invite is None or \
+                   data.oldest_invite + ttl > now:
+                    continue
+                removed.update(
+                    (group, username)
+                    for username, invited in data.invited.items()
+                    if username in data.unverified and invited + ttl <= now)
+
+        if not removed and not invites:
+            return 0
+
+        config = dict(current.config)
+        for group, key in removed | invites:
+            if config.get(group) is current.config.get(group):
+                config[group] = copy.deepcopy(config[group])
+                config[group][self.MODIFIED] = now
+            if (group, key) in invites:
+                config[group][self.INVITES].pop(key, None)
+            else:
+                self.__remove_user(config, group, key)
+
+        for group in set(group for group, _ in removed | invites):
+            self.__clean_config(config, group=group)
+        self.__commit(config)
+
+        logging.getLogger(__name__).info(
+            "Removed %d expired memberships and stale unverified users"
+            " and %d expired invite tokens", len(removed), len(invites))
+        return len(removed) + len(invites)
+
+    @tracing.traced("UserManager.create_invite")
+    @_logged
+    @_writes
+    def create_invite(self, group, expires=None):
+        """Creates a one-time invite token for a group.
+
+            Only the token's hash is stored, so the token can't be
+            recovered from the configuration file.
+
+            Args:
+                group (str): The group the token invites to.
+                expires (Optional[float]): The unix timestamp at which
+                    the token becomes invalid. Defaults to `INVITE_TTL`
+                    seconds from now.
+
+            Returns:
+                str: The token. Fits into a `/start` deep link.
+        """
+        if expires is None:
+            expires = time.time() + self.INVITE_TTL
+
+        token = self.INVITE_PREFIX + base64.urlsafe_b64encode(
+            os.urandom(18)).decode("ascii")
+        digest = _hash_token(token)
+
+        config = self.__begin(group)
+        config[group].setdefault(self.INVITES, {})[digest] = expires
+        self.__commit(config, [(expires, group, digest)])
+        return token
+
+    def __find_invite(self, digest):
+        """Looks up a valid invite token.
+
+            Args:
+                digest (str): The hash of the token.
+
+            Returns:
+                str: The group the token invites to or None if the
+                    token doesn't exist or expired.
+        """
+        invite = self.__get_snapshot().find_invite(digest)
+        if invite is None or invite[1] <= time.time():
+            return None
+        return invite[0]
+
+    @tracing.traced("UserManager.redeem_invite")
+    @_logged
+    def redeem_invite(self, token, user_id, username):
+        """Adds a user to a group with an invite token.
+
+            The user is added to the verified users and the
+            token can't be used again.
+
+            Args:
+                token (str): The invite token.
+                user_id (str): The user's unique id.
+                username (str): The user's name.
+
+            Returns:
+                str: The group the user was added to or None if the
+                    token is invalid or expired.
+        """
+        digest = _hash_token(token)
+        # Check the snapshot first so that invalid tokens
+        # never wait for the write lock.
+        if self.__find_invite(digest) is None:
+            return None
+
+        return self.__redeem_invite(digest, user_id, username)
+
+    @_writes
+    def __redeem_invite(self, digest, user_id, username):
+        """
+            Consumes an invite token and adds the user to its group.
+        """
+        group = self.__find_invite(digest)
+        if group is None:
+            return None
+
+        config = self.__begin(group)
+        config[group][self.INVITES].pop(digest)
+
+        if username in (config[group].get(self.UNVERIFIED) or []):
+            config[group][self.UNVERIFIED].remove(username)
+            config[group].get(self.INVITED, {}).pop(username, None)
 
+        if not self.userid_is_verified_in_group(group, user_id):
+            config[group].setdefault(self.VERIFIED, []).append({
+                "id": user_id,
+                "username": username
+            })
+
+        self.__clean_config(config, group=group)
+        self.__commit(config)
+        return group
+
+    @tracing.traced("UserManager.find_users")
+    def find_users(self, prefix, limit=50):
+        """Finds users by a prefix of their name or id.
+
+            Args:
+                prefix (str): The prefix. Case and a leading @ are
+                    ignored.
+                limit (Optional[int]): The maximum number of results.
+
+            Returns:
+                list: A dict with the `group`, the `username` and the
+                    `id` per matching user. The id of unverified users
+                    is None.
+        """
+        return [{"group": group, "username": username, "id": user_id}
+                for group, username, user_id in
+                self.__get_snapshot().find_users(prefix, limit)]
+
+    @tracing.traced("UserManager.get_group_stats")
+    def get_group_stats(self):
+        """Get the statistics of all groups.
+
+            Returns:
+                list: A dict with the group's `name`, the number of
+                    `verified` and `unverified` users and the unix
+                    timestamp the group was last `modified` at per
+                    group, sorted by name. The timestamp is None if
+                    it is unknown.
+        """
+        return self.__get_snapshot().stats()
+
+    def preload(self):
+        """Loads the users and builds all indexes.
+
+            Lookups after a preload don't have to read the
+            configuration file or build an index first.
+
+            Returns:
+                dict: The number of `groups` and `users` and the
+                    estimated `size` of the snapshot in bytes.
+        """
+        current = self.__get_snapshot()
+        current.find_users("", limit=1)
+        current.find_invite("")
+        current.grants(None)
+        return {"groups": len(current.groups),
+                "users": sum(group.verified_count + group.unverified_count
+                             for group in current.groups.values()),
+                "size": current.size}
+
+    @tracing.traced("UserManager.get_pending_users")
+    def get_pending_users(self):
+        """Get all unverified users.
+
+            Returns:
+                list: A dict with the `group`, the `username` and the
+                    unix timestamp the user was `invited` at per
+                    unverified user, the oldest first. The timestamp
+                    is None if it is unknown.
+        """
+        pending = [
+            {"group": group, "username": username,
+             "invited": data.invited.get(username)}
+            for group, data in self.__get_snapshot().groups.items()
+            for username in data.data.get(self.UNVERIFIED) or []
+            if not data.is_expired(username=username)
+        ]
+        pending.sort(key=lambda usr: (usr["invited"] is not None,
+                                      usr["invited"] or 0))
+        return pending
+
+    @tracing.traced("UserManager.group_is_empty")
     def group_is_empty(self, group):
         """Checks if given group is empty.
 
             Checks if the passed group has any users
-            or is completely empty.
+            or is completely empty. Invite tokens don't count.
 
             Args:
                 group (str): The group to be checked.
@@ -314,10 +1396,66 @@ class UserManager(object):  # pylint: disable=too-few-public-methods
             Returns:
                 bool: True if the group is emtpy, otherwise False.
         """
-        self.__load_config()
-        self.__config.get(group)
-        return not bool(self.__config.get(group))
+        data = self.__get_snapshot().group(group).data
+        return not (data.get(self.VERIFIED) or data.get(self.UNVERIFIED))
+
+    def iter_users(self, groups, mode=snapshot.UNION, verified=True,
+                   unverified=False):
+        """Streams the users of one or several groups.
+
+            The users are read from the snapshot current at the first
+            step, so changes made while iterating don't show up.
+            Verified users are identified by their id and unverified
+            users by their name; each is yielded once.
+
+            Args:
+                groups (str or list): The group's or groups' names.
+                mode (Optional[str]): "union" yields the users of any of
+                    the groups, "intersection" the users of all.
+                verified (Optional[bool]): Yields the verified users.
+                unverified (Optional[bool]): Yields the unverified users.
+
+            Yields:
+                dict: The user's `username` and `id`. The id of
+                    unverified users is None.
+
+            Raises:
+                ValueError: If the mode is unknown.
+        """
+        # a single group's name, also as unicode on python 2
+        if isinstance(groups, (type(u""), str)):
+            groups = [groups]
+        for username, user_id in self.__get_snapshot().iter_users(
+                groups, mode, verified=verified, unverified=unverified):
+            yield {"username": username, "id": user_id}
+
+    @tracing.traced("UserManager.count_users")
+    def count_users(self, groups, mode=snapshot.UNION, verified=True,
+                    unverified=False):
+        """Counts the users `iter_users` yields in constant memory.
+
+            A single group is counted in O(1) and repeated counts are
+            kept with the snapshot unless memberships expire.
+
+            Args:
+                groups (str or list): The group's or groups' names.
+                mode (Optional[str]): "union" or "intersection".
+                verified (Optional[bool]): Counts the verified users.
+                unverified (Optional[bool]): Counts the unverified users.
+
+            Returns:
+                int: The number of users.
+
+            Raises:
+                ValueError: If the mode is unknown.
+        """
+        # a single group's name, also as unicode on python 2
+        if isinstance(groups, (type(u""), str)):
+            groups = [groups]
+        return self.__get_snapshot().count_users(
+            groups, mode, verified=verified, unverified=unverified)
 
+    @tracing.traced("UserManager.get_users")
     def get_users(self, group):
         """Get all users from given group.
 
@@ -330,6 +1468,9 @@ class UserManager(object):  # pylint: disable=too-few-public-methods
             Returns:
                 list: Verified users from given group.
         """
-        self.__load_config()
-        group = self.__config.get(group, {})
-        return group.get(self.VERIFIED, [])
+        data = self.__get_snapshot().group(group)
+        users = data.data.get(self.VERIFIED, [])
+        if data.expires:
+            return [usr for usr in users
+                    if not data.is_expired(username=usr.get("username"))]
+        return list(users)
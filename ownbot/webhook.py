@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""
+    Provides a webhook server which feeds updates to a dispatcher.
+"""
+import json
+import logging
+import threading
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:  # python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from telegram import Update
+
+from ownbot.ratelimit import CLOCK
+
+# The largest request body accepted, Telegram's updates are far smaller
+MAX_BODY_SIZE = 1024 * 1024
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    """
+        HTTP server which handles every request in its own thread.
+    """
+    daemon_threads = True
+
+
+class WebhookRunner(object):
+    """Receives updates by webhook and dispatches them in a worker pool.
+
+        Telegram posts every update to `path`. The update is put into a
+        bounded queue and answered with 200 at once. If the queue is
+        full, the request is answered with 503 so Telegram retries it
+        later. `GET /metrics` returns the counters of `stats` as JSON.
+
+        Args:
+            dispatcher (telegram.ext.Dispatcher): The dispatcher with the
+                handlers, e.g. the `AdminCommands`.
+            port (int): The port to listen on. 0 picks a free port.
+            host (Optional[str]): The address to listen on.
+            path (Optional[str]): The path Telegram posts to. Use a
+                secret path, e.g. containing the bot's token.
+            workers (Optional[int]): The number of dispatching threads.
+            queue_size (Optional[int]): The maximum number of queued
+                updates.
+    """
+
+    def __init__(self, dispatcher, port, host="0.0.0.0", path="/",
+                 workers=4, queue_size=100):
+        self.dispatcher = dispatcher
+        self.path = path
+        self.workers = workers
+        self.__queue = queue.Queue(maxsize=queue_size)
+        self.__lock = threading.Lock()
+        self.__accepting = False
+        self.__threads = []
+        self.__counters = dict.fromkeys(
+            ("received", "rejected", "invalid", "processed", "failed",
+             "max_queued"), 0)
+        self.__wait = 0.0
+        self.__server = _Server((host, port), self.__make_handler())
+        self.__server_thread = None
+
+    @property
+    def address(self):
+        """
+            Returns the (host, port) tuple the server listens on.
+        """
+        return self.__server.server_address
+
+    @property
+    def stats(self):
+        """Returns the counters.
+
+            Returns:
+                dict: The number of `received`, `rejected` (queue full
+                    or draining), `invalid`, `processed` and `failed`
+                    updates, the current (`queued`) and the highest
+                    (`max_queued`) queue length and the average seconds
+                    an update waited in the queue (`average_wait`).
+        """
+        with self.__lock:
+            stats = dict(self.__counters)
+            done = stats["processed"] + stats["failed"]
+            stats["average_wait"] = self.__wait / done if done else 0.0
+        stats["queued"] = self.__queue.qsize()
+        return stats
+
+    def __count(self, name, value=1):
+        """
+            Increments a counter.
+        """
+        with self.__lock:
+            self.__counters[name] += value
+
+    def submit(self, update):
+        """Queues an update without waiting.
+
+            Args:
+                update (telegram.Update): The update.
+
+            Returns:
+                bool: True if the update was queued, False if the queue
+                    is full or the runner is draining.
+        """
+        if not self.__accepting:
+            self.__count("rejected")
+            return False
+        try:
+            self.__queue.put_nowait((update, CLOCK()))
+        except queue.Full:
+            self.__count("rejected")
+            return False
+
+        queued = self.__queue.qsize()
+        with self.__lock:
+            self.__counters["received"] += 1
+            self.__counters["max_queued"] = max(
+                self.__counters["max_queued"], queued)
+        return True
+
+    def post(self, body):
+        """Parses and queues a posted update.
+
+            Args:
+                body (bytes): The request body.
+
+            Returns:
+                int: The HTTP status, 200 if the update was queued, 400
+                    if the body is not an update and 503 if the queue
+                    is full or the runner is draining.
+        """
+        try:
+            if len(body) > MAX_BODY_SIZE:
+                raise ValueError("The body is too large")
+            update = Update.de_json(json.loads(body.decode("utf-8")),
+                                    self.dispatcher.bot)
+            if update is None:
+                raise ValueError("Empty update")
+        except Exception:  # pylint: disable=broad-except
+            self.__count("invalid")
+            return 400
+        return 200 if self.submit(update) else 503
+
+    def __make_handler(self):
+        """
+            Returns the request handler class of the server.
+        """
+        runner = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """
+                Receives the updates and serves the metrics.
+            """
+
+            def __reply(self, status, body, headers=()):
+                """
+                    Sends a JSON response.
+                """
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):  # pylint: disable=invalid-name
+                """
+                    Queues a posted update.
+                """
+                if self.path != runner.path:
+                    self.__reply(404, {"ok": False})
+                    return
+
+                length = int(self.headers.get("Content-Length") or 0)
+                status = runner.post(
+                    self.rfile.read(min(length, MAX_BODY_SIZE + 1)))
+                headers = [("Retry-After", "1")] if status == 503 else []
+                self.__reply(status, {"ok": status == 200}, headers)
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                """
+                    Returns the counters.
+                """
+                if self.path.split("?")[0] != "/metrics":
+                    self.__reply(404, {"ok": False})
+                    return
+                self.__reply(200, runner.stats)
+
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                """
+                    Keeps every request out of stderr.
+                """
+
+        return Handler
+
+    def __work(self):
+        """
+            Dispatches queued updates until None is received.
+        """
+        log = logging.getLogger(__name__)
+        while True:
+            item = self.__queue.get()
+            if item is None:
+                return
+            update, queued = item
+            wait = CLOCK() - queued
+            try:
+                self.dispatcher.process_update(update)
+            except Exception:  # pylint: disable=broad-except
+                log.exception("Processing the update %s failed",
+                              update.update_id)
+                name = "failed"
+            else:
+                name = "processed"
+            with self.__lock:
+                self.__counters[name] += 1
+                self.__wait += wait
+
+    def start(self, webhook_url=None):
+        """Starts the workers and the server.
+
+            Args:
+                webhook_url (Optional[str]): The public URL of `path`.
+                    If set, it is registered as the bot's webhook.
+        """
+        self.__accepting = True
+        for index in range(self.workers):
+            thread = threading.Thread(target=self.__work,
+                                      name="ownbot-webhook-{0}".format(index))
+            thread.daemon = True
+            thread.start()
+            self.__threads.append(thread)
+
+        self.__server_thread = threading.Thread(
+            target=self.__server.serve_forever, name="ownbot-webhook")
+        self.__server_thread.daemon = True
+        self.__server_thread.start()
+
+        if webhook_url is not None:
+            self.dispatcher.bot.setWebhook(webhook_url=webhook_url)
+
+    def stop(self, timeout=None):
+        """Stops accepting updates and drains the queue.
+
+            New updates are answered with 503, so Telegram keeps them
+            for the next start. The queued updates are still processed.
+
+            Args:
+                timeout (Optional[float]): Seconds to wait for each
+                    worker to finish.
+
+            Returns:
+                int: The number of updates left in the queue.
+        """
+        self.__accepting = False
+        if self.__server_thread is not None:
+            self.__server.shutdown()
+            self.__server_thread.join(timeout)
+        self.__server.server_close()
+
+        for _ in self.__threads:
+            try:
+                self.__queue.put(None, timeout=timeout)
+            except queue.Full:
+                break
+        for thread in self.__threads:
+            thread.join(timeout)
+        self.__threads = []
+
+        left = 0
+        while True:
+            try:
+                if self.__queue.get_nowait() is not None:
+                    left += 1
+            except queue.Empty:
+                return left
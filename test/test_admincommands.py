@@ -2,9 +2,10 @@
 """
     Provides a unit test class for the ownbot.admincommands module.
 """
+import time
 from datetime import datetime
 from unittest import TestCase
-from mock import patch, Mock
+from mock import DEFAULT, patch, Mock
 
 from telegram import Bot, Update, Message, User, Chat
 from telegram.ext import Dispatcher
@@ -27,9 +28,12 @@ def dummy_decorator(*_):
 
 
 import ownbot.auth
+import ownbot.usermanager
 ownbot.auth.requires_usergroup = dummy_decorator
 
 from ownbot.admincommands import AdminCommands
+from ownbot.broadcast import BroadcastResult
+from ownbot.messagequeue import MessageQueue
 
 
 class TestAdminCommands(TestCase):  # pylint: disable=too-many-public-methods
@@ -54,6 +58,26 @@ class TestAdminCommands(TestCase):  # pylint: disable=too-many-public-methods
             AdminCommands(dispatcher)
             self.assertTrue(dispatcher.add_handler.called)
 
+    def test_init_tenant(self):
+        """
+            Test that the commands manage the users of the tenant
+        """
+        tenants = []
+        with patch("ownbot.admincommands.UserManager") as usrmgr_mock:
+            usrmgr_mock.return_value.get_users.return_value = []
+            usrmgr_mock.side_effect = lambda *_: tenants.append(
+                ownbot.usermanager.get_tenant()) or DEFAULT
+            dispatcher = Mock(spec=Dispatcher)
+            AdminCommands(dispatcher, message_queue=Mock(spec=MessageQueue),
+                          tenant="foobot")
+            handlers = dict((call[0][0].command, call[0][0])
+                            for call in dispatcher.add_handler.call_args_list)
+            handlers["users"].callback(Mock(spec=Bot),
+                                       self.__get_dummy_update())
+
+        self.assertEqual(tenants[-1], "foobot")
+        self.assertIsNone(ownbot.usermanager.get_tenant())
+
     def test_admin_help(self):
         """
             Test admin help command
@@ -94,6 +118,235 @@ class TestAdminCommands(TestCase):  # pylint: disable=too-many-public-methods
                 bot, update)
         self.assertTrue(bot.sendMessage.called)
 
+    def test_get_groups(self):
+        """
+            Test groups command
+        """
+        bot = Mock(spec=Bot)
+        update = self.__get_dummy_update()
+
+        with patch("ownbot.admincommands.UserManager") as usrmgr_mock:
+            usrmgr_mock.return_value.get_group_stats.return_value = [
+                {"name": "bar_group", "verified": 0, "unverified": 1,
+                 "modified": None},
+                {"name": "foogroup", "verified": 2, "unverified": 0,
+                 "modified": 10 ** 9}
+            ]
+            AdminCommands._AdminCommands__get_groups(  # pylint: disable=no-member, protected-access
+                bot, update)
+        text = bot.sendMessage.call_args[1]["text"]
+        self.assertIn("bar\\_group: 0 verified, 1 unverified\n", text)
+        self.assertIn("foogroup: 2 verified, 0 unverified, modified 2001-09-", text)
+
+    def test_get_groups_none(self):
+        """
+            Test groups command if there are no groups
+        """
+        bot = Mock(spec=Bot)
+        update = self.__get_dummy_update()
+
+        with patch("ownbot.admincommands.UserManager") as usrmgr_mock:
+            usrmgr_mock.return_value.get_group_stats.return_value = []
+            AdminCommands._AdminCommands__get_groups(  # pylint: disable=no-member, protected-access
+                bot, update)
+        bot.sendMessage.assert_called_with(chat_id=1,
+                                           text="No groups registered")
+
+    def test_find_user(self):
+        """
+            Test finduser command
+        """
+        bot = Mock(spec=Bot)
+        update = self.__get_dummy_update()
+
+        with patch("ownbot.admincommands.UserManager") as usrmgr_mock:
+            usrmgr_mock.return_value.find_users.return_value = [
+                {"group": "foogroup", "username": "@foouser", "id": 1337},
+                {"group": "bargroup", "username": "@fooman", "id": None}
+            ]
+            AdminCommands._AdminCommands__find_user(  # pylint: disable=no-member, protected-access
+                bot, update, ["foo"])
+        bot.sendMessage.assert_called_with(
+            chat_id=1,
+            text="@foouser with id 1337 in foogroup\n"
+            "@fooman (unverified) in bargroup\n")
+
+    def test_find_user_nothing_found(self):
+        """
+            Test finduser command if no user matches
+        """
+        bot = Mock(spec=Bot)
+        update = self.__get_dummy_update()
+
+        with patch("ownbot.admincommands.UserManager") as usrmgr_mock:
+            usrmgr_mock.return_value.find_users.return_value = []
+            AdminCommands._AdminCommands__find_user(  # pylint: disable=no-member, protected-access
+                bot, update, ["foo"])
+        bot.sendMessage.assert_called_with(chat_id=1,
+                                           text="No users found for 'foo'")
+
+    def test_get_pending(self):
+        """
+            Test pending command
+        """
+        bot = Mock(spec=Bot)
+        update = self.__get_dummy_update()
+
+        with patch("ownbot.admincommands.UserManager") as usrmgr_mock:
+            usrmgr_mock.return_value.get_pending_users.return_value = [
+                {"group": "foogroup", "username": "@foouser",
+                 "invited": None},
+                {"group": "bargroup", "username": "@baruser",
+                 "invited": time.time() - 3 * 60 * 60 - 5}
+            ]
+            AdminCommands._AdminCommands__get_pending(  # pylint: disable=no-member, protected-access
+                bot, update)
+        text = bot.sendMessage.call_args[1]["text"]
+        self.assertIn("@foouser in foogroup, added at an unknown time", text)
+        self.assertIn("@baruser in bargroup, added 3h ago", text)
+
+    def test_get_pending_escapes_markdown(self):
+        """
+            Test pending command escapes names for Markdown
+        """
+        bot = Mock(spec=Bot)
+        update = self.__get_dummy_update()
+
+        with patch("ownbot.admincommands.UserManager") as usrmgr_mock:
+            usrmgr_mock.return_value.get_pending_users.return_value = [
+                {"group": "foo_group", "username": "@john_doe",
+                 "invited": None}]
+            AdminCommands._AdminCommands__get_pending(  # pylint: disable=no-member, protected-access
+                bot, update)
+        self.assertIn("@john\\_doe in foo\\_group",
+                      bot.sendMessage.call_args[1]["text"])
+
+    def test_get_pending_none(self):
+        """
+            Test pending command if there are no unverified users
+        """
+        bot = Mock(spec=Bot)
+        update = self.__get_dummy_update()
+
+        with patch("ownbot.admincommands.UserManager") as usrmgr_mock:
+            usrmgr_mock.return_value.get_pending_users.return_value = []
+            AdminCommands._AdminCommands__get_pending(  # pylint: disable=no-member, protected-access
+                bot, update)
+        bot.sendMessage.assert_called_with(chat_id=1,
+                                           text="No pending users")
+
+    def test_invite(self):
+        """
+            Test invite command
+        """
+        bot = Mock(spec=Bot)
+        bot.username = "foobot"
+        update = self.__get_dummy_update()
+
+        with patch("ownbot.admincommands.UserManager") as usrmgr_mock:
+            usrmgr_mock.return_value.create_invite.return_value = "inv_foo"
+            usrmgr_mock.return_value.INVITE_TTL = 60
+            AdminCommands._AdminCommands__invite(  # pylint: disable=no-member, protected-access
+                bot, update, ["foogroup"])
+            usrmgr_mock.return_value.create_invite.assert_called_with(
+                "foogroup", expires=None)
+        self.assertIn("https://t.me/foobot?start=inv_foo",
+                      bot.sendMessage.call_args[1]["text"])
+
+    def test_invite_no_args(self):
+        """
+            Test invite command if the wrong number of args is passed
+        """
+        bot = Mock(spec=Bot)
+        update = self.__get_dummy_update()
+
+        AdminCommands._AdminCommands__invite(  # pylint: disable=no-member, protected-access
+            bot, update, [])
+        bot.sendMessage.assert_called_with(
+            chat_id=1, text="Usage: invite <group> [duration]")
+
+    def test_backup(self):
+        """
+            Test backup command
+        """
+        bot = Mock(spec=Bot)
+        update = self.__get_dummy_update()
+
+        with patch("ownbot.admincommands.UserManager") as usrmgr_mock:
+            usrmgr_mock.return_value.backup.return_value = \
+                "/foo/users-1.yml.gz"
+            usrmgr_mock.return_value.get_backups.return_value = ["foo"]
+            usrmgr_mock.return_value.backup_dir = "/foo"
+            AdminCommands._AdminCommands__backup(  # pylint: disable=no-member, protected-access
+                bot, update)
+        bot.sendMessage.assert_called_with(
+            chat_id=1,
+            text="Saved the backup 'users-1.yml.gz'. 1 backups are kept in "
+            "'/foo'.")
+
+    def test_backup_failed(self):
+        """
+            Test backup command if the backup can't be written
+        """
+        bot = Mock(spec=Bot)
+        update = self.__get_dummy_update()
+
+        with patch("ownbot.admincommands.UserManager") as usrmgr_mock:
+            usrmgr_mock.return_value.backup.side_effect = OSError("foo")
+            AdminCommands._AdminCommands__backup(  # pylint: disable=no-member, protected-access
+                bot, update)
+        bot.sendMessage.assert_called_with(chat_id=1,
+                                           text="The backup failed: foo")
+
+    def test_redeem_invite(self):
+        """
+            Test starting the bot with an invite token
+        """
+        bot = Mock(spec=Bot)
+        update = self.__get_dummy_update()
+
+        with patch("ownbot.admincommands.UserManager") as usrmgr_mock:
+            usrmgr_mock.INVITE_PREFIX = "inv_"
+            usrmgr_mock.return_value.redeem_invite.return_value = "foogroup"
+            AdminCommands._AdminCommands__redeem_invite(  # pylint: disable=no-member, protected-access
+                bot, update, ["inv_foo"])
+            usrmgr_mock.return_value.redeem_invite.assert_called_with(
+                "inv_foo", 1337, "@foouser")
+        bot.sendMessage.assert_called_with(
+            chat_id=1,
+            text="Hello @foouser! You have been added to the 'foogroup' group.")
+
+    def test_redeem_invalid_invite(self):
+        """
+            Test starting the bot with an invalid invite token
+        """
+        bot = Mock(spec=Bot)
+        update = self.__get_dummy_update()
+
+        with patch("ownbot.admincommands.UserManager") as usrmgr_mock:
+            usrmgr_mock.INVITE_PREFIX = "inv_"
+            usrmgr_mock.return_value.redeem_invite.return_value = None
+            AdminCommands._AdminCommands__redeem_invite(  # pylint: disable=no-member, protected-access
+                bot, update, ["inv_foo"])
+        bot.sendMessage.assert_called_with(
+            chat_id=1, text="This invite link is invalid or expired.")
+
+    def test_start_without_invite(self):
+        """
+            Test that other start commands are ignored
+        """
+        bot = Mock(spec=Bot)
+        update = self.__get_dummy_update()
+
+        with patch("ownbot.admincommands.UserManager") as usrmgr_mock:
+            usrmgr_mock.INVITE_PREFIX = "inv_"
+            AdminCommands._AdminCommands__redeem_invite(  # pylint: disable=no-member, protected-access
+                bot, update, [])
+            AdminCommands._AdminCommands__redeem_invite(  # pylint: disable=no-member, protected-access
+                bot, update, ["ref42"])
+            self.assertFalse(usrmgr_mock.return_value.redeem_invite.called)
+        self.assertFalse(bot.sendMessage.called)
+
     def test_adduser_no_args(self):
         """
             Test adduser command if the wrong number of args is passed
@@ -104,7 +357,7 @@ class TestAdminCommands(TestCase):  # pylint: disable=too-many-public-methods
         AdminCommands._AdminCommands__add_user(  # pylint: disable=no-member, protected-access
             bot, update, [])
         bot.sendMessage.assert_called_with(
-            chat_id=1, text="Usage: adduser <user> <group>")
+            chat_id=1, text="Usage: adduser <user> <group> [duration]")
 
     def test_adduser_usr_already_in_grp(self):
         """
@@ -136,6 +389,38 @@ class TestAdminCommands(TestCase):  # pylint: disable=too-many-public-methods
             chat_id=1,
             text="Added user '@foouser' to the group 'foogroup'.")
 
+    def test_adduser_duration(self):
+        """
+            Test adduser command with a duration
+        """
+        bot = Mock(spec=Bot)
+        update = self.__get_dummy_update()
+
+        with patch("ownbot.admincommands.UserManager") as usrmgr_mock:
+            usrmgr_mock.return_value.add_user.return_value = True
+            before = time.time()
+            AdminCommands._AdminCommands__add_user(  # pylint: disable=no-member, protected-access
+                bot, update, ["@foouser", "foogroup", "2d"])
+            expires = usrmgr_mock.return_value.add_user.call_args[1][
+                "expires"]
+        self.assertGreaterEqual(expires, before + 2 * 24 * 60 * 60)
+        self.assertLess(expires, time.time() + 2 * 24 * 60 * 60 + 1)
+        self.assertIn(" until ", bot.sendMessage.call_args[1]["text"])
+
+    def test_adduser_invalid_duration(self):
+        """
+            Test adduser command with an invalid duration
+        """
+        bot = Mock(spec=Bot)
+        update = self.__get_dummy_update()
+
+        with patch("ownbot.admincommands.UserManager") as usrmgr_mock:
+            AdminCommands._AdminCommands__add_user(  # pylint: disable=no-member, protected-access
+                bot, update, ["@foouser", "foogroup", "soon"])
+            self.assertFalse(usrmgr_mock.return_value.add_user.called)
+        bot.sendMessage.assert_called_with(
+            chat_id=1, text="Usage: adduser <user> <group> [duration]")
+
     def test_rmuser_no_args(self):
         """
             Test rmuser command if the wrong number of args is passed
@@ -179,3 +464,78 @@ class TestAdminCommands(TestCase):  # pylint: disable=too-many-public-methods
             bot.sendMessage.assert_called_with(
                 chat_id=1,
                 text="Removed user '@foouser' from the group 'foogroup'.")
+
+    def test_empty_message_queue(self):
+        """
+            Test that an empty message queue passed is used
+        """
+        with patch("ownbot.admincommands.UserManager"):
+            queue = MessageQueue()
+            commands = AdminCommands(Mock(spec=Dispatcher),
+                                     message_queue=queue)
+        self.assertIs(commands.message_queue, queue)
+
+    def test_replies_are_queued(self):
+        """
+            Test that registered handlers reply through the message queue
+        """
+        with patch("ownbot.admincommands.UserManager"):
+            dispatcher = Mock(spec=Dispatcher)
+            queue = Mock()
+            AdminCommands(dispatcher, message_queue=queue)
+
+        handler = dispatcher.add_handler.call_args_list[0][0][0]
+        bot = Mock(spec=Bot)
+        handler.callback(bot, self.__get_dummy_update())
+
+        self.assertFalse(bot.sendMessage.called)
+        self.assertTrue(queue.enqueue.called)
+        self.assertEqual(queue.enqueue.call_args[0][:2],
+                         (1, bot.sendMessage))
+
+    def test_broadcast_no_args(self):
+        """
+            Test broadcast command if the wrong number of args is passed
+        """
+        with patch("ownbot.admincommands.UserManager"):
+            queue = Mock()
+            commands = AdminCommands(Mock(spec=Dispatcher),
+                                     message_queue=queue)
+
+        bot = Mock(spec=Bot)
+        commands._AdminCommands__broadcast(  # pylint: disable=no-member, protected-access
+            bot, self.__get_dummy_update(), ["foogroup"])
+
+        self.assertEqual(queue.enqueue.call_args[1],
+                         {"chat_id": 1,
+                          "text": "Usage: broadcast <group> <text>"})
+
+    def test_broadcast(self):
+        """
+            Test broadcast command
+        """
+        with patch("ownbot.admincommands.UserManager") as usrmgr_mock:
+            queue = Mock()
+            broadcaster = Mock()
+            broadcaster.broadcast.return_value = BroadcastResult()
+            commands = AdminCommands(Mock(spec=Dispatcher),
+                                     message_queue=queue,
+                                     broadcaster=broadcaster)
+            usrmgr_mock.return_value.get_users.return_value = [
+                {"id": 1337, "username": "@foouser"}]
+
+            bot = Mock(spec=Bot)
+            update = self.__get_dummy_update()
+            update.message.text = "/broadcast foogroup hello  world"
+            commands._AdminCommands__broadcast(  # pylint: disable=no-member, protected-access
+                bot, update, ["foogroup", "hello", "world"])
+
+        for _ in range(100):
+            if queue.enqueue.call_count == 2:
+                break
+            time.sleep(0.01)
+
+        broadcaster.broadcast.assert_called_with(bot, [1337],
+                                                 "hello  world")
+        self.assertEqual(queue.enqueue.call_count, 2)
+        self.assertIn("done", queue.enqueue.call_args[1]["text"])
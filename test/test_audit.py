@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+    Provides a unit test class for the ownbot.audit module.
+"""
+import json
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+
+from ownbot import audit
+from ownbot.audit import AuditLog
+
+
+class TestAudit(TestCase):  # pylint: disable=too-many-public-methods
+    """
+        Provides unit tests for the ownbot.audit module.
+    """
+
+    def setUp(self):
+        self.__tmpdir = tempfile.mkdtemp()
+        self.__path = os.path.join(self.__tmpdir, "audit.jsonl")
+
+    def tearDown(self):
+        audit.disable()
+        shutil.rmtree(self.__tmpdir)
+
+    def __read(self, path=None):
+        """Returns the records of a log file"""
+        with open(path or self.__path) as log_file:
+            return [json.loads(line) for line in log_file]
+
+    def test_record(self):
+        """
+            Test writing records as json lines
+        """
+        audit_log = AuditLog(self.__path, flush_interval=60)
+        self.assertTrue(audit_log.record(user_id=1337, decision="deny"))
+        audit_log.close(5)
+
+        records = self.__read()
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]["user_id"], 1337)
+        self.assertEqual(records[0]["decision"], "deny")
+        self.assertIn("time", records[0])
+        self.assertEqual(audit_log.written, 1)
+
+    def test_batch_wakes_writer(self):
+        """
+            Test that a full batch is written before the flush interval
+        """
+        audit_log = AuditLog(self.__path, batch_size=2, flush_interval=60)
+        audit_log.record(user_id=1)
+        audit_log.record(user_id=2)
+
+        for _ in range(500):
+            if audit_log.written == 2:
+                break
+            time.sleep(0.01)
+
+        self.assertEqual(audit_log.written, 2)
+        audit_log.close(5)
+
+    def test_drop_when_full(self):
+        """
+            Test that records are dropped and counted if the buffer is full
+        """
+        audit_log = AuditLog(self.__path, capacity=2, flush_interval=60)
+        results = [audit_log.record(user_id=i) for i in range(3)]
+        audit_log.close(5)
+
+        self.assertEqual(results, [True, True, False])
+        self.assertEqual(audit_log.dropped, 1)
+        self.assertEqual([rec["user_id"] for rec in self.__read()], [0, 1])
+
+    def test_rotation(self):
+        """
+            Test rotating the log file
+        """
+        audit_log = AuditLog(self.__path, batch_size=1, flush_interval=60,
+                             max_bytes=1, backup_count=2)
+        for i in range(3):
+            audit_log.record(user_id=i)
+            audit_log.flush()
+        audit_log.close(5)
+
+        self.assertFalse(os.path.exists(self.__path))
+        self.assertEqual(self.__read(self.__path + ".1")[0]["user_id"], 2)
+        self.assertEqual(self.__read(self.__path + ".2")[0]["user_id"], 1)
+        self.assertFalse(os.path.exists(self.__path + ".3"))
+
+    def test_enable_disable(self):
+        """
+            Test enabling and disabling the global audit log
+        """
+        self.assertIsNone(audit.get_audit_log())
+        audit_log = audit.enable(self.__path, flush_interval=60)
+        self.assertIs(audit.get_audit_log(), audit_log)
+        audit_log.record(user_id=1337)
+        audit.disable()
+
+        self.assertIsNone(audit.get_audit_log())
+        self.assertEqual(len(self.__read()), 1)
@@ -4,12 +4,14 @@
 """
 from datetime import datetime
 from unittest import TestCase
-from mock import patch, Mock
+from mock import DEFAULT, patch, Mock
 from imp import reload
 
-from telegram import Bot, Update, User, Chat, Message
+from telegram import Bot, Update, User, Chat, Message, CallbackQuery, \
+    InlineQuery
 
 import ownbot.auth
+import ownbot.usermanager
 # Is needed otherwise the decorators would be patched
 # by the test_admincommands' dummy decorator.
 reload(ownbot.auth)
@@ -157,3 +159,356 @@ class TestAuth(TestCase):  # pylint: disable=too-many-public-methods
 
             self.assertTrue(usrmgr_mock.return_value.group_is_empty.called)
             self.assertTrue(user_mock.save.called)
+
+    def test_requires_usergroup_tenant(self):
+        """
+            Test requires usergroup decorator checks the users of a tenant
+        """
+        tenants = []
+        with patch("ownbot.auth.User") as user_mock:
+            user_mock.return_value.has_access.return_value = True
+            user_mock.side_effect = lambda *_: tenants.append(
+                ownbot.usermanager.get_tenant()) or DEFAULT
+
+            @ownbot.auth.requires_usergroup(
+                "foo", tenant=lambda bot, update: bot.username)
+            def my_command_handler(bot, update):
+                """Dummy command handler"""
+                tenants.append(ownbot.usermanager.get_tenant())
+                return update
+
+            bot_mock = Mock(spec=Bot)
+            bot_mock.username = "foobot"
+            update = self.__get_dummy_update()
+            self.assertIs(my_command_handler(bot_mock, update), update)
+
+        self.assertEqual(tenants, ["foobot", "foobot"])
+        self.assertIsNone(ownbot.usermanager.get_tenant())
+
+    def test_requires_usergroup_unknown_option(self):
+        """
+            Test requires usergroup decorator rejects unknown options
+        """
+        with self.assertRaises(TypeError):
+            ownbot.auth.requires_usergroup("foo", bar=True)
+
+    def test_requires_usergroup_callback_query(self):
+        """
+            Test requires usergroup decorator with a callback query
+        """
+        with patch("ownbot.auth.User") as user_mock:
+            user_mock.return_value.has_access.return_value = True
+
+            @ownbot.auth.requires_usergroup("foo")
+            def my_command_handler(bot, update):
+                """Dummy command handler"""
+                print(bot, update)
+                return True
+
+            sender = User(1337, "@foouser")
+            query = CallbackQuery(1, sender, "foo", data="bar")
+            called = my_command_handler(Mock(spec=Bot),
+                                        Update(1, callback_query=query))
+
+            self.assertTrue(called)
+            user_mock.assert_called_with("@foouser", 1337)
+
+    def test_requires_usergroup_edited_message(self):
+        """
+            Test requires usergroup decorator with an edited message
+        """
+        with patch("ownbot.auth.User") as user_mock:
+            user_mock.return_value.has_access.return_value = False
+
+            @ownbot.auth.requires_usergroup("foo")
+            def my_command_handler(bot, update):
+                """Dummy command handler"""
+                print(bot, update)
+                return True
+
+            message = self.__get_dummy_update().message
+            called = my_command_handler(Mock(spec=Bot),
+                                        Update(1, edited_message=message))
+
+            self.assertIsNone(called)
+            user_mock.assert_called_with("@foouser", 1337)
+
+    def test_requires_usergroup_no_sender(self):
+        """
+            Test requires usergroup decorator ignores updates without sender
+        """
+        with patch("ownbot.auth.User") as user_mock:
+
+            @ownbot.auth.requires_usergroup("foo")
+            def my_command_handler(bot, update):
+                """Dummy command handler"""
+                print(bot, update)
+                return True
+
+            self.assertIsNone(my_command_handler(Mock(spec=Bot), Update(1)))
+            self.assertFalse(user_mock.called)
+
+    def test_requires_usergroup_signature(self):
+        """
+            Test requires usergroup decorator reads the signature once
+        """
+        with patch("ownbot.auth.User") as user_mock:
+            user_mock.return_value.has_access.return_value = True
+
+            @ownbot.auth.rate_limited(100)
+            @ownbot.auth.requires_usergroup("foo")
+            def my_command_handler(self, bot, update, args):
+                """Dummy command handler"""
+                return self, bot, update, args
+
+            # not a telegram.Bot, so the type can't tell the position
+            update = self.__get_dummy_update()
+            called = my_command_handler("self", "bot", update, [])
+
+            self.assertEqual(called, ("self", "bot", update, []))
+            self.assertEqual(my_command_handler.__name__,
+                             "my_command_handler")
+
+    def test_assign_first_to_inline_query(self):
+        """
+            Test assign first to decorator replies to inline queries
+            in the private chat
+        """
+        with patch("ownbot.auth.User"),\
+                patch("ownbot.auth.UserManager") as usrmgr_mock:
+            usrmgr_mock.return_value.group_is_empty.return_value = True
+
+            @ownbot.auth.assign_first_to("foo")
+            def my_command_handler(bot, update):
+                """Dummy command handler"""
+                print(bot, update)
+
+            bot_mock = Mock(spec=Bot)
+            query = InlineQuery(1, User(1337, "foo"), "bar", "")
+            my_command_handler(bot_mock, Update(1, inline_query=query))
+
+            bot_mock.sendMessage.assert_called_with(
+                chat_id=1337,
+                text="Hello foo! You have been added to the 'foo' group.")
+
+    def test_rate_limited(self):
+        """
+            Test rate limited decorator drops requests over the limit.
+        """
+        calls = []
+
+        @ownbot.auth.rate_limited(1, burst=2)
+        def my_command_handler(bot, update):
+            """Dummy command handler"""
+            calls.append((bot, update))
+            return True
+
+        bot_mock = Mock(spec=Bot)
+        update = self.__get_dummy_update()
+        results = [my_command_handler(bot_mock, update) for _ in range(3)]
+
+        self.assertEqual(results, [True, True, None])
+        self.assertEqual(len(calls), 2)
+
+    def test_rate_limited_before_auth(self):
+        """
+            Test rate limited decorator skips the authorization when dropping.
+        """
+        with patch("ownbot.auth.User") as user_mock:
+            user_mock.return_value.has_access.return_value = True
+
+            @ownbot.auth.rate_limited(1, burst=1)
+            @ownbot.auth.requires_usergroup("foo")
+            def my_command_handler(bot, update):
+                """Dummy command handler"""
+                print(bot, update)
+                return True
+
+            bot_mock = Mock(spec=Bot)
+            update = self.__get_dummy_update()
+            self.assertTrue(my_command_handler(bot_mock, update))
+            self.assertIsNone(my_command_handler(bot_mock, update))
+            self.assertEqual(user_mock.return_value.has_access.call_count, 1)
+
+    def test_rate_limited_scope(self):
+        """
+            Test rate limited decorator shares the budget of a scope.
+        """
+
+        @ownbot.auth.rate_limited(1, burst=1, scope="foo")
+        def first_handler(bot, update):
+            """Dummy command handler"""
+            print(bot, update)
+            return True
+
+        @ownbot.auth.rate_limited(1, burst=1, scope="foo")
+        def second_handler(bot, update):
+            """Dummy command handler"""
+            print(bot, update)
+            return True
+
+        bot_mock = Mock(spec=Bot)
+        update = self.__get_dummy_update()
+        self.assertTrue(first_handler(bot_mock, update))
+        self.assertIsNone(second_handler(bot_mock, update))
+
+    def test_requires_usergroup_audit(self):
+        """
+            Test requires usergroup decorator records its decisions.
+        """
+        with patch("ownbot.auth.User") as user_mock,\
+                patch("ownbot.audit.get_audit_log") as audit_mock:
+            user_mock.return_value.has_access.return_value = False
+
+            @ownbot.auth.requires_usergroup("foo", "bar")
+            def my_command_handler(bot, update):
+                """Dummy command handler"""
+                print(bot, update)
+                return True
+
+            update = self.__get_dummy_update()
+            update.message.text = "/foo bar"
+            my_command_handler(Mock(spec=Bot), update)
+
+            fields = audit_mock.return_value.record.call_args[1]
+            self.assertEqual(fields["user_id"], 1337)
+            self.assertEqual(fields["username"], "@foouser")
+            self.assertEqual(fields["command"], "/foo")
+            self.assertEqual(fields["groups"], ["foo", "bar"])
+            self.assertEqual(fields["decision"], "deny")
+            self.assertGreaterEqual(fields["latency_ms"], 0)
+
+    def test_requires_usergroup_chat(self):
+        """
+            Test requires usergroup decorator checks the grants of the chat
+        """
+        with patch("ownbot.auth.User") as user_mock:
+            user_mock.return_value.has_access.return_value = True
+
+            @ownbot.auth.requires_usergroup("foo")
+            def my_command_handler(bot, update):
+                """Dummy command handler"""
+                print(bot, update)
+                return True
+
+            self.assertTrue(my_command_handler(Mock(spec=Bot),
+                                               self.__get_dummy_update()))
+            user_mock.return_value.has_access.assert_called_with(
+                "foo", chat_id=1)
+
+            sender = User(1337, "@foouser")
+            query = InlineQuery(1, sender, "bar", "")
+            my_command_handler(Mock(spec=Bot), Update(1, inline_query=query))
+            user_mock.return_value.has_access.assert_called_with(
+                "foo", chat_id=None)
+
+
+    @staticmethod
+    def __get_update(user_id, chat_id, text="/status"):
+        """Returns an update of a user in a chat"""
+        user = User(user_id, "@user{0}".format(user_id))
+        message = Message(chat_id, user, datetime.now(),
+                          Chat(chat_id, "group"), text=text)
+        return Update(chat_id, message=message)
+
+    def test_memoized(self):
+        """
+            Test memoized replays the cached replies to other chats
+        """
+        calls = []
+
+        @ownbot.auth.memoized(60)
+        def my_command_handler(bot, update):
+            """Dummy command handler"""
+            calls.append(update)
+            bot.sendMessage(chat_id=update.message.chat_id, text="status",
+                            reply_to_message_id=update.message.message_id)
+            return True
+
+        first_bot = Mock(spec=Bot)
+        self.assertTrue(my_command_handler(first_bot,
+                                           self.__get_update(1, 10)))
+        first_bot.sendMessage.assert_called_once_with(
+            10, text="status", reply_to_message_id=10)
+
+        second_bot = Mock(spec=Bot)
+        self.assertTrue(my_command_handler(second_bot,
+                                           self.__get_update(2, 20)))
+        second_bot.sendMessage.assert_called_once_with(
+            20, text="status", reply_to_message_id=20)
+        self.assertEqual(len(calls), 1)
+
+        my_command_handler(Mock(spec=Bot),
+                           self.__get_update(2, 20, "/status foo"))
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(my_command_handler.cache.hits, 1)
+
+    def test_memoized_scope(self):
+        """
+            Test memoized keeps the replies of different groups apart
+        """
+        calls = []
+
+        @ownbot.auth.memoized(60, scope=["foo", "bar"])
+        def my_command_handler(bot, update):
+            """Dummy command handler"""
+            calls.append(update)
+            bot.sendMessage(update.message.chat_id, "status")
+
+        groups = {1: frozenset(["foo"]), 2: frozenset(["bar", "baz"]),
+                  3: frozenset(["foo", "baz"])}
+        with patch("ownbot.auth.UserManager") as usrmgr_mock:
+            usrmgr_mock.return_value.get_user_groups.side_effect = \
+                lambda user_id, chat_id: groups[user_id]
+            for user_id in (1, 2, 3):
+                my_command_handler(Mock(spec=Bot),
+                                   self.__get_update(user_id, 10))
+            usrmgr_mock.return_value.get_user_groups.assert_called_with(
+                3, chat_id=10)
+
+        self.assertEqual([update.message.from_user.id for update in calls],
+                         [1, 2])
+
+    def test_memoized_not_cacheable(self):
+        """
+            Test memoized doesn't cache replies sent elsewhere
+        """
+        calls = []
+
+        @ownbot.auth.memoized(60)
+        def my_command_handler(bot, update):
+            """Dummy command handler"""
+            calls.append(update)
+            bot.sendMessage(chat_id=99, text="notify")
+            bot.sendMessage(chat_id=update.message.chat_id, text="status")
+
+        for _ in range(2):
+            bot_mock = Mock(spec=Bot)
+            my_command_handler(bot_mock, self.__get_update(1, 10))
+            self.assertEqual(bot_mock.sendMessage.call_count, 2)
+        self.assertEqual(len(calls), 2)
+
+    def test_memoized_order(self):
+        """
+            Test memoized refuses to skip the authorization
+        """
+        with self.assertRaises(TypeError):
+
+            @ownbot.auth.memoized(60)
+            @ownbot.auth.requires_usergroup("foo")
+            def my_command_handler(bot, update):
+                """Dummy command handler"""
+                print(bot, update)
+
+        with patch("ownbot.auth.User") as user_mock:
+            user_mock.return_value.has_access.return_value = False
+
+            @ownbot.auth.requires_usergroup("foo")
+            @ownbot.auth.memoized(60)
+            def my_other_handler(bot, update):
+                """Dummy command handler"""
+                bot.sendMessage(update.message.chat_id, "secret")
+
+            bot_mock = Mock(spec=Bot)
+            my_other_handler(bot_mock, self.__get_update(1, 10))
+            self.assertFalse(bot_mock.sendMessage.called)
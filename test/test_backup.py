@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+    Provides a unit test class for the ownbot.backup module.
+"""
+import gzip
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from mock import patch
+
+from ownbot import backup
+
+
+class TestBackup(TestCase):  # pylint: disable=too-many-public-methods
+    """
+        Provides unit tests for the ownbot.backup module.
+    """
+
+    CONFIG = {"foogroup": {"users": [{"id": 1337, "username": "@foouser"}],
+                           "unverified": ["@baruser"],
+                           "expires": {"@foouser": 1.5},
+                           "chats": {-100: [42]},
+                           "modified": 10}}
+
+    def setUp(self):
+        self.__tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.__tmpdir)
+
+    def test_write_read(self):
+        """
+            Test that a backup is read back unchanged
+        """
+        path = backup.write(self.CONFIG, os.path.join(self.__tmpdir, "new"))
+        self.assertTrue(path.endswith(".yml.gz"))
+        self.assertEqual(backup.read(path), self.CONFIG)
+        self.assertEqual(os.listdir(os.path.dirname(path)),
+                         [os.path.basename(path)])
+
+    def test_read_invalid(self):
+        """
+            Test that invalid backups are rejected
+        """
+        path = os.path.join(self.__tmpdir, "users-invalid.yml.gz")
+        for content in (b"- foo", b"foo: {users: [foo]}",
+                        b"foo: {bar: 1}", b"foo: {expires: {'@foo': bar}}",
+                        b"foo: {chats: {-100: [bar]}}",
+                        b"foo: [bar"):
+            with gzip.open(path, "wb") as backup_file:
+                backup_file.write(content)
+            with self.assertRaises(ValueError):
+                backup.read(path)
+
+        with open(path, "wb") as backup_file:
+            backup_file.write(b"not compressed")
+        with self.assertRaises(ValueError):
+            backup.read(path)
+
+        with self.assertRaises(IOError):
+            backup.read(os.path.join(self.__tmpdir, "missing.yml.gz"))
+
+    def test_rotate(self):
+        """
+            Test that only the newest backups are kept
+        """
+        paths = []
+        for second in range(3):
+            with patch("ownbot.backup.time.time",
+                       return_value=1000000000 + second):
+                paths.append(backup.write({}, self.__tmpdir))
+        open(os.path.join(self.__tmpdir, "foo.yml.gz"), "w").close()
+
+        self.assertEqual(backup.list_backups(self.__tmpdir), paths[::-1])
+        self.assertEqual(backup.rotate(self.__tmpdir, 2), paths[:1])
+        self.assertEqual(backup.list_backups(self.__tmpdir), paths[:0:-1])
+        self.assertEqual(backup.list_backups(
+            os.path.join(self.__tmpdir, "missing")), [])
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+    Provides a unit test class for the ownbot.broadcast module.
+"""
+import threading
+from unittest import TestCase
+from mock import Mock
+
+from telegram import Bot
+from telegram.error import BadRequest, RetryAfter, TimedOut, Unauthorized
+
+from ownbot.broadcast import Broadcaster
+from ownbot.ratelimit import TokenBucket
+
+
+class TestBroadcast(TestCase):  # pylint: disable=too-many-public-methods
+    """
+        Provides unit tests for the ownbot.broadcast module.
+    """
+
+    def test_broadcast(self):
+        """
+            Test sending a message to all chats
+        """
+        bot = Mock(spec=Bot)
+        broadcaster = Broadcaster(workers=4, rate=10000)
+        result = broadcaster.broadcast(bot, range(100), "foo")
+
+        self.assertEqual(result.sent, 100)
+        self.assertEqual(result.failed, [])
+        self.assertEqual(result.total, 100)
+        chat_ids = sorted(call[1]["chat_id"]
+                          for call in bot.sendMessage.call_args_list)
+        self.assertEqual(chat_ids, list(range(100)))
+
+    def test_no_chats(self):
+        """
+            Test broadcasting to nobody
+        """
+        result = Broadcaster().broadcast(Mock(spec=Bot), [], "foo")
+        self.assertEqual(result.total, 0)
+
+    def test_retry(self):
+        """
+            Test that transient errors are retried with backoff
+        """
+        sleeps = []
+        bot = Mock(spec=Bot)
+        bot.sendMessage.side_effect = [TimedOut(), RetryAfter(7), None]
+        broadcaster = Broadcaster(workers=1, rate=10000, backoff=2,
+                                  sleep=sleeps.append)
+        result = broadcaster.broadcast(bot, [1], "foo")
+
+        self.assertEqual(result.sent, 1)
+        self.assertEqual(result.retries, 2)
+        # ignore the short waits of the rate limiting
+        self.assertEqual([delay for delay in sleeps if delay >= 1], [2, 7])
+
+    def test_give_up(self):
+        """
+            Test that a send is given up after the last retry
+        """
+        bot = Mock(spec=Bot)
+        bot.sendMessage.side_effect = TimedOut()
+        broadcaster = Broadcaster(workers=1, rate=10000, retries=2,
+                                  sleep=lambda _: None)
+        result = broadcaster.broadcast(bot, [1], "foo")
+
+        self.assertEqual(result.failed, [1])
+        self.assertEqual(bot.sendMessage.call_count, 3)
+
+    def test_permanent_errors(self):
+        """
+            Test that permanent errors are not retried
+        """
+        bot = Mock(spec=Bot)
+        bot.sendMessage.side_effect = [Unauthorized(),
+                                       BadRequest("chat not found")]
+        broadcaster = Broadcaster(workers=1, rate=10000)
+        result = broadcaster.broadcast(bot, [1, 2], "foo")
+
+        self.assertEqual(sorted(result.failed), [1, 2])
+        self.assertEqual(result.retries, 0)
+
+    def test_rate(self):
+        """
+            Test that all workers together keep to the rate
+        """
+        sleeps = []
+        lock = threading.Lock()
+
+        def sleep(seconds):
+            """Records the waits without sleeping"""
+            with lock:
+                sleeps.append(seconds)
+
+        broadcaster = Broadcaster(workers=4, rate=10, sleep=sleep)
+        broadcaster.broadcast(Mock(spec=Bot), range(21), "foo")
+
+        # the first message is sent right away, 20 more take 2 seconds
+        self.assertAlmostEqual(max(sleeps), 2, places=1)
+
+    def test_shared_bucket(self):
+        """
+            Test that every message takes a token from the shared bucket
+        """
+        bucket = Mock(spec=TokenBucket)
+        bot = Mock(spec=Bot)
+        bot.sendMessage.side_effect = [TimedOut(), None, None]
+        broadcaster = Broadcaster(workers=1, rate=10000, bucket=bucket,
+                                  sleep=lambda _: None)
+        broadcaster.broadcast(bot, [1, 2], "foo")
+
+        self.assertEqual(bucket.acquire.call_count, 3)
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+    Provides a unit test class for the ownbot.cache module.
+"""
+import threading
+import time
+from unittest import TestCase
+
+import ownbot.cache
+from ownbot.cache import ResponseCache
+
+
+class FakeClock(object):  # pylint: disable=too-few-public-methods
+    """Manually advanced clock"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestCache(TestCase):  # pylint: disable=too-many-public-methods
+    """
+        Provides unit tests for the ownbot.cache module.
+    """
+
+    def test_ttl(self):
+        """
+            Test that entries expire after the ttl
+        """
+        clock = FakeClock()
+        cache = ResponseCache(10, clock=clock)
+        self.assertEqual(cache.get("foo", lambda: (1, True)), (1, True))
+        self.assertEqual(cache.get("foo", lambda: (2, True)), (1, False))
+
+        clock.now = 10.0
+        self.assertEqual(cache.get("foo", lambda: (3, True)), (3, True))
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 2)
+
+    def test_lru_eviction(self):
+        """
+            Test that the least recently used entry is dropped
+        """
+        cache = ResponseCache(10, max_size=2, clock=FakeClock())
+        cache.get(1, lambda: (1, True))
+        cache.get(2, lambda: (2, True))
+        cache.get(1, lambda: (None, True))
+        cache.get(3, lambda: (3, True))
+
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get(1, lambda: (None, True)), (1, False))
+        self.assertEqual(cache.get(2, lambda: (4, True)), (4, True))
+
+    def test_not_cacheable(self):
+        """
+            Test that values which may not be cached are computed again
+        """
+        cache = ResponseCache(10, clock=FakeClock())
+        cache.get("foo", lambda: (1, False))
+        self.assertEqual(cache.get("foo", lambda: (2, True)), (2, True))
+        self.assertEqual(len(cache), 1)
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_clear_all(self):
+        """
+            Test that all caches are cleared
+        """
+        caches = [ResponseCache(10, clock=FakeClock()) for _ in range(2)]
+        for cache in caches:
+            cache.get("foo", lambda: (1, True))
+
+        ownbot.cache.clear_all()
+        self.assertEqual([len(cache) for cache in caches], [0, 0])
+
+    def test_clear_while_computing(self):
+        """
+            Test that a value computed before clear is not cached
+        """
+        cache = ResponseCache(10, clock=FakeClock())
+
+        def compute():
+            """Computes the value while the cache is cleared"""
+            cache.clear()
+            return 1, True
+
+        self.assertEqual(cache.get("foo", compute), (1, True))
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.get("foo", lambda: (2, True)), (2, True))
+
+    def test_single_flight(self):
+        """
+            Test that concurrent lookups of a key compute once
+        """
+        cache = ResponseCache(10)
+        calls = []
+        results = []
+        started = threading.Event()
+
+        def compute():
+            """Slowly computes the value"""
+            calls.append(1)
+            started.set()
+            time.sleep(0.1)
+            return "foo", True
+
+        def lookup():
+            """Looks up the key"""
+            results.append(cache.get("key", compute))
+
+        leader = threading.Thread(target=lookup)
+        leader.start()
+        started.wait(5)
+        followers = [threading.Thread(target=lookup) for _ in range(4)]
+        for thread in followers:
+            thread.start()
+        for thread in [leader] + followers:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(results),
+                         [("foo", False)] * 4 + [("foo", True)])
+
+    def test_error(self):
+        """
+            Test that errors are raised and nothing is cached
+        """
+        cache = ResponseCache(10, clock=FakeClock())
+
+        def fail():
+            """Fails to compute the value"""
+            raise ValueError("foo")
+
+        with self.assertRaises(ValueError):
+            cache.get("foo", fail)
+        self.assertEqual(cache.get("foo", lambda: (1, True)), (1, True))
+
+    def test_invalid_ttl(self):
+        """
+            Test that the ttl must be positive
+        """
+        with self.assertRaises(ValueError):
+            ResponseCache(0)
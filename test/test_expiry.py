@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+    Provides a unit test class for the ownbot.expiry module.
+"""
+import threading
+from unittest import TestCase
+
+from ownbot.expiry import ExpiryHeap, Sweeper, format_duration, \
+    parse_duration
+
+
+class TestExpiry(TestCase):  # pylint: disable=too-many-public-methods
+    """
+        Provides unit tests for the ownbot.expiry module.
+    """
+
+    def test_parse_duration(self):
+        """
+            Test parsing durations
+        """
+        self.assertEqual(parse_duration("30s"), 30)
+        self.assertEqual(parse_duration("30m"), 30 * 60)
+        self.assertEqual(parse_duration("12H"), 12 * 60 * 60)
+        self.assertEqual(parse_duration("2d"), 2 * 24 * 60 * 60)
+        self.assertEqual(parse_duration("1w"), 7 * 24 * 60 * 60)
+
+    def test_parse_invalid_duration(self):
+        """
+            Test parsing invalid durations
+        """
+        for text in ("", "2", "d", "0d", "-1d", "1.5h", "2y"):
+            with self.assertRaises(ValueError):
+                parse_duration(text)
+
+    def test_format_duration(self):
+        """
+            Test formatting durations in their largest unit
+        """
+        self.assertEqual(format_duration(-1), "0s")
+        self.assertEqual(format_duration(59.9), "59s")
+        self.assertEqual(format_duration(90), "1m")
+        self.assertEqual(format_duration(3 * 24 * 60 * 60 + 5), "3d")
+        self.assertEqual(format_duration(15 * 24 * 60 * 60), "2w")
+
+    def test_heap(self):
+        """
+            Test popping the due entries in order
+        """
+        heap = ExpiryHeap()
+        heap.push(30, "foogroup", "@baz")
+        heap.push(10, "foogroup", "@foo")
+        heap.push(20, "bargroup", "@bar")
+
+        self.assertEqual(len(heap), 3)
+        self.assertEqual(heap.peek(), 10)
+        self.assertEqual(heap.pop_due(5), [])
+        self.assertEqual(heap.pop_due(20), [(10, "foogroup", "@foo"),
+                                            (20, "bargroup", "@bar")])
+        self.assertEqual(heap.peek(), 30)
+
+    def test_rebuild(self):
+        """
+            Test replacing all entries of the heap
+        """
+        heap = ExpiryHeap()
+        heap.push(1, "foogroup", "@foo")
+        heap.rebuild([(5, "bargroup", "@bar"), (3, "bazgroup", "@baz")])
+
+        self.assertEqual(heap.pop_due(10), [(3, "bazgroup", "@baz"),
+                                            (5, "bargroup", "@bar")])
+        self.assertEqual(heap.peek(), None)
+
+    def test_sweeper(self):
+        """
+            Test sweeping once due and stopping when there is nothing to do
+        """
+        heap = ExpiryHeap()
+        swept = threading.Event()
+
+        def sweep(now):
+            """Removes the due entries"""
+            heap.pop_due(now)
+            swept.set()
+
+        sweeper = Sweeper(sweep, heap.peek, clock=lambda: 100)
+        heap.push(50, "foogroup", "@foo")
+        sweeper.notify()
+
+        self.assertTrue(swept.wait(5))
+        for _ in range(500):
+            if not sweeper.running:
+                break
+            threading.Event().wait(0.01)
+        self.assertFalse(sweeper.running)
+        self.assertEqual(len(heap), 0)
+
+    def test_sweeper_waits(self):
+        """
+            Test that the sweeper doesn't sweep before the entries are due
+        """
+        heap = ExpiryHeap()
+        swept = []
+        sweeper = Sweeper(swept.append, heap.peek, clock=lambda: 100)
+        heap.push(200, "foogroup", "@foo")
+        sweeper.notify()
+
+        threading.Event().wait(0.1)
+        self.assertEqual(swept, [])
+        self.assertTrue(sweeper.running)
+
+        heap.pop_due(200)
+        sweeper.notify()
+
+    def test_sweeper_stop(self):
+        """
+            Test that a stopped sweeper ends its thread and stays stopped
+        """
+        heap = ExpiryHeap()
+        swept = []
+        sweeper = Sweeper(swept.append, heap.peek, clock=lambda: 100)
+        heap.push(200, "foogroup", "@foo")
+        sweeper.notify()
+        self.assertTrue(sweeper.running)
+
+        sweeper.stop(5)
+        self.assertFalse(sweeper.running)
+        sweeper.notify()
+        self.assertFalse(sweeper.running)
+        self.assertEqual(swept, [])
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+    Provides a unit test class for the ownbot.loadtest module.
+"""
+from unittest import TestCase
+
+import ownbot.usermanager
+from ownbot import loadtest
+from ownbot.usermanager import UserManager
+
+
+class TestLoadTest(TestCase):  # pylint: disable=too-many-public-methods
+    """
+        Provides unit tests for the ownbot.loadtest module.
+    """
+
+    def test_populate(self):
+        """
+            Test distributing the users over the groups
+        """
+        config = loadtest.populate(5, 2)
+
+        self.assertEqual(sorted(config), ["admin", "group0", "group1"])
+        ids = [usr["id"] for usr in config["group0"][UserManager.VERIFIED]]
+        self.assertEqual(ids, [2, 4, 6])
+        ids = [usr["id"] for usr in config["group1"][UserManager.VERIFIED]]
+        self.assertEqual(ids, [3, 5])
+
+    def test_run(self):
+        """
+            Test a short load test
+        """
+        orig_path = UserManager.USERS_CONF_PATH
+        stores = list(ownbot.usermanager._STORES)  # pylint: disable=protected-access
+        report = loadtest.run(users=10, groups=2, updates=200, workers=2,
+                              unauthorized=0.0, seed=1)
+
+        self.assertEqual(report.updates, 200)
+        self.assertEqual(report.granted, 200)
+        self.assertEqual(report.messages, 200)
+        self.assertEqual(len(report.latencies), 200)
+        self.assertEqual(report.writes, 0)
+        self.assertEqual(UserManager.USERS_CONF_PATH, orig_path)
+        self.assertEqual(list(ownbot.usermanager._STORES),  # pylint: disable=protected-access
+                         stores)
+
+    def test_run_unauthorized(self):
+        """
+            Test a load test with unknown users and writes
+        """
+        report = loadtest.run(users=10, groups=2, updates=200, workers=4,
+                              unauthorized=0.5, write_ratio=0.1, seed=1)
+
+        self.assertLess(report.granted, 200)
+        self.assertGreater(report.writes, 0)
+        self.assertIn("updates:    200", str(report))
+
+    def test_run_fractions(self):
+        """
+            Test that the fractions are shares of all updates
+        """
+        report = loadtest.run(users=10, groups=2, updates=200, workers=2,
+                              unauthorized=0.9, write_ratio=0.1, seed=1)
+
+        self.assertEqual(report.granted, 0)
+        self.assertGreater(report.writes, 0)
+
+    def test_percentile(self):
+        """
+            Test the latency percentiles of a report
+        """
+        report = loadtest.LoadReport(4, 2.0, [0.4, 0.1, 0.3, 0.2], 4,
+                                     {"reads": 1, "writes": 0}, 4)
+
+        self.assertEqual(report.throughput, 2.0)
+        self.assertEqual(report.percentile(0), 0.1)
+        self.assertEqual(report.percentile(100), 0.4)
+        self.assertEqual(loadtest.LoadReport(0, 0, [], 0, {"reads": 0,
+                                                            "writes": 0},
+                                             0).percentile(50), 0.0)
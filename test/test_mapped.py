@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+    Provides a unit test class for the ownbot.mapped module.
+"""
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+
+from ownbot.mapped import MappedSnapshot, export
+
+
+class TestMapped(TestCase):  # pylint: disable=too-many-public-methods
+    """
+        Provides unit tests for the ownbot.mapped module.
+    """
+
+    CONFIG = {
+        "foogroup": {
+            "users": [{"id": 1337, "username": "@foouser"},
+                      {"id": 42, "username": "@baruser"}],
+            "unverified": [u"@bäzuser"]
+        },
+        "admin": {
+            "users": [{"id": 1, "username": "@admin"}]
+        }
+    }
+
+    def setUp(self):
+        self.__tmpdir = tempfile.mkdtemp()
+        self.__path = os.path.join(self.__tmpdir, "users.bin")
+
+    def tearDown(self):
+        shutil.rmtree(self.__tmpdir)
+
+    def test_lookup(self):
+        """
+            Test looking up users in an exported snapshot
+        """
+        export(self.CONFIG, self.__path)
+        mapped = MappedSnapshot(self.__path)
+
+        self.assertEqual(mapped.groups, ["admin", "foogroup"])
+        self.assertTrue(mapped.userid_is_verified_in_group("foogroup", 42))
+        self.assertTrue(mapped.userid_is_verified_in_group("foogroup", 1337))
+        self.assertFalse(mapped.userid_is_verified_in_group("foogroup", 1))
+        self.assertFalse(mapped.userid_is_verified_in_group("bargroup", 1))
+        self.assertTrue(mapped.username_is_verified_in_group("foogroup",
+                                                             "@foouser"))
+        self.assertFalse(mapped.username_is_verified_in_group("admin",
+                                                              "@foouser"))
+        self.assertTrue(mapped.user_is_unverified_in_group("foogroup",
+                                                           u"@bäzuser"))
+        self.assertTrue(mapped.user_is_in_group("foogroup",
+                                                username=u"@bäzuser"))
+        self.assertTrue(mapped.user_is_in_group("admin", user_id=1))
+        self.assertFalse(mapped.user_is_in_group("admin"))
+
+    def test_empty(self):
+        """
+            Test an empty snapshot
+        """
+        export({}, self.__path)
+        mapped = MappedSnapshot(self.__path)
+
+        self.assertEqual(mapped.groups, [])
+        self.assertFalse(mapped.user_is_in_group("foogroup", user_id=1))
+
+    def test_expired(self):
+        """
+            Test that expired memberships are absent
+        """
+        export({"foogroup": {
+            "users": [{"id": 1337, "username": "@foouser"}],
+            "unverified": ["@baruser"],
+            "expires": {"@foouser": time.time() - 1,
+                        "@baruser": time.time() + 60}
+        }}, self.__path)
+        mapped = MappedSnapshot(self.__path)
+
+        self.assertFalse(mapped.userid_is_verified_in_group("foogroup", 1337))
+        self.assertTrue(mapped.user_is_unverified_in_group("foogroup",
+                                                           "@baruser"))
+
+    def test_refresh(self):
+        """
+            Test mapping a replaced snapshot
+        """
+        export(self.CONFIG, self.__path)
+        mapped = MappedSnapshot(self.__path, check_interval=None)
+        self.assertFalse(mapped.refresh())
+
+        export({"bargroup": {"users": [{"id": 7, "username": "@qux"}]}},
+               self.__path)
+        self.assertFalse(mapped.user_is_in_group("bargroup", user_id=7))
+        self.assertTrue(mapped.refresh())
+        self.assertTrue(mapped.user_is_in_group("bargroup", user_id=7))
+        self.assertFalse(mapped.user_is_in_group("foogroup", user_id=42))
+        self.assertEqual(os.listdir(self.__tmpdir), ["users.bin"])
+
+    def test_invalid_file(self):
+        """
+            Test mapping a file which is not a snapshot
+        """
+        with open(self.__path, "wb") as snapshot_file:
+            snapshot_file.write(b"\0" * 64)
+
+        with self.assertRaises(ValueError):
+            MappedSnapshot(self.__path)
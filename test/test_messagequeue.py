@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+    Provides a unit test class for the ownbot.messagequeue module.
+"""
+import threading
+import time
+from unittest import TestCase
+from mock import Mock
+
+from telegram import Bot
+
+from ownbot.messagequeue import MessageQueue, QueuedBot, split_text
+
+
+class FakeBot(object):  # pylint: disable=too-few-public-methods
+    """Records the sent messages"""
+
+    def __init__(self):
+        self.sent = []
+        self.lock = threading.Lock()
+
+    def sendMessage(self, chat_id, text, **_):  # pylint: disable=invalid-name
+        """Records a message with the time it was sent"""
+        with self.lock:
+            self.sent.append((time.time(), chat_id, text))
+
+
+class TestMessageQueue(TestCase):  # pylint: disable=too-many-public-methods
+    """
+        Provides unit tests for the ownbot.messagequeue module.
+    """
+
+    def test_split_text(self):
+        """
+            Test splitting long texts at line breaks
+        """
+        self.assertEqual(split_text("foo"), ["foo"])
+        self.assertEqual(split_text(""), [""])
+        self.assertEqual(split_text("foo\nbar\n", limit=5),
+                         ["foo\n", "bar\n"])
+        self.assertEqual(split_text("foobarbaz", limit=4),
+                         ["foob", "arba", "z"])
+
+    def test_per_chat_rate(self):
+        """
+            Test that messages to one chat are spaced and ordered
+        """
+        bot = FakeBot()
+        queue = MessageQueue(per_chat_rate=20, global_rate=1000)
+        for i in range(3):
+            queue.enqueue(1, bot.sendMessage, chat_id=1, text=str(i))
+        queue.stop(5)
+
+        self.assertEqual([text for _, _, text in bot.sent], ["0", "1", "2"])
+        for before, after in zip(bot.sent, bot.sent[1:]):
+            self.assertGreaterEqual(after[0] - before[0], 0.04)
+        self.assertEqual(queue.sent, 3)
+        self.assertEqual(len(queue), 0)
+
+    def test_chats_dont_block_each_other(self):
+        """
+            Test that a busy chat doesn't delay other chats
+        """
+        bot = FakeBot()
+        queue = MessageQueue(per_chat_rate=2, global_rate=1000)
+        for i in range(3):
+            queue.enqueue(1, bot.sendMessage, chat_id=1, text=str(i))
+        queue.enqueue(2, bot.sendMessage, chat_id=2, text="other")
+        queue.stop(5)
+
+        chats = [chat_id for _, chat_id, _ in bot.sent]
+        self.assertEqual(chats.index(2), 1)
+
+    def test_global_rate(self):
+        """
+            Test that messages to different chats are spaced globally
+        """
+        bot = FakeBot()
+        queue = MessageQueue(per_chat_rate=1000, global_rate=20)
+        for chat_id in range(3):
+            queue.enqueue(chat_id, bot.sendMessage, chat_id=chat_id,
+                          text="foo")
+        queue.stop(5)
+
+        self.assertEqual(len(bot.sent), 3)
+        for before, after in zip(bot.sent, bot.sent[1:]):
+            self.assertGreaterEqual(after[0] - before[0], 0.04)
+
+    def test_shared_bucket(self):
+        """
+            Test that tokens taken by other senders delay the messages
+        """
+        bot = FakeBot()
+        queue = MessageQueue(per_chat_rate=1000, global_rate=20)
+        queue.bucket.acquire()
+        start = time.time()
+        queue.enqueue(1, bot.sendMessage, chat_id=1, text="foo")
+        queue.stop(5)
+
+        self.assertEqual(len(bot.sent), 1)
+        self.assertGreaterEqual(bot.sent[0][0] - start, 0.04)
+
+    def test_failed_send(self):
+        """
+            Test that a failing send doesn't stop the worker
+        """
+        bot = FakeBot()
+        queue = MessageQueue(per_chat_rate=1000, global_rate=1000)
+        queue.enqueue(1, Mock(side_effect=ValueError))
+        queue.enqueue(2, bot.sendMessage, chat_id=2, text="foo")
+        queue.stop(5)
+
+        self.assertEqual(queue.failed, 1)
+        self.assertEqual(queue.sent, 1)
+
+    def test_queued_bot(self):
+        """
+            Test that the queued bot returns before the message is sent
+        """
+        bot = Mock(spec=Bot)
+        bot.sendMessage.side_effect = lambda **_: time.sleep(0.2)
+        queue = MessageQueue(per_chat_rate=1000, global_rate=1000)
+        queued_bot = QueuedBot(bot, queue)
+
+        start = time.time()
+        queued_bot.sendMessage(chat_id=1, text="foo", parse_mode="Markdown")
+        self.assertLess(time.time() - start, 0.1)
+        self.assertIsInstance(queued_bot, Bot)
+
+        queue.stop(5)
+        bot.sendMessage.assert_called_with(chat_id=1, text="foo",
+                                           parse_mode="Markdown")
+        self.assertIs(queued_bot.getMe, bot.getMe)
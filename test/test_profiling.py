@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+    Provides a unit test class for the ownbot.profiling module.
+"""
+import os
+import pstats
+import shutil
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+from mock import Mock, patch
+
+from telegram import Bot, Chat, Message, Update, User
+
+import ownbot.auth
+from ownbot import profiling
+from ownbot.profiling import Profiler
+
+
+class TestProfiling(TestCase):  # pylint: disable=too-many-public-methods
+    """
+        Provides unit tests for the ownbot.profiling module.
+    """
+
+    def setUp(self):
+        self.__tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        profiling.disable()
+        shutil.rmtree(self.__tmpdir)
+
+    def test_record_slow(self):
+        """
+            Test that requests above the threshold are logged
+        """
+        profiler = Profiler(threshold=0.1)
+        with patch("ownbot.profiling.logging") as logging_mock:
+            self.assertFalse(profiler.record("/foo", 1337, 0.01, 0.02))
+            self.assertTrue(profiler.record("/foo", 1337, 0.05, 0.2))
+
+        args = logging_mock.getLogger.return_value.warning.call_args[0]
+        self.assertEqual(args[1:3], ("/foo", 1337))
+        self.assertAlmostEqual(args[3], 250)
+        self.assertEqual(profiler.slow, 1)
+
+    def test_record_disabled(self):
+        """
+            Test that no request is logged without a threshold
+        """
+        profiler = Profiler(threshold=None)
+        self.assertFalse(profiler.record("/foo", 1337, 10, 10))
+
+    def test_storage_time(self):
+        """
+            Test that the storage time is only counted while enabled
+        """
+        profiling.add_storage_time(1.0)
+        profiler = profiling.enable(threshold=0)
+        profiler.start()
+        profiling.add_storage_time(0.25)
+        profiling.add_storage_time(0.25)
+
+        with patch("ownbot.profiling.logging") as logging_mock:
+            profiler.record("/foo", 1337, 0.0, 0.0)
+        args = logging_mock.getLogger.return_value.warning.call_args[0]
+        self.assertAlmostEqual(args[5], 500)
+
+    def test_sample(self):
+        """
+            Test that a sampled call is dumped to a pstats file
+        """
+        profiler = Profiler(sample_rate=1.0, directory=self.__tmpdir)
+        self.assertTrue(profiler.should_sample())
+        self.assertEqual(profiler.sample("foo", sum, [1, 2]), 3)
+
+        files = os.listdir(self.__tmpdir)
+        self.assertEqual(len(files), 1)
+        self.assertTrue(files[0].startswith("foo-"))
+        pstats.Stats(os.path.join(self.__tmpdir, files[0]))
+
+    def test_sample_limits(self):
+        """
+            Test that the number of samples is limited
+        """
+        self.assertFalse(Profiler(sample_rate=0.0).should_sample())
+
+        profiler = Profiler(sample_rate=1.0, directory=self.__tmpdir,
+                            max_samples=1)
+        profiler.sample("foo", profiler.should_sample)
+        self.assertFalse(profiler.sample("foo", profiler.should_sample))
+        self.assertFalse(profiler.should_sample())
+
+    def test_requires_usergroup(self):
+        """
+            Test that protected handlers are timed and sampled
+        """
+        profiler = profiling.enable(threshold=0, sample_rate=1.0,
+                                    directory=self.__tmpdir)
+
+        with patch("ownbot.auth.User") as user_mock:
+            user_mock.return_value.has_access.return_value = True
+
+            @ownbot.auth.requires_usergroup("foo")
+            def my_command_handler(bot, update):
+                """Dummy command handler"""
+                print(bot, update)
+                return True
+
+            user = User(1337, "@foouser")
+            message = Message(1, user, datetime.now(), Chat(1, None),
+                              text="/foo bar")
+            called = my_command_handler(Mock(spec=Bot),
+                                        Update(1, message=message))
+
+        self.assertTrue(called)
+        self.assertEqual(profiler.slow, 1)
+        self.assertEqual(len(os.listdir(self.__tmpdir)), 1)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+    Provides a unit test class for the ownbot.ratelimit module.
+"""
+from unittest import TestCase
+
+from ownbot.ratelimit import RateLimiter, TokenBucket, refill
+
+
+class FakeClock(object):  # pylint: disable=too-few-public-methods
+    """Manually advanced clock"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestRateLimit(TestCase):  # pylint: disable=too-many-public-methods
+    """
+        Provides unit tests for the ownbot.ratelimit module.
+    """
+
+    def test_refill(self):
+        """
+            Test refilling a bucket
+        """
+        self.assertEqual(refill(0, 0, 1, 2, 10), 2)
+        self.assertEqual(refill(9, 0, 1, 2, 10), 10)
+        self.assertEqual(refill(1, 5, 4, 2, 10), 1)
+
+    def test_burst(self):
+        """
+            Test that a full bucket allows a burst and then drops
+        """
+        clock = FakeClock()
+        limiter = RateLimiter(1, burst=3, clock=clock)
+        results = [limiter.allow(1337) for _ in range(4)]
+        self.assertEqual(results, [True, True, True, False])
+
+        clock.now = 1.0
+        self.assertTrue(limiter.allow(1337))
+        self.assertFalse(limiter.allow(1337))
+
+    def test_keys_are_independent(self):
+        """
+            Test that every key has its own bucket
+        """
+        limiter = RateLimiter(1, clock=FakeClock())
+        self.assertTrue(limiter.allow(1))
+        self.assertFalse(limiter.allow(1))
+        self.assertTrue(limiter.allow(2))
+
+    def test_lru_eviction(self):
+        """
+            Test that the least recently used bucket is dropped
+        """
+        limiter = RateLimiter(1, max_keys=2, clock=FakeClock())
+        limiter.allow(1)
+        limiter.allow(2)
+        limiter.allow(1)
+        limiter.allow(3)
+
+        self.assertEqual(len(limiter), 2)
+        # key 2 was evicted and starts with a full bucket again
+        self.assertTrue(limiter.allow(2))
+        # key 3 is still tracked and empty
+        self.assertFalse(limiter.allow(3))
+
+    def test_invalid_rate(self):
+        """
+            Test that the rate must be positive
+        """
+        self.assertRaises(ValueError, RateLimiter, 0)
+
+    def test_token_bucket_consume(self):
+        """
+            Test taking tokens without waiting
+        """
+        clock = FakeClock()
+        bucket = TokenBucket(2, burst=2, clock=clock)
+        self.assertTrue(bucket.consume())
+        self.assertTrue(bucket.consume())
+        self.assertFalse(bucket.consume())
+
+        clock.now = 0.5
+        self.assertTrue(bucket.consume())
+        self.assertFalse(bucket.consume())
+
+    def test_token_bucket_acquire(self):
+        """
+            Test that waiting callers reserve consecutive slots
+        """
+        sleeps = []
+        bucket = TokenBucket(4, clock=FakeClock(), sleep=sleeps.append)
+        waits = [bucket.acquire() for _ in range(3)]
+
+        self.assertEqual(waits, [0.0, 0.25, 0.5])
+        self.assertEqual(sleeps, [0.25, 0.5])
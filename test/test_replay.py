@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+    Provides a unit test class for the ownbot.recording and
+    ownbot.replay modules.
+"""
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from mock import Mock, patch
+
+from telegram import Bot
+
+import ownbot.usermanager
+from ownbot import recording, replay
+from ownbot.auth import requires_usergroup
+from ownbot.mapped import MappedSnapshot
+from ownbot.usermanager import UserManager
+
+
+class TestReplay(TestCase):  # pylint: disable=too-many-public-methods
+    """
+        Provides unit tests for the ownbot.recording and ownbot.replay
+        modules.
+    """
+
+    def setUp(self):
+        self.__tmpdir = tempfile.mkdtemp()
+        self.__path = os.path.join(self.__tmpdir, "recording.jsonl")
+        config_dir = os.path.join(self.__tmpdir, "config")
+        self.__patches = [
+            patch.object(UserManager, "CONFIG_DIR_PATH", config_dir),
+            patch.object(UserManager, "USERS_CONF_PATH",
+                         os.path.join(config_dir, "users.yml")),
+        ]
+        for patcher in self.__patches:
+            patcher.start()
+
+    def tearDown(self):
+        recording.disable()
+        for patcher in self.__patches:
+            patcher.stop()
+        shutil.rmtree(self.__tmpdir)
+
+    def __record(self):
+        """Records a granted and a denied update"""
+        UserManager().add_user("@foouser", "foogroup", user_id=1337)
+        recording.enable(self.__path)
+
+        @requires_usergroup("foogroup")
+        def my_command_handler(bot, update):
+            """Dummy command handler"""
+            print(bot, update)
+
+        for user_id, username in ((1337, "foouser"), (42, "baruser")):
+            update = replay.make_update(1, {
+                "user_id": user_id, "username": username,
+                "text": "/foo @foouser foogroup secret", "kind": "message"})
+            my_command_handler(Mock(spec=Bot), update)
+        recording.disable()
+
+    def test_anonymizer(self):
+        """
+            Test that ids and names are replaced consistently
+        """
+        anonymizer = recording.Anonymizer(b"key")
+        self.assertEqual(anonymizer.user_id(1337), anonymizer.user_id(1337))
+        self.assertNotEqual(anonymizer.user_id(1337), anonymizer.user_id(42))
+        self.assertEqual(
+            anonymizer.text("/adduser @Foo foogroup 2d secret", {"foogroup"}),
+            "/adduser {0} foogroup 2d x".format(anonymizer.username("@foo")))
+        self.assertEqual(anonymizer.config({"foogroup": {
+            "users": [{"id": 1337, "username": "@foo"}],
+            "expires": {"@foo": 1}}}), {"foogroup": {
+                "users": [{"id": anonymizer.user_id(1337),
+                           "username": anonymizer.username("@foo")}],
+                "expires": {anonymizer.username("@foo"): 1}}})
+
+    def test_record(self):
+        """
+            Test that updates are recorded anonymized
+        """
+        self.__record()
+
+        config, events = recording.load(self.__path)
+        with open(self.__path) as recording_file:
+            content = recording_file.read()
+        for secret in ("1337", "foouser", "baruser", "secret"):
+            self.assertNotIn(secret, content)
+        self.assertEqual(list(config), ["foogroup"])
+        self.assertEqual([event["granted"] for event in events],
+                         [True, False])
+        self.assertEqual(events[0]["groups"], ["foogroup"])
+        self.assertEqual(events[0]["kind"], "message")
+        self.assertTrue(events[0]["text"].endswith(" foogroup x"))
+
+    def test_load_invalid(self):
+        """
+            Test that other files are not loaded
+        """
+        with open(self.__path, "w") as recording_file:
+            recording_file.write("{}\n")
+        with self.assertRaises(ValueError):
+            recording.load(self.__path)
+
+    def test_replay(self):
+        """
+            Test that a replay reproduces the recorded decisions
+        """
+        self.__record()
+        orig_path = UserManager.USERS_CONF_PATH
+
+        report = replay.run(self.__path)
+        self.assertEqual(report.updates, 2)
+        self.assertEqual(report.granted, 1)
+        self.assertEqual(report.messages, 1)
+        self.assertEqual(report.changed, [])
+        self.assertEqual(UserManager.USERS_CONF_PATH, orig_path)
+        self.assertIsNone(recording.get_recorder())
+
+    def test_replay_keeps_users(self):
+        """
+            Test that a replay leaves the binary snapshot and stores alone
+        """
+        path = os.path.join(self.__tmpdir, "users.bin")
+        with patch.object(UserManager, "MAPPED_SNAPSHOT_PATH", path):
+            UserManager().add_user("@admin", "admin", user_id=42)
+            self.__record()
+            stores = list(ownbot.usermanager._STORES)  # pylint: disable=protected-access
+
+            replay.run(self.__path)
+
+            self.assertEqual(UserManager.MAPPED_SNAPSHOT_PATH, path)
+        self.assertEqual(list(ownbot.usermanager._STORES),  # pylint: disable=protected-access
+                         stores)
+        mapped = MappedSnapshot(path, check_interval=None)
+        self.assertTrue(mapped.user_is_in_group("admin", user_id=42))
+
+    def test_replay_changed(self):
+        """
+            Test that changed decisions are reported
+        """
+        self.__record()
+        with open(self.__path) as recording_file:
+            lines = recording_file.readlines()
+        header = json.loads(lines[0])
+        header["config"] = {}
+        with open(self.__path, "w") as recording_file:
+            recording_file.write(json.dumps(header) + "\n")
+            recording_file.writelines(lines[1:])
+
+        report = replay.run(self.__path, speed=100.0)
+        self.assertEqual(report.changed, [{"index": 0, "recorded": True,
+                                           "replayed": False}])
+        self.assertIn("changed:    1 decisions", str(report))
+
+    def test_replay_chat_grants(self):
+        """
+            Test that chat grants are recorded and replayed
+        """
+        UserManager().grant_in_chat(1337, "foogroup", -100)
+        recording.enable(self.__path)
+
+        @requires_usergroup("foogroup")
+        def my_command_handler(bot, update):
+            """Dummy command handler"""
+            print(bot, update)
+
+        for chat_id in (-100, -200):
+            my_command_handler(Mock(spec=Bot), replay.make_update(1, {
+                "user_id": 1337, "username": "foouser", "text": "/foo",
+                "kind": "message", "chat_id": chat_id}))
+        recording.disable()
+
+        config, events = recording.load(self.__path)
+        self.assertEqual([event["granted"] for event in events],
+                         [True, False])
+        self.assertEqual(list(config["foogroup"]["chats"]),
+                         [events[0]["chat_id"]])
+
+        report = replay.run(self.__path)
+        self.assertEqual(report.granted, 1)
+        self.assertEqual(report.changed, [])
+
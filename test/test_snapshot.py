@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+"""
+    Provides a unit test class for the ownbot.snapshot module.
+"""
+import threading
+from unittest import TestCase
+
+from ownbot.snapshot import Snapshot, Store
+
+
+class TestSnapshot(TestCase):  # pylint: disable=too-many-public-methods
+    """
+        Provides unit tests for the ownbot.snapshot module.
+    """
+
+    def test_group_index(self):
+        """
+            Test the indexes of a group snapshot
+        """
+        config = {"foogroup": {"users": [{"id": 1337,
+                                          "username": "@foouser"}],
+                               "unverified": ["@baruser"]}}
+        group = Snapshot(config).group("foogroup")
+        self.assertEqual(group.ids, frozenset([1337]))
+        self.assertEqual(group.names, frozenset(["@foouser"]))
+        self.assertEqual(group.unverified, frozenset(["@baruser"]))
+
+    def test_find_invite(self):
+        """
+            Test looking up invite tokens of all groups
+        """
+        config = {"foogroup": {"invites": {"abc": 10}},
+                  "bargroup": {"invites": {"def": 20}}}
+        current = Snapshot(config)
+
+        self.assertEqual(current.find_invite("def"), ("bargroup", 20))
+        self.assertEqual(current.find_invite("ghi"), None)
+        self.assertEqual(sorted(current.expiries()),
+                         [(10, "foogroup", "abc"), (20, "bargroup", "def")])
+
+    def test_update_invite_index(self):
+        """
+            Test that the invite index is updated for changed groups only
+        """
+        config = {"foogroup": {"invites": {"abc": 10}},
+                  "bargroup": {"invites": {"def": 20}}}
+        previous = Snapshot(config)
+        previous.find_invite("abc")
+
+        new_config = dict(config)
+        new_config["foogroup"] = {"invites": {"ghi": 30}}
+        del new_config["bargroup"]
+        current = Snapshot(new_config, previous)
+
+        self.assertEqual(current.invite_index, {"ghi": ("foogroup", 30)})
+        self.assertEqual(current.find_invite("abc"), None)
+        self.assertEqual(previous.find_invite("def"), ("bargroup", 20))
+
+    def test_find_users(self):
+        """
+            Test finding users by a prefix of their name or id
+        """
+        config = {"foogroup": {"users": [{"id": 1337,
+                                          "username": "@FooUser"}],
+                               "unverified": ["@foobar", "@baruser"]},
+                  "bargroup": {"users": [{"id": 42, "username": "@foouser"}]}}
+        current = Snapshot(config)
+
+        self.assertEqual(current.find_users("@foo"), [
+            ("foogroup", "@foobar", None),
+            ("bargroup", "@foouser", 42),
+            ("foogroup", "@FooUser", 1337),
+        ])
+        self.assertEqual(current.find_users("133"),
+                         [("foogroup", "@FooUser", 1337)])
+        self.assertEqual(current.find_users("foo", limit=1),
+                         [("foogroup", "@foobar", None)])
+        self.assertEqual(current.find_users("baz"), [])
+
+    def test_update_search_index(self):
+        """
+            Test that the search index is updated for changed groups only
+        """
+        config = dict(("group{0}".format(i), {"unverified": [
+            "@user{0}".format(i)]}) for i in range(100))
+        previous = Snapshot(config)
+        previous.find_users("")
+
+        new_config = dict(config)
+        new_config["group3"] = {"users": [{"id": 3, "username": "@user3"}]}
+        del new_config["group4"]
+        current = Snapshot(new_config, previous)
+
+        self.assertIsNotNone(current.search_index)
+        self.assertEqual(current.search_index, sorted(
+            entry for name, group in current.groups.items()
+            for entry in group.search_entries(name)))
+        self.assertEqual(current.find_users("3"),
+                         [("group3", "@user3", 3)])
+        self.assertEqual(current.find_users("user4", limit=1),
+                         [("group40", "@user40", None)])
+
+    def test_grants(self):
+        """
+            Test looking up the global and chat scoped grants of a user
+        """
+        config = {"foogroup": {"users": [{"id": 1337,
+                                          "username": "@foouser"}],
+                               "chats": {-100: [42]}},
+                  "bargroup": {"chats": {-100: [1337], -200: [42]}},
+                  "bazgroup": {"users": [{"id": 42, "username": "@baz"}],
+                               "expires": {"@baz": 1}}}
+        current = Snapshot(config)
+
+        self.assertEqual(current.grants(1337), frozenset(["foogroup"]))
+        self.assertEqual(current.grants(1337, -100),
+                         frozenset(["foogroup", "bargroup"]))
+        self.assertEqual(current.grants(42, -100), frozenset(["foogroup"]))
+        self.assertEqual(current.grants(42, -300), frozenset())
+        self.assertEqual(current.grants(7, -100), frozenset())
+
+    def test_update_grant_index(self):
+        """
+            Test that the grant index is updated for changed groups only
+        """
+        config = dict(("group{0}".format(i), {"users": [
+            {"id": i, "username": "@user{0}".format(i)}]})
+                      for i in range(100))
+        previous = Snapshot(config)
+        previous.grants(1)
+
+        new_config = dict(config)
+        new_config["group3"] = {"chats": {-100: [5]}}
+        del new_config["group4"]
+        current = Snapshot(new_config, previous)
+
+        self.assertIsNotNone(current.grant_index)
+        self.assertEqual(current.grants(3, -100), frozenset())
+        self.assertEqual(current.grants(4), frozenset())
+        self.assertEqual(current.grants(5, -100),
+                         frozenset(["group5", "group3"]))
+        self.assertEqual(current.grants(5), frozenset(["group5"]))
+        self.assertEqual(previous.grants(3), frozenset(["group3"]))
+
+    def test_iter_users(self):
+        """
+            Test streaming and counting the users of several groups
+        """
+        config = {"foogroup": {"users": [{"id": 1, "username": "@foo"},
+                                         {"id": 2, "username": "@bar"}],
+                               "unverified": ["@baz", "@qux"]},
+                  "bargroup": {"users": [{"id": 2, "username": "@bar"},
+                                         {"id": 3, "username": "@quux"}],
+                               "unverified": ["@baz"]},
+                  "bazgroup": {"users": [{"id": 1, "username": "@foo"},
+                                         {"id": 4, "username": "@old"}],
+                               "expires": {"@old": 1}}}
+        current = Snapshot(config)
+        names = ["foogroup", "bargroup", "bazgroup"]
+
+        self.assertEqual(list(current.iter_users(names)),
+                         [("@foo", 1), ("@bar", 2), ("@quux", 3)])
+        self.assertEqual(
+            list(current.iter_users(names[:2], unverified=True)),
+            [("@foo", 1), ("@bar", 2), ("@baz", None), ("@qux", None),
+             ("@quux", 3)])
+        self.assertEqual(list(current.iter_users(
+            names[:2], "intersection", verified=False, unverified=True)),
+                         [("@baz", None)])
+        self.assertEqual(list(current.iter_users(["foogroup", "bazgroup"],
+                                                 "intersection")),
+                         [("@foo", 1)])
+        self.assertEqual(list(current.iter_users(["foogroup", "missing"],
+                                                 "intersection")), [])
+
+        for args in ((names, ), (names[:2], "union", True, True),
+                     (names[:2], "intersection", False, True),
+                     (["foogroup", "bazgroup"], "intersection"),
+                     (["bazgroup"], ), (["foogroup"], "union", True, True),
+                     (["missing"], )):
+            self.assertEqual(current.count_users(*args),
+                             len(list(current.iter_users(*args))))
+
+        with self.assertRaises(ValueError):
+            list(current.iter_users(names, "difference"))
+
+    def test_count_users_duplicates(self):
+        """
+            Test that counts agree with the streamed users
+        """
+        config = {"foogroup": {"users": [{"id": 1, "username": "@foo"},
+                                         {"id": 1, "username": "@foo"},
+                                         {"id": None, "username": "@bar"}],
+                               "unverified": ["@baz", "@baz"]},
+                  "bargroup": {"users": [{"id": 1, "username": "@foo"},
+                                         {"id": 2, "username": "@qux"},
+                                         {"id": 2, "username": "@qux"}],
+                               "expires": {"@qux": 10 ** 12}}}
+        current = Snapshot(config)
+
+        for args in ((["foogroup"], ), (["foogroup"], "union", True, True),
+                     (["foogroup", "bargroup"], ),
+                     (["foogroup", "bargroup"], "intersection"),
+                     (["bargroup"], )):
+            users = list(current.iter_users(*args))
+            self.assertEqual(len(users), len(set(users)))
+            self.assertEqual(current.count_users(*args), len(users))
+        self.assertEqual(current.count_users(["foogroup", "bargroup"]), 2)
+
+    def test_count_users_cached(self):
+        """
+            Test that counts are kept with the snapshot
+        """
+        config = {"foogroup": {"users": [{"id": 1, "username": "@foo"}]},
+                  "bargroup": {"users": [{"id": 2, "username": "@bar"}],
+                               "expires": {"@bar": 1}}}
+        current = Snapshot(config)
+
+        self.assertEqual(current.count_users(["foogroup", "foogroup"]), 1)
+        self.assertEqual(current.counts,
+                         {(("foogroup", "foogroup"), "union", True, False): 1})
+        self.assertEqual(current.count_users(["foogroup", "bargroup"]), 1)
+        self.assertEqual(len(current.counts), 1)
+
+    def test_stats(self):
+        """
+            Test the statistics of all groups
+        """
+        config = {"foogroup": {"users": [{"id": 1337,
+                                          "username": "@foouser"}],
+                               "unverified": ["@baruser"],
+                               "modified": 10},
+                  "bargroup": {"unverified": ["@bazuser", "@quxuser"]}}
+
+        self.assertEqual(Snapshot(config).stats(), [
+            {"name": "bargroup", "verified": 0, "unverified": 2,
+             "modified": None},
+            {"name": "foogroup", "verified": 1, "unverified": 1,
+             "modified": 10},
+        ])
+
+    def test_missing_group(self):
+        """
+            Test looking up a group which does not exist
+        """
+        group = Snapshot({}).group("foogroup")
+        self.assertFalse(group.ids)
+        self.assertEqual(group.data, {})
+
+    def test_reuse_unchanged_groups(self):
+        """
+            Test that untouched groups are not indexed again
+        """
+        config = {"foogroup": {"unverified": ["@foouser"]},
+                  "bargroup": {"unverified": ["@baruser"]}}
+        previous = Snapshot(config)
+
+        new_config = dict(config)
+        new_config["bargroup"] = {"unverified": []}
+        current = Snapshot(new_config, previous)
+
+        self.assertIs(current.group("foogroup"), previous.group("foogroup"))
+        self.assertIsNot(current.group("bargroup"),
+                         previous.group("bargroup"))
+
+    def test_publish_check(self):
+        """
+            Test that a conditional publish fails on a stale snapshot
+        """
+        store = Store()
+        first, second = Snapshot({}), Snapshot({})
+        self.assertTrue(store.publish(first, None))
+        self.assertFalse(store.publish(second, None, expected=None,
+                                       check=True))
+        self.assertIs(store.snapshot, first)
+        self.assertTrue(store.publish(second, None, expected=first,
+                                      check=True))
+        self.assertIs(store.snapshot, second)
+
+    def test_evict_writer(self):
+        """
+            Test that a snapshot isn't evicted while a writer holds the lock
+        """
+        store = Store()
+        store.publish(Snapshot({"foogroup": {}}), None)
+        locked = threading.Event()
+        release = threading.Event()
+
+        def write():
+            """Holds the write lock until released"""
+            with store.lock:
+                locked.set()
+                release.wait(5)
+
+        thread = threading.Thread(target=write)
+        thread.start()
+        locked.wait(5)
+        self.assertFalse(store.evict())
+        self.assertIsNotNone(store.snapshot)
+        release.set()
+        thread.join(5)
+
+        self.assertTrue(store.evict())
+        self.assertIsNone(store.snapshot)
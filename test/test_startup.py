@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+    Provides a unit test class for the ownbot.startup module.
+"""
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from mock import patch
+
+try:
+    from urllib.request import urlopen
+    from urllib.error import HTTPError
+except ImportError:  # python 2
+    from urllib2 import urlopen, HTTPError
+
+import ownbot
+import ownbot.usermanager
+from ownbot.startup import ReadinessProbe, warmup
+from ownbot.usermanager import UserManager
+
+
+class TestStartup(TestCase):  # pylint: disable=too-many-public-methods
+    """
+        Provides unit tests for the ownbot.startup module.
+    """
+
+    def setUp(self):
+        self.__tmpdir = tempfile.mkdtemp()
+        self.__patches = [
+            patch.object(UserManager, "CONFIG_DIR_PATH",
+                         os.path.join(self.__tmpdir, "config")),
+            patch.object(UserManager, "USERS_CONF_PATH",
+                         os.path.join(self.__tmpdir, "config", "users.yml")),
+        ]
+        for patcher in self.__patches:
+            patcher.start()
+
+    def tearDown(self):
+        for patcher in self.__patches:
+            patcher.stop()
+        shutil.rmtree(self.__tmpdir)
+
+    def test_warmup(self):
+        """
+            Test that the users are loaded and indexed
+        """
+        UserManager().add_user("@foouser", "foogroup", user_id=1337)
+        UserManager("foobot").add_user("@baruser", "foogroup")
+        path = os.path.join(self.__tmpdir, "ready.json")
+
+        with patch("ownbot.startup.gc") as gc_mock:
+            report = ownbot.warmup(tenants=["foobot"], modules=["json"],
+                                   readiness_file=path)
+            self.assertTrue(gc_mock.freeze.called)
+
+        self.assertTrue(report["ready"])
+        self.assertEqual(report["groups"], 2)
+        self.assertEqual(report["users"], 2)
+        self.assertGreater(report["size"], 0)
+        self.assertGreaterEqual(report["load_time"], 0)
+        with open(path) as readiness_file:
+            self.assertEqual(json.load(readiness_file), report)
+
+        store = ownbot.usermanager._get_store(  # pylint: disable=protected-access
+            UserManager.USERS_CONF_PATH)
+        self.assertIsNotNone(store.snapshot.search_index)
+        self.assertIsNotNone(store.snapshot.invite_index)
+        self.assertIsNotNone(store.snapshot.grant_index)
+
+    def test_warmup_creates_config_dir(self):
+        """
+            Test that warm-up works before any user was added
+        """
+        report = warmup(freeze=False)
+        self.assertEqual(report["users"], 0)
+        self.assertTrue(os.path.isdir(UserManager.CONFIG_DIR_PATH))
+
+    def test_readiness_probe(self):
+        """
+            Test that the probe reports 503 until warmed up
+        """
+        probe = ReadinessProbe(0)
+        try:
+            url = "http://{0}:{1}/ready".format(*probe.address)
+            with self.assertRaises(HTTPError) as context:
+                urlopen(url)
+            self.assertEqual(context.exception.code, 503)
+            context.exception.close()
+
+            report = warmup(freeze=False, probe=probe)
+            response = urlopen(url)
+            try:
+                self.assertEqual(response.getcode(), 200)
+                self.assertEqual(json.loads(response.read().decode("utf-8")),
+                                 report)
+            finally:
+                response.close()
+        finally:
+            probe.close()
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+    Provides a unit test class for the ownbot.tracing module.
+"""
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from mock import patch
+
+from ownbot import tracing
+from ownbot.usermanager import UserManager
+
+
+class TestTracing(TestCase):  # pylint: disable=too-many-public-methods
+    """
+        Provides unit tests for the ownbot.tracing module.
+    """
+
+    def setUp(self):
+        self.__tmpdir = tempfile.mkdtemp()
+        self.__path = os.path.join(self.__tmpdir, "traces.jsonl")
+
+    def tearDown(self):
+        tracing.disable()
+        shutil.rmtree(self.__tmpdir)
+
+    def __read(self):
+        """Returns the exported spans by name"""
+        tracing.disable()
+        with open(self.__path) as trace_file:
+            spans = [json.loads(line) for line in trace_file]
+        return dict((span["name"], span) for span in spans)
+
+    def test_disabled(self):
+        """
+            Test that nothing is recorded while tracing is disabled
+        """
+        with tracing.span("foo") as span:
+            tracing.set_attribute("foo", "bar")
+        self.assertIsNone(span)
+        self.assertFalse(os.path.exists(self.__path))
+
+    def test_parent_child(self):
+        """
+            Test that nested spans belong to the same trace
+        """
+        tracing.enable(self.__path)
+        with tracing.span("parent", foo="bar"):
+            with tracing.span("child"):
+                tracing.set_attribute("cache_hit", True)
+
+        spans = self.__read()
+        parent, child = spans["parent"], spans["child"]
+        self.assertEqual(parent["traceId"], child["traceId"])
+        self.assertEqual(child["parentSpanId"], parent["spanId"])
+        self.assertIsNone(parent["parentSpanId"])
+        self.assertEqual(parent["attributes"], {"foo": "bar"})
+        self.assertEqual(child["attributes"], {"cache_hit": True})
+        self.assertLessEqual(parent["startTimeUnixNano"],
+                             child["startTimeUnixNano"])
+        self.assertEqual(child["status"], {"code": "OK"})
+
+    def test_error(self):
+        """
+            Test that an exception is recorded in the span's status
+        """
+        tracing.enable(self.__path)
+
+        @tracing.traced("foo")
+        def fail():
+            """Raises a KeyError"""
+            raise KeyError("foo")
+
+        with self.assertRaises(KeyError):
+            fail()
+        self.assertEqual(self.__read()["foo"]["status"],
+                         {"code": "ERROR", "message": "KeyError"})
+
+    def test_sampling(self):
+        """
+            Test that unsampled traces are dropped completely
+        """
+        tracing.enable(self.__path, sample_rate=0.0)
+        with tracing.span("parent") as parent:
+            with tracing.span("child") as child:
+                pass
+
+        self.assertIsNone(parent)
+        self.assertIsNone(child)
+        self.assertEqual(tracing.get_tracer().exporter.written, 0)
+
+    def test_usermanager(self):
+        """
+            Test that the storage accesses of a UserManager call are traced
+        """
+        with patch.object(UserManager, "CONFIG_DIR_PATH", self.__tmpdir), \
+                patch.object(UserManager, "USERS_CONF_PATH",
+                             os.path.join(self.__tmpdir, "users.yml")):
+            usrmgr = UserManager()
+            usrmgr.add_user("@foouser", "foogroup", user_id=1337)
+            with open(UserManager.USERS_CONF_PATH, "a") as config_file:
+                config_file.write("\n")
+
+            tracing.enable(self.__path)
+            with tracing.span("request"):
+                self.assertTrue(usrmgr.user_is_in_group("foogroup",
+                                                        user_id=1337))
+
+        spans = self.__read()
+        call = spans["UserManager.user_is_in_group"]
+        load = spans["storage.load"]
+        self.assertEqual(call["parentSpanId"], spans["request"]["spanId"])
+        self.assertEqual(load["parentSpanId"], call["spanId"])
+        self.assertFalse(load["attributes"]["cache_hit"])
+        self.assertGreater(load["attributes"]["bytes_read"], 0)
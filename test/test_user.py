@@ -42,9 +42,11 @@ class TestUser(TestCase):  # pylint: disable=too-many-public-methods
         """
         user, usrmgr_mock = self.__get_test_instance(
             "@foouser", 1337, group="foogroup")
-        usrmgr_mock.return_value.user_is_in_group.return_value = True
+        usrmgr_mock.return_value.get_user_groups.return_value = \
+            frozenset(["foogroup"])
         with patch.object(user, "save"):
-            user.has_access("foogroup")
+            self.assertTrue(user.has_access("foogroup"))
+        self.assertFalse(usrmgr_mock.return_value.verify_user.called)
 
     def test_has_access_is_not_in_group(self):
         """
@@ -52,7 +54,19 @@ class TestUser(TestCase):  # pylint: disable=too-many-public-methods
         """
         user, usrmgr_mock = self.__get_test_instance(
             "@foouser", 1337, group="bargroup")
-        usrmgr_mock.return_value.user_is_in_group.return_value = False
+        usrmgr_mock.return_value.get_user_groups.return_value = frozenset()
         usrmgr_mock.return_value.verify_user.return_value = False
         with patch.object(user, "save"):
-            user.has_access("foogroup")
+            self.assertFalse(user.has_access("foogroup"))
+
+    def test_has_access_in_chat(self):
+        """
+            Test has access checks the grants of the passed chat
+        """
+        user, usrmgr_mock = self.__get_test_instance("@foouser", 1337)
+        usrmgr_mock.return_value.get_user_groups.return_value = \
+            frozenset(["admin"])
+        with patch.object(user, "save"):
+            self.assertTrue(user.has_access("foogroup", chat_id=-100))
+        usrmgr_mock.return_value.get_user_groups.assert_called_once_with(
+            1337, chat_id=-100)
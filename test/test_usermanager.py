@@ -3,11 +3,23 @@
     Provides a unit test class for the ownbot.usermanager module.
 """
 import io
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
 
 from unittest import TestCase
-from mock import patch
+from mock import ANY, patch
 
-from ownbot.usermanager import UserManager
+import yaml
+
+import ownbot.usermanager
+from ownbot.cache import ResponseCache
+from ownbot.mapped import MappedSnapshot
+from ownbot.user import User
+from ownbot.usermanager import TransactionConflict, UserManager
 
 
 class TestUserManager(TestCase):  # pylint: disable=too-many-public-methods
@@ -93,8 +105,12 @@ foogroup:
             Test save config
         """
         usrmgr = self.__get_dummy_object()
-        with patch("ownbot.usermanager.open"):
+        with patch("ownbot.usermanager.open") as open_mock,\
+                patch("ownbot.compat.replace") as replace_mock:
             usrmgr.config = {}
+            tmp_path = open_mock.call_args[0][0]
+            replace_mock.assert_called_with(tmp_path,
+                                            UserManager.USERS_CONF_PATH)
 
     def test_userid_is_verified_grp(self):
         """
@@ -230,7 +246,8 @@ foogroup:
             self.assertTrue(result)
             expected_config = {
                 "foogroup": {"users": [{"id": 1337,
-                                        "username": "@foouser"}]}
+                                        "username": "@foouser"}],
+                             "modified": ANY}
             }
             self.assertEqual(usrmgr.config, expected_config)
 
@@ -258,7 +275,9 @@ foogroup:
                 patch.object(usrmgr, "_UserManager__save_config"):
             result = usrmgr.add_user("@foouser", "foogroup")
             self.assertTrue(result)
-            expected_config = {"foogroup": {"unverified": ["@foouser"]}}
+            expected_config = {"foogroup": {"unverified": ["@foouser"],
+                                            "invited": {"@foouser": ANY},
+                                            "modified": ANY}}
             self.assertEqual(usrmgr.config, expected_config)
 
     def test_add_user_verified(self):
@@ -274,7 +293,8 @@ foogroup:
             self.assertTrue(result)
             expected_config = {
                 "foogroup": {"users": [{"id": 1337,
-                                        "username": "@foouser"}]}
+                                        "username": "@foouser"}],
+                             "modified": ANY}
             }
             self.assertEqual(usrmgr.config, expected_config)
 
@@ -346,3 +366,727 @@ foogroup:
                 patch.object(usrmgr, "_UserManager__save_config"):
             result = usrmgr.get_users("foogroup")
             self.assertEqual(result, [{"id": 1337, "username": "@foouser"}])
+
+
+class TestUserManagerConcurrency(TestCase):  # pylint: disable=too-many-public-methods
+    """
+        Provides multithreaded stress tests for the ownbot.usermanager module.
+    """
+
+    USERS_PER_WORKER = 3
+
+    def setUp(self):
+        self.__tmpdir = tempfile.mkdtemp()
+        self.__patches = [
+            patch.object(UserManager, "CONFIG_DIR_PATH", self.__tmpdir),
+            patch.object(UserManager, "USERS_CONF_PATH",
+                         os.path.join(self.__tmpdir, "users.yml")),
+        ]
+        for patcher in self.__patches:
+            patcher.start()
+
+    def tearDown(self):
+        # Stops the sweepers before their files are removed
+        for path in list(ownbot.usermanager._STORES):  # pylint: disable=protected-access
+            if path.startswith(self.__tmpdir):
+                ownbot.usermanager._drop_store(path)  # pylint: disable=protected-access
+        for patcher in self.__patches:
+            patcher.stop()
+        shutil.rmtree(self.__tmpdir)
+
+    def __run_workers(self, workers):
+        """Adds and verifies users from concurrent threads.
+
+            Returns:
+                float: The measured operations per second.
+        """
+        errors = []
+
+        def work(worker):
+            """Adds, verifies and looks up users of one worker"""
+            try:
+                usrmgr = UserManager()
+                for i in range(self.USERS_PER_WORKER):
+                    name = "@user{0}_{1}_{2}".format(workers, worker, i)
+                    usrmgr.add_user(name, "unverified{0}".format(workers))
+                    usrmgr.add_user(name, "group{0}".format(workers))
+                    usrmgr.verify_user(worker * 1000 + i, name,
+                                       "group{0}".format(workers))
+                    usrmgr.user_is_in_group("group{0}".format(workers),
+                                            user_id=worker * 1000 + i)
+            except Exception as exc:  # pylint: disable=broad-except
+                errors.append(exc)
+
+        threads = [threading.Thread(target=work, args=(worker, ))
+                   for worker in range(workers)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+
+        self.assertEqual(errors, [])
+        return workers * self.USERS_PER_WORKER * 4 / elapsed
+
+    def test_no_lost_updates(self):
+        """
+            Test that concurrent mutations don't overwrite each other
+        """
+        log = logging.getLogger(__name__)
+        for workers in (1, 4, 16):
+            throughput = self.__run_workers(workers)
+            log.info("%d workers: %.0f ops/s", workers, throughput)
+
+            usrmgr = UserManager()
+            expected = workers * self.USERS_PER_WORKER
+            unverified = usrmgr.config["unverified{0}".format(workers)]
+            self.assertEqual(len(unverified["unverified"]), expected)
+            self.assertEqual(
+                len(usrmgr.get_users("group{0}".format(workers))), expected)
+            self.assertNotIn("unverified",
+                             usrmgr.config["group{0}".format(workers)])
+
+    def test_reads_dont_wait_for_writers(self):
+        """
+            Test that lookups don't block while a writer holds the lock
+        """
+        usrmgr = UserManager()
+        usrmgr.add_user("@foouser", "foogroup", user_id=1337)
+        store = ownbot.usermanager._get_store(  # pylint: disable=protected-access
+            UserManager.USERS_CONF_PATH)
+        results = []
+
+        def read():
+            """Looks up the user"""
+            results.append(UserManager().user_is_in_group("foogroup",
+                                                          user_id=1337))
+
+        with store.lock:
+            thread = threading.Thread(target=read)
+            thread.start()
+            thread.join(5)
+
+        self.assertEqual(results, [True])
+
+    def test_reload_on_external_change(self):
+        """
+            Test that a modified configuration file is loaded again
+        """
+        usrmgr = UserManager()
+        usrmgr.add_user("@foouser", "foogroup")
+        self.assertTrue(usrmgr.user_is_in_group("foogroup",
+                                                username="@foouser"))
+
+        with open(UserManager.USERS_CONF_PATH, "w") as config_file:
+            config_file.write("bargroup:\n  unverified:\n  - '@baruser'\n")
+
+        self.assertFalse(usrmgr.user_is_in_group("foogroup",
+                                                 username="@foouser"))
+        self.assertTrue(usrmgr.user_is_in_group("bargroup",
+                                                username="@baruser"))
+
+    def test_expiring_membership(self):
+        """
+            Test that an expired membership is absent and removed
+        """
+        usrmgr = UserManager()
+        usrmgr.add_user("@foouser", "foogroup", user_id=1337,
+                        expires=time.time() + 0.2)
+        usrmgr.add_user("@baruser", "foogroup")
+        self.assertTrue(usrmgr.user_is_in_group("foogroup", user_id=1337))
+
+        time.sleep(0.2)
+        self.assertFalse(usrmgr.user_is_in_group("foogroup", user_id=1337))
+        self.assertEqual(usrmgr.get_users("foogroup"), [])
+
+        # The sweeper publishes the change before writing the file
+        store = ownbot.usermanager._get_store(  # pylint: disable=protected-access
+            UserManager.USERS_CONF_PATH)
+        for _ in range(500):
+            if not store.generation % 2:
+                with open(UserManager.USERS_CONF_PATH) as config_file:
+                    if "users" not in yaml.safe_load(config_file)["foogroup"]:
+                        break
+            time.sleep(0.01)
+        self.assertEqual(usrmgr.config, {"foogroup": {
+            "unverified": ["@baruser"], "invited": {"@baruser": ANY},
+            "modified": ANY}})
+
+    def test_sweep_expired(self):
+        """
+            Test that expired memberships are removed with a single write
+        """
+        usrmgr = UserManager()
+        now = time.time()
+        # keep the sweeper from removing the memberships first
+        with patch("ownbot.usermanager.Sweeper"):
+            usrmgr.config = {
+                "foogroup": {
+                    "unverified": ["@foouser", "@baruser"],
+                    "expires": {"@foouser": now - 2, "@baruser": now + 60}
+                },
+                "bargroup": {
+                    "users": [{"id": 1337, "username": "@bazuser"}],
+                    "expires": {"@bazuser": now - 1}
+                }
+            }
+        self.assertFalse(usrmgr.user_is_unverified_in_group("foogroup",
+                                                             "@foouser"))
+        self.assertFalse(usrmgr.userid_is_verified_in_group("bargroup",
+                                                            1337))
+
+        writes = usrmgr.storage_stats["writes"]
+        self.assertEqual(usrmgr.sweep(now), 2)
+        self.assertEqual(usrmgr.storage_stats["writes"], writes + 1)
+        self.assertEqual(usrmgr.config, {"foogroup": {
+            "unverified": ["@baruser"],
+            "expires": {"@baruser": now + 60},
+            "modified": now
+        }})
+        self.assertEqual(usrmgr.sweep(now), 0)
+
+    def test_readd_expired_user(self):
+        """
+            Test adding a user again whose membership expired
+        """
+        usrmgr = UserManager()
+        with patch("ownbot.usermanager.Sweeper"):
+            usrmgr.config = {"foogroup": {"unverified": ["@foouser"],
+                                          "expires": {"@foouser": 1}}}
+
+        self.assertTrue(usrmgr.add_user("@foouser", "foogroup"))
+        self.assertEqual(usrmgr.config, {"foogroup": {
+            "unverified": ["@foouser"], "invited": {"@foouser": ANY},
+            "modified": ANY}})
+
+    def test_sweep_stale_unverified(self):
+        """
+            Test that unverified users are removed after the TTL
+        """
+        usrmgr = UserManager()
+        now = time.time()
+        with patch("ownbot.usermanager.Sweeper"):
+            usrmgr.config = {
+                "foogroup": {
+                    "unverified": ["@foouser", "@baruser", "@legacy"],
+                    "invited": {"@foouser": now - 100, "@baruser": now - 5}
+                }
+            }
+
+        with patch.object(UserManager, "UNVERIFIED_TTL", 10):
+            self.assertEqual(usrmgr.sweep(now), 1)
+            self.assertEqual(usrmgr.config, {"foogroup": {
+                "unverified": ["@baruser", "@legacy"],
+                "invited": {"@baruser": now - 5},
+                "modified": now
+            }})
+            self.assertEqual(usrmgr.sweep(now + 10), 1)
+
+        with patch.object(UserManager, "UNVERIFIED_TTL", None):
+            usrmgr.add_user("@bazuser", "foogroup")
+            self.assertEqual(usrmgr.sweep(now + 10 ** 9), 0)
+
+        self.assertEqual(usrmgr.config["foogroup"]["unverified"],
+                         ["@legacy", "@bazuser"])
+
+    def test_verify_drops_invitation(self):
+        """
+            Test that verifying a user removes the invitation time
+        """
+        usrmgr = UserManager()
+        usrmgr.add_user("@foouser", "foogroup")
+        usrmgr.verify_user(1337, "@foouser", "foogroup")
+
+        self.assertEqual(usrmgr.config, {"foogroup": {
+            "users": [{"id": 1337, "username": "@foouser"}],
+            "modified": ANY}})
+
+    def test_get_pending_users(self):
+        """
+            Test listing the unverified users, the oldest first
+        """
+        usrmgr = UserManager()
+        with patch("ownbot.usermanager.Sweeper"):
+            usrmgr.config = {
+                "foogroup": {"unverified": ["@foouser", "@legacy"],
+                             "invited": {"@foouser": 20}},
+                "bargroup": {"unverified": ["@baruser"],
+                             "invited": {"@baruser": 10}}
+            }
+
+        self.assertEqual(usrmgr.get_pending_users(), [
+            {"group": "foogroup", "username": "@legacy", "invited": None},
+            {"group": "bargroup", "username": "@baruser", "invited": 10},
+            {"group": "foogroup", "username": "@foouser", "invited": 20},
+        ])
+
+    def test_invite(self):
+        """
+            Test redeeming a one-time invite token
+        """
+        usrmgr = UserManager()
+        usrmgr.add_user("@foouser", "foogroup")
+        token = usrmgr.create_invite("foogroup")
+
+        self.assertTrue(token.startswith(UserManager.INVITE_PREFIX))
+        with open(UserManager.USERS_CONF_PATH) as config_file:
+            self.assertNotIn(token, config_file.read())
+        self.assertEqual(usrmgr.redeem_invite(token, 1337, "@foouser"),
+                         "foogroup")
+        self.assertEqual(usrmgr.config, {"foogroup": {
+            "users": [{"id": 1337, "username": "@foouser"}],
+            "modified": ANY}})
+        self.assertIsNone(usrmgr.redeem_invite(token, 1338, "@baruser"))
+
+    def test_invite_expired(self):
+        """
+            Test that expired invite tokens are rejected and removed
+        """
+        usrmgr = UserManager()
+        with patch("ownbot.usermanager.Sweeper"):
+            token = usrmgr.create_invite("foogroup",
+                                         expires=time.time() - 1)
+
+        self.assertTrue(usrmgr.group_is_empty("foogroup"))
+        self.assertIsNone(usrmgr.redeem_invite(token, 1337, "@foouser"))
+        self.assertEqual(usrmgr.sweep(), 1)
+        self.assertEqual(usrmgr.config, {})
+
+    def test_find_users(self):
+        """
+            Test finding users after mutations
+        """
+        usrmgr = UserManager()
+        usrmgr.add_user("@foouser", "foogroup", user_id=1337)
+        self.assertEqual(usrmgr.find_users("foo"), [
+            {"group": "foogroup", "username": "@foouser", "id": 1337}])
+
+        usrmgr.add_user("@fooman", "bargroup")
+        usrmgr.rm_user("@foouser", "foogroup")
+        self.assertEqual(usrmgr.find_users("@FOO"), [
+            {"group": "bargroup", "username": "@fooman", "id": None}])
+
+    def test_group_stats(self):
+        """
+            Test that the group statistics follow the mutations
+        """
+        usrmgr = UserManager()
+        before = time.time()
+        usrmgr.add_user("@foouser", "foogroup", user_id=1337)
+        usrmgr.add_user("@baruser", "foogroup")
+        usrmgr.add_user("@bazuser", "bargroup")
+        usrmgr.rm_user("@bazuser", "bargroup")
+
+        stats = usrmgr.get_group_stats()
+        self.assertEqual(len(stats), 1)
+        self.assertEqual(stats[0]["name"], "foogroup")
+        self.assertEqual(stats[0]["verified"], 1)
+        self.assertEqual(stats[0]["unverified"], 1)
+        self.assertGreaterEqual(stats[0]["modified"], before)
+
+    def test_mapped_snapshot(self):
+        """
+            Test that the binary snapshot is written after changes
+        """
+        path = os.path.join(self.__tmpdir, "users.bin")
+        with patch.object(UserManager, "MAPPED_SNAPSHOT_PATH", path):
+            usrmgr = UserManager()
+            usrmgr.add_user("@foouser", "foogroup", user_id=1337)
+            mapped = MappedSnapshot(path, check_interval=None)
+            self.assertTrue(mapped.user_is_in_group("foogroup",
+                                                    user_id=1337))
+
+            usrmgr.rm_user("@foouser", "foogroup")
+            self.assertTrue(mapped.refresh())
+            self.assertFalse(mapped.user_is_in_group("foogroup",
+                                                     user_id=1337))
+
+    def test_mapped_snapshot_export_race(self):
+        """
+            Test that a slow export of a reader doesn't replace a newer one
+        """
+        path = os.path.join(self.__tmpdir, "users.bin")
+        export = ownbot.mapped.export
+        writers = []
+
+        def slow_export(config, export_path):
+            """Lets a writer run while the first export is written"""
+            if not writers:
+                writer = threading.Thread(target=usrmgr.add_user,
+                                          args=("@baruser", "bargroup"),
+                                          kwargs={"user_id": 42})
+                writers.append(writer)
+                writer.start()
+                writer.join(0.2)
+            export(config, export_path)
+
+        with patch.object(UserManager, "MAPPED_SNAPSHOT_PATH", path):
+            usrmgr = UserManager()
+            usrmgr.add_user("@foouser", "foogroup", user_id=1337)
+            with open(UserManager.USERS_CONF_PATH, "w") as config_file:
+                config_file.write("foogroup:\n  unverified:\n  - '@foo'\n")
+
+            with patch("ownbot.mapped.export", side_effect=slow_export):
+                usrmgr.user_is_in_group("foogroup", username="@foo")
+                writers[0].join(5)
+
+            mapped = MappedSnapshot(path, check_interval=None)
+            self.assertTrue(mapped.user_is_in_group("bargroup", user_id=42))
+
+    def test_transaction(self):
+        """
+            Test that a transaction is saved once and isolated until done
+        """
+        usrmgr = UserManager()
+        usrmgr.add_user("@foouser", "foogroup", user_id=1337)
+        writes = usrmgr.storage_stats["writes"]
+        seen = []
+
+        with usrmgr.transaction():
+            usrmgr.rm_user("@foouser", "foogroup")
+            usrmgr.add_user("@foouser", "bargroup", user_id=1337)
+            self.assertTrue(usrmgr.user_is_in_group("bargroup",
+                                                    user_id=1337))
+
+            thread = threading.Thread(target=lambda: seen.append(
+                UserManager().user_is_in_group("foogroup", user_id=1337)))
+            thread.start()
+            thread.join()
+
+        self.assertEqual(seen, [True])
+        self.assertEqual(usrmgr.storage_stats["writes"], writes + 1)
+        self.assertFalse(usrmgr.user_is_in_group("foogroup", user_id=1337))
+        self.assertTrue(usrmgr.user_is_in_group("bargroup", user_id=1337))
+
+    def test_transaction_rollback(self):
+        """
+            Test that nothing is saved if a transaction fails
+        """
+        usrmgr = UserManager()
+        with self.assertRaises(KeyError):
+            with usrmgr.transaction():
+                usrmgr.add_user("@foouser", "foogroup")
+                raise KeyError("foo")
+
+        self.assertEqual(usrmgr.config, {})
+
+    def test_transaction_replay(self):
+        """
+            Test that a transaction is replayed on a concurrent change
+        """
+        usrmgr = UserManager()
+        with usrmgr.transaction():
+            self.assertTrue(usrmgr.add_user("@foouser", "foogroup"))
+            thread = threading.Thread(
+                target=lambda: UserManager().add_user("@baruser", "foogroup"))
+            thread.start()
+            thread.join()
+
+        self.assertEqual(usrmgr.config["foogroup"]["unverified"],
+                         ["@baruser", "@foouser"])
+
+    def test_transaction_conflict(self):
+        """
+            Test that a replay with another result fails
+        """
+        usrmgr = UserManager()
+        with self.assertRaises(TransactionConflict):
+            with usrmgr.transaction():
+                self.assertTrue(usrmgr.add_user("@foouser", "foogroup"))
+                thread = threading.Thread(
+                    target=lambda: UserManager().add_user(
+                        "@foouser", "foogroup", user_id=1337))
+                thread.start()
+                thread.join()
+
+        self.assertEqual(usrmgr.get_users("foogroup"),
+                         [{"id": 1337, "username": "@foouser"}])
+
+    def test_tenants(self):
+        """
+            Test that the users of tenants are stored separately
+        """
+        UserManager("foobot").add_user("@foouser", "foogroup", user_id=1337)
+        with ownbot.usermanager.using_tenant("barbot"):
+            UserManager().add_user("@baruser", "foogroup", user_id=42)
+
+        self.assertEqual(UserManager().config, {})
+        self.assertEqual(UserManager("foobot").get_users("foogroup"),
+                         [{"id": 1337, "username": "@foouser"}])
+        self.assertEqual(UserManager("barbot").get_users("foogroup"),
+                         [{"id": 42, "username": "@baruser"}])
+        self.assertTrue(os.path.isfile(os.path.join(
+            self.__tmpdir, "tenants", "foobot", "users.yml")))
+
+    def test_tenant_mapped_snapshots(self):
+        """
+            Test that every tenant writes its own binary snapshot
+        """
+        path = os.path.join(self.__tmpdir, "users.bin")
+        with patch.object(UserManager, "MAPPED_SNAPSHOT_PATH", path):
+            UserManager("foobot").add_user("@alice", "admin", user_id=1)
+            UserManager("barbot").add_user("@bob", "admin", user_id=2)
+
+        foo = MappedSnapshot(os.path.join(self.__tmpdir, "tenants", "foobot",
+                                          "users.bin"), check_interval=None)
+        bar = MappedSnapshot(os.path.join(self.__tmpdir, "tenants", "barbot",
+                                          "users.bin"), check_interval=None)
+        self.assertTrue(foo.user_is_in_group("admin", user_id=1))
+        self.assertFalse(foo.user_is_in_group("admin", user_id=2))
+        self.assertTrue(bar.user_is_in_group("admin", user_id=2))
+        self.assertFalse(bar.user_is_in_group("admin", user_id=1))
+        self.assertFalse(os.path.exists(path))
+
+    def test_temporary_store(self):
+        """
+            Test that a temporary store leaves the configured users alone
+        """
+        path = os.path.join(self.__tmpdir, "users.bin")
+        with patch.object(UserManager, "MAPPED_SNAPSHOT_PATH", path):
+            UserManager().add_user("@alice", "admin", user_id=1)
+            stores = list(ownbot.usermanager._STORES)  # pylint: disable=protected-access
+            with ownbot.usermanager.temporary_store() as tenant:
+                usrmgr = UserManager(tenant)
+                usrmgr.add_user("@bob", "admin", user_id=2,
+                                expires=time.time() + 60)
+                directory = usrmgr.CONFIG_DIR_PATH
+                self.assertTrue(os.path.exists(usrmgr.USERS_CONF_PATH))
+                self.assertIsNone(usrmgr.MAPPED_SNAPSHOT_PATH)
+                self.assertFalse(UserManager().user_is_in_group("admin",
+                                                                user_id=2))
+
+        self.assertFalse(os.path.exists(directory))
+        self.assertEqual(list(ownbot.usermanager._STORES),  # pylint: disable=protected-access
+                         stores)
+        self.assertEqual(UserManager.USERS_CONF_PATH,
+                         os.path.join(self.__tmpdir, "users.yml"))
+        mapped = MappedSnapshot(path, check_interval=None)
+        self.assertTrue(mapped.user_is_in_group("admin", user_id=1))
+        self.assertFalse(mapped.user_is_in_group("admin", user_id=2))
+
+    def test_invalid_tenant(self):
+        """
+            Test that a tenant must not contain a path
+        """
+        for tenant in ("", ".", "..", os.path.join("foo", "bar")):
+            with self.assertRaises(ValueError):
+                UserManager(tenant)
+
+    def test_evict_while_loading(self):
+        """
+            Test that an eviction after loading doesn't lose any groups
+        """
+        usrmgr = UserManager()
+        usrmgr.add_user("@foouser", "foogroup", user_id=1337)
+        store = ownbot.usermanager._get_store(  # pylint: disable=protected-access
+            UserManager.USERS_CONF_PATH)
+        load_config = usrmgr._UserManager__load_config  # pylint: disable=protected-access
+        evicted = []
+
+        def load_and_evict():
+            """Loads the file and evicts the snapshot from another thread"""
+            load_config()
+            # The load after an eviction gets through
+            if evicted and evicted[-1] is True:
+                evicted.append(None)
+                return
+            thread = threading.Thread(
+                target=lambda: evicted.append(store.evict()))
+            thread.start()
+            thread.join(5)
+
+        with patch.object(usrmgr, "_UserManager__load_config",
+                          side_effect=load_and_evict):
+            usrmgr.add_user("@baruser", "bargroup", user_id=42)
+            self.assertTrue(usrmgr.user_is_in_group("foogroup",
+                                                    user_id=1337))
+
+        # Readers loaded again, the writer's base was never evicted
+        self.assertIn(True, evicted)
+        self.assertIn(False, evicted)
+        self.assertTrue(usrmgr.user_is_in_group("foogroup", user_id=1337))
+        self.assertTrue(usrmgr.user_is_in_group("bargroup", user_id=42))
+        with open(UserManager.USERS_CONF_PATH) as config_file:
+            self.assertEqual(sorted(yaml.safe_load(config_file)),
+                             ["bargroup", "foogroup"])
+
+    def test_memory_budget(self):
+        """
+            Test that the least recently used tenants are evicted
+        """
+        for tenant in ("foobot", "barbot", "bazbot"):
+            UserManager(tenant).add_user("@foouser", "foogroup",
+                                         user_id=1337)
+        stores = ownbot.usermanager._STORES  # pylint: disable=protected-access
+        paths = dict((tenant, UserManager(tenant).USERS_CONF_PATH)
+                     for tenant in ("foobot", "barbot", "bazbot"))
+        for tenant in ("foobot", "barbot", "bazbot"):
+            stores[paths[tenant]].evict()
+            self.assertTrue(UserManager(tenant).user_is_in_group(
+                "foogroup", user_id=1337))
+
+        budget = stores[paths["foobot"]].snapshot.size
+        with patch.object(UserManager, "MEMORY_BUDGET", budget):
+            stores[paths["foobot"]].evict()
+            self.assertTrue(UserManager("foobot").user_is_in_group(
+                "foogroup", user_id=1337))
+
+        self.assertIsNotNone(stores[paths["foobot"]].snapshot)
+        self.assertIsNone(stores[paths["barbot"]].snapshot)
+        self.assertIsNone(stores[paths["bazbot"]].snapshot)
+        reads = UserManager("barbot").storage_stats["reads"]
+        self.assertTrue(UserManager("barbot").user_is_in_group(
+            "foogroup", user_id=1337))
+        self.assertEqual(UserManager("barbot").storage_stats["reads"],
+                         reads + 1)
+
+    def test_save_config_atomic(self):
+        """
+            Test that the configuration file is replaced, not rewritten
+        """
+        usrmgr = UserManager()
+        usrmgr.add_user("@foouser", "foogroup")
+        with open(UserManager.USERS_CONF_PATH) as config_file:
+            usrmgr.add_user("@baruser", "foogroup")
+            self.assertNotIn("@baruser", config_file.read())
+
+        self.assertEqual(os.listdir(self.__tmpdir), ["users.yml"])
+
+    def test_backup_restore(self):
+        """
+            Test restoring a backup
+        """
+        usrmgr = UserManager()
+        usrmgr.add_user("@foouser", "foogroup", user_id=1337)
+        with patch.object(UserManager, "BACKUP_COUNT", 1):
+            usrmgr.backup()
+            path = usrmgr.backup()
+        self.assertEqual(usrmgr.get_backups(), [path])
+
+        usrmgr.rm_user("@foouser", "foogroup")
+        usrmgr.add_user("@baruser", "bargroup", expires=time.time() + 60)
+        with usrmgr.transaction():
+            usrmgr.restore(path)
+            self.assertFalse(usrmgr.user_is_in_group("bargroup",
+                                                     username="@baruser"))
+
+        self.assertTrue(usrmgr.user_is_in_group("foogroup", user_id=1337))
+        self.assertFalse(usrmgr.user_is_in_group("bargroup",
+                                                 username="@baruser"))
+        self.assertEqual(UserManager().find_users("@bar"), [])
+
+    def test_restore_clears_caches(self):
+        """
+            Test that restoring a backup drops the cached replies
+        """
+        usrmgr = UserManager()
+        usrmgr.add_user("@foouser", "foogroup", user_id=1337)
+        path = usrmgr.backup()
+        cache = ResponseCache(60)
+        cache.get("/users", lambda: ("@foouser", True))
+
+        with usrmgr.transaction():
+            usrmgr.restore(path)
+            self.assertEqual(len(cache), 1)
+        self.assertEqual(len(cache), 0)
+
+        cache.get("/users", lambda: ("@foouser", True))
+        usrmgr.restore(path)
+        self.assertEqual(len(cache), 0)
+        # the restored file is read by new processes
+        store = ownbot.usermanager._STORES.pop(  # pylint: disable=protected-access
+            UserManager.USERS_CONF_PATH)
+        try:
+            self.assertTrue(UserManager().user_is_in_group("foogroup",
+                                                           user_id=1337))
+        finally:
+            ownbot.usermanager._STORES[  # pylint: disable=protected-access
+                UserManager.USERS_CONF_PATH] = store
+
+    def test_restore_invalid(self):
+        """
+            Test that an invalid backup changes nothing
+        """
+        usrmgr = UserManager()
+        usrmgr.add_user("@foouser", "foogroup", user_id=1337)
+        path = os.path.join(self.__tmpdir, "invalid.yml")
+        with open(path, "w") as backup_file:
+            backup_file.write("foogroup: [foo]")
+
+        with self.assertRaises(ValueError):
+            usrmgr.restore(path)
+        self.assertTrue(usrmgr.user_is_in_group("foogroup", user_id=1337))
+
+    def test_chat_grants(self):
+        """
+            Test that chat grants apply within their chat only
+        """
+        usrmgr = UserManager()
+        usrmgr.add_user("@foouser", "foogroup", user_id=1337)
+        self.assertTrue(usrmgr.grant_in_chat(42, "moderators", -100))
+        self.assertFalse(usrmgr.grant_in_chat(42, "moderators", -100))
+        self.assertTrue(usrmgr.grant_in_chat(1337, "moderators", -200))
+
+        self.assertTrue(usrmgr.user_is_in_group("moderators", user_id=42,
+                                                chat_id=-100))
+        self.assertFalse(usrmgr.user_is_in_group("moderators", user_id=42,
+                                                 chat_id=-200))
+        self.assertFalse(usrmgr.user_is_in_group("moderators", user_id=42))
+        self.assertEqual(usrmgr.get_user_groups(1337, chat_id=-200),
+                         frozenset(["foogroup", "moderators"]))
+        self.assertEqual(usrmgr.get_chat_grants(-100), [
+            {"group": "moderators", "chat_id": -100, "id": 42}])
+
+        with open(UserManager.USERS_CONF_PATH) as config_file:
+            saved = yaml.safe_load(config_file)
+        self.assertEqual(saved["moderators"]["chats"],
+                         {-100: [42], -200: [1337]})
+
+        self.assertTrue(usrmgr.revoke_in_chat(42, "moderators", -100))
+        self.assertFalse(usrmgr.revoke_in_chat(42, "moderators", -100))
+        self.assertEqual(usrmgr.get_user_groups(42, chat_id=-100),
+                         frozenset())
+        self.assertTrue(usrmgr.revoke_in_chat(1337, "moderators", -200))
+        self.assertNotIn("moderators", usrmgr.config)
+
+    def test_chat_grants_single_read(self):
+        """
+            Test that checking a user reads the snapshot once per group
+        """
+        usrmgr = UserManager()
+        usrmgr.add_user("@foouser", "foogroup", user_id=1337)
+        usrmgr.grant_in_chat(1337, "bargroup", -100)
+        user = User("@foouser", 1337)
+
+        with patch.object(UserManager, "_UserManager__get_snapshot",
+                          autospec=True,
+                          side_effect=getattr(
+                              UserManager,
+                              "_UserManager__get_snapshot")) as get_mock:
+            self.assertTrue(user.has_access("bargroup", chat_id=-100))
+            self.assertEqual(get_mock.call_count, 1)
+
+    def test_iter_users(self):
+        """
+            Test streaming the users of several groups
+        """
+        usrmgr = UserManager()
+        usrmgr.add_user("@foouser", "foogroup", user_id=1337)
+        usrmgr.add_user("@foouser", "bargroup", user_id=1337)
+        usrmgr.add_user("@baruser", "bargroup")
+
+        users = usrmgr.iter_users(["foogroup", "bargroup"], unverified=True)
+        self.assertEqual(next(users), {"username": "@foouser", "id": 1337})
+        # the iteration keeps the snapshot it started with
+        usrmgr.add_user("@bazuser", "bargroup")
+        self.assertEqual(list(users), [{"username": "@baruser", "id": None}])
+
+        self.assertEqual(list(usrmgr.iter_users("bargroup")),
+                         [{"username": "@foouser", "id": 1337}])
+        self.assertEqual(usrmgr.count_users(["foogroup", "bargroup"],
+                                            mode="intersection"), 1)
+        self.assertEqual(usrmgr.count_users("bargroup", unverified=True), 3)
+        with self.assertRaises(ValueError):
+            usrmgr.count_users("bargroup", mode="difference")
+
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+    Provides a unit test class for the ownbot.webhook module.
+"""
+import json
+import threading
+from unittest import TestCase
+from mock import Mock, patch
+
+try:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError
+except ImportError:  # python 2
+    from urllib2 import Request, urlopen, HTTPError
+
+from ownbot.loadtest import FakeBot
+from ownbot.webhook import WebhookRunner
+
+
+def _update(update_id):
+    """
+        Returns the JSON data of a message update.
+    """
+    return {"update_id": update_id,
+            "message": {"message_id": update_id, "date": 0,
+                        "from": {"id": 1337, "first_name": "foo",
+                                 "username": "foouser"},
+                        "chat": {"id": 1337, "type": "private"},
+                        "text": "/start"}}
+
+
+class TestWebhook(TestCase):  # pylint: disable=too-many-public-methods
+    """
+        Provides unit tests for the ownbot.webhook module.
+    """
+
+    def setUp(self):
+        self.dispatcher = Mock()
+        self.dispatcher.bot = FakeBot()
+        self.runner = None
+
+    def tearDown(self):
+        if self.runner is not None:
+            self.runner.stop(timeout=5)
+
+    def __start(self, **kwargs):
+        """
+            Starts a runner on a free port.
+        """
+        self.runner = WebhookRunner(self.dispatcher, 0, host="127.0.0.1",
+                                    path="/hook", **kwargs)
+        self.runner.start()
+
+    def __url(self, path):
+        """
+            Returns the URL of a path on the runner.
+        """
+        return "http://{0}:{1}{2}".format(self.runner.address[0],
+                                          self.runner.address[1], path)
+
+    def __post(self, data, path="/hook"):
+        """
+            Posts data and returns the status.
+        """
+        body = data if isinstance(data, bytes) else \
+            json.dumps(data).encode("utf-8")
+        request = Request(self.__url(path), data=body,
+                          headers={"Content-Type": "application/json"})
+        try:
+            return urlopen(request, timeout=5).getcode()
+        except HTTPError as error:
+            return error.code
+
+    def test_dispatches_updates(self):
+        """
+            Test that posted updates are passed to the dispatcher
+        """
+        self.__start(workers=2)
+        for update_id in range(5):
+            self.assertEqual(self.__post(_update(update_id)), 200)
+
+        self.assertEqual(self.runner.stop(timeout=5), 0)
+        self.runner = None
+        update_ids = sorted(call[0][0].update_id for call in
+                            self.dispatcher.process_update.call_args_list)
+        self.assertEqual(update_ids, list(range(5)))
+        update = self.dispatcher.process_update.call_args[0][0]
+        self.assertEqual(update.message.from_user.id, 1337)
+
+    def test_invalid_requests(self):
+        """
+            Test that invalid bodies and unknown paths are rejected
+        """
+        self.__start()
+        self.assertEqual(self.__post(b"no json"), 400)
+        self.assertEqual(self.__post(_update(1), path="/other"), 404)
+        with patch("ownbot.webhook.MAX_BODY_SIZE", 10):
+            self.assertEqual(self.__post(_update(1)), 400)
+        self.assertEqual(self.runner.stats["invalid"], 2)
+        self.assertFalse(self.dispatcher.process_update.called)
+
+    def test_backpressure(self):
+        """
+            Test that updates are rejected with 503 if the queue is full
+        """
+        release = threading.Event()
+        started = threading.Event()
+
+        def process_update(update):  # pylint: disable=unused-argument
+            """Blocks the worker"""
+            started.set()
+            release.wait(5)
+
+        self.dispatcher.process_update.side_effect = process_update
+        self.__start(workers=1, queue_size=2)
+
+        self.assertEqual(self.__post(_update(1)), 200)
+        self.assertTrue(started.wait(5))
+        self.assertEqual(self.__post(_update(2)), 200)
+        self.assertEqual(self.__post(_update(3)), 200)
+
+        request = Request(self.__url("/hook"),
+                          data=json.dumps(_update(4)).encode("utf-8"))
+        with self.assertRaises(HTTPError) as context:
+            urlopen(request, timeout=5)
+        self.assertEqual(context.exception.code, 503)
+        self.assertEqual(context.exception.headers["Retry-After"], "1")
+
+        metrics = json.loads(urlopen(self.__url("/metrics"), timeout=5)
+                             .read().decode("utf-8"))
+        self.assertEqual(metrics["received"], 3)
+        self.assertEqual(metrics["rejected"], 1)
+        self.assertEqual(metrics["queued"], 2)
+        self.assertEqual(metrics["max_queued"], 2)
+
+        release.set()
+
+    def test_stop_drains_queue(self):
+        """
+            Test that queued updates are processed on stop
+        """
+        release = threading.Event()
+        self.dispatcher.process_update.side_effect = \
+            lambda update: release.wait(5)
+        self.__start(workers=1, queue_size=10)
+        for update_id in range(4):
+            self.assertEqual(self.__post(_update(update_id)), 200)
+
+        release.set()
+        self.assertEqual(self.runner.stop(timeout=5), 0)
+        stats = self.runner.stats
+        self.runner = None
+        self.assertEqual(stats["processed"], 4)
+        self.assertEqual(stats["queued"], 0)
+
+        # updates after the stop are rejected
+        self.assertFalse(WebhookRunner(self.dispatcher, 0,
+                                       host="127.0.0.1").submit(Mock()))
+
+    def test_failed_updates(self):
+        """
+            Test that exceptions of handlers are counted
+        """
+        self.dispatcher.process_update.side_effect = ValueError("foo")
+        self.__start(workers=1)
+        self.assertEqual(self.__post(_update(1)), 200)
+        self.runner.stop(timeout=5)
+        self.assertEqual(self.runner.stats["failed"], 1)
+        self.runner = None
+
+    def test_set_webhook(self):
+        """
+            Test that the webhook is registered on start
+        """
+        self.dispatcher.bot = Mock()
+        self.runner = WebhookRunner(self.dispatcher, 0, host="127.0.0.1")
+        self.runner.start(webhook_url="https://example.com/hook")
+        self.dispatcher.bot.setWebhook.assert_called_with(
+            webhook_url="https://example.com/hook")